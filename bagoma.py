@@ -34,19 +34,45 @@ import shutil
 import re
 import pprint
 import hashlib
+import zlib
+import mmap
+import tempfile
+import struct
 import time
+import calendar
 import getpass
 import imap_utf7
 import ConfigParser
 import logging
 import argparse
+import threading
+import multiprocessing
+import socket
+import Queue
+import copy_reg
+from bisect import bisect_left
+from binascii import hexlify, unhexlify
+from heapq import merge
+from collections import deque
 from email.parser import HeaderParser
 from email.utils import getaddresses, parsedate_tz, mktime_tz
-from copy import deepcopy
+from copy import copy, deepcopy
+from cStringIO import StringIO
 from xml.dom.minidom import Document
 from types import *
+from array import array
 from lockfile import LockFile
 
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # For debugging
 try:
     import pdb
@@ -79,30 +105,1152 @@ IgnoredFolders = ['Spam', 'Trash']
 # Tell imaplib that XLIST works the same way as LIST
 imaplib.Commands['XLIST'] = imaplib.Commands['LIST']
 
+# ENABLE (RFC 5161) is not known to imaplib
+imaplib.Commands['ENABLE'] = ('AUTH',)
+
+# Neither is COMPRESS (RFC 4978)
+imaplib.Commands['COMPRESS'] = ('AUTH', 'SELECTED')
+
 msgIdMatch  = re.compile(r'\bMessage-Id\: (.+)', re.IGNORECASE + re.MULTILINE)
 uIdMatch    = re.compile(r'\bUID (\d+)', re.IGNORECASE)
 lstRspMatch = re.compile(r'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)')
 intDateMatch= re.compile(r'\bINTERNALDATE "([^"]+)"')
 flagsMatch  = re.compile(r'\bFLAGS \(([^\)]*)\)')
+hdrEndMatch = re.compile(r'\r?\n\r?\n')
+gmMsgIdMatch= re.compile(r'\bX-GM-MSGID (\d+)')
+gmLabelsMatch=re.compile(r'\bX-GM-LABELS \(((?:[^()"]|"(?:[^"\\]|\\.)*")*)\)')
+gmLabelMatch= re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s"]+)')
+literalMatch= re.compile(r'\{\d+\+?\}$')
+stsRspMatch = re.compile(r'(?P<name>.*) \((?P<items>[^()]*)\)$')
+esearchMatch= re.compile(r'\bALL (\S+)', re.IGNORECASE)
+sizeMatch   = re.compile(r'\bRFC822\.SIZE (\d+)', re.IGNORECASE)
+sha1Match   = re.compile(r'^[0-9a-f]{40}$')
+utcDateMatch= re.compile(r'^(\d\d)-(\w{3})-(\d{4}) (\d\d):(\d\d):(\d\d) \+0000$')
+shardMatch  = re.compile(r'^[0-9a-f]{2}$')
 
 emailMatch  = re.compile(r'([\w\-\.+]+@((\w[\w\-]+)\.)+[\w\-]+)')
 
 DOW = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MON = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
 def serialize(filename, value):
-    f = open(filename, 'w')
-    pickle.dump(value, f)
+    # A crash while writing must not leave a truncated file behind
+    f = open(filename + '.tmp', 'wb')
+    pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
     f.close()
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(filename + '.tmp', filename)
 
 def deserialize(filename):
     try:
-        f = open(filename, 'r')
-        value = pickle.load(f)
+        f = open(filename, 'rb')
+        unpickler = pickle.Unpickler(f)
+        unpickler.find_global = findGlobal
+        value = unpickler.load()
         f.close()
         return value
     except:
         return {}
 
+def findGlobal(module, name):
+    if (module, name) == ('copy_reg', '_reconstructor'):
+        return reconstruct
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+def reconstruct(cls, base, state):
+    """
+    Pickles made by older versions have EmailMsg objects that were dict
+    subclasses.
+    """
+    if base is dict and not issubclass(cls, dict):
+        obj = cls.__new__(cls)
+        obj.update(state)
+        return obj
+    return copy_reg._reconstructor(cls, base, state)
+
+def compressUidSet(uids):
+    """
+    Packs a list of UIDs into an IMAP sequence set (ex: "1:4,7,9:12"). The
+    order of the UIDs is not preserved.
+    """
+    ranges = []
+    for uid in sorted(set([int(u) for u in uids])):
+        if len(ranges) and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join([str(lo) if lo == hi else '%d:%d' % (lo, hi) for lo, hi in ranges])
+
+def expandUidSet(seqSet):
+    """
+    Unpacks an IMAP sequence set (ex: "1:4,7,9:12") into a list of UIDs
+    (strings), in the order the set lists them. COPYUID (RFC 4315) pairs the
+    source and destination UIDs by their position in the two sets.
+    """
+    uids = []
+    for part in seqSet.split(','):
+        lo, sep, hi = part.partition(':')
+        lo, hi = sorted([int(lo), int(hi if len(sep) else lo)])
+        uids.extend([str(uid) for uid in xrange(lo, hi + 1)])
+    return uids
+
+def groupBySize(items, size, maxCount, maxBytes):
+    """
+    Generator that yields the items in lists of up to maxCount items whose
+    size(item) add up to at most maxBytes. An item larger than maxBytes gets
+    a list of its own. Items are only taken from the iterable as needed.
+    """
+    group, bytes = [], 0
+    for item in items:
+        itemSize = size(item)
+        if len(group) and (len(group) >= maxCount or bytes + itemSize > maxBytes):
+            yield group
+            group, bytes = [], 0
+        group.append(item)
+        bytes += itemSize
+    if len(group):
+        yield group
+
+
+class UidSet(object):
+    """
+    A set of UIDs stored as sorted, non-overlapping (lo, hi) ranges. The memory
+    it takes, and the time it takes to compute the difference/intersection of
+    two sets, depends on the number of gaps between the UIDs, not on the number
+    of UIDs.
+
+    Iterating over the set yields the UIDs as strings, the same way they are
+    returned by the server (and used as EmailFolder.msgs keys).
+    """
+    def __init__(self, uids=()):
+        # Flattened (lo, hi) pairs
+        self.ranges = array('L')
+        for uid in sorted(set([long(u) for u in uids])):
+            self.append(uid)
+
+    @staticmethod
+    def parse(seqSet):
+        """Creates a UidSet from an IMAP sequence set (ex: "1:4,7,9:12")"""
+        pairs = []
+        for part in seqSet.split(','):
+            lo, sep, hi = part.partition(':')
+            if len(sep):
+                pairs.append(tuple(sorted([long(lo), long(hi)])))
+            else:
+                pairs.append((long(lo), long(lo)))
+        return UidSet.fromPairs(pairs)
+
+    @staticmethod
+    def fromPairs(pairs):
+        """Creates a UidSet from a list of (lo, hi) ranges"""
+        uidSet = UidSet()
+        for lo, hi in sorted(pairs):
+            r = uidSet.ranges
+            if len(r) and lo <= r[-1] + 1:
+                r[-1] = max(r[-1], hi)
+            else:
+                r.extend([lo, hi])
+        return uidSet
+
+    @staticmethod
+    def of(uids):
+        """Backups made before UidSet existed have lists of UIDs"""
+        if isinstance(uids, UidSet):
+            return uids
+        return UidSet(uids)
+
+    def append(self, uid):
+        """Adds a UID larger than all the UIDs already in the set"""
+        r = self.ranges
+        if len(r) and uid == r[-1] + 1:
+            r[-1] = uid
+        else:
+            r.extend([uid, uid])
+
+    def pairs(self):
+        r = self.ranges
+        return [(r[i], r[i + 1]) for i in xrange(0, len(r), 2)]
+
+    def __len__(self):
+        r = self.ranges
+        return int(sum([r[i + 1] - r[i] + 1 for i in xrange(0, len(r), 2)]))
+
+    def __iter__(self):
+        for lo, hi in self.pairs():
+            for uid in xrange(lo, hi + 1):
+                yield str(uid)
+
+    def __contains__(self, uid):
+        uid = long(uid)
+        r = self.ranges
+        lo, hi = 0, len(r) / 2
+        while lo < hi:
+            mid = (lo + hi) / 2
+            if r[2 * mid + 1] < uid:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < len(r) / 2 and r[2 * lo] <= uid
+
+    def __str__(self):
+        return ','.join([str(lo) if lo == hi else '%d:%d' % (lo, hi) for lo, hi in self.pairs()])
+
+    def union(self, other):
+        return UidSet.fromPairs(self.pairs() + UidSet.of(other).pairs())
+
+    def intersection(self, other):
+        a = self.pairs()
+        b = UidSet.of(other).pairs()
+        pairs = []
+        i = j = 0
+        while i < len(a) and j < len(b):
+            lo = max(a[i][0], b[j][0])
+            hi = min(a[i][1], b[j][1])
+            if lo <= hi:
+                pairs.append((lo, hi))
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return UidSet.fromPairs(pairs)
+
+    def difference(self, other):
+        b = UidSet.of(other).pairs()
+        pairs = []
+        j = 0
+        for lo, hi in self.pairs():
+            while j < len(b) and b[j][1] < lo:
+                j += 1
+            k = j
+            while k < len(b) and b[k][0] <= hi:
+                if b[k][0] > lo:
+                    pairs.append((lo, b[k][0] - 1))
+                lo = max(lo, b[k][1] + 1)
+                k += 1
+            if lo <= hi:
+                pairs.append((lo, hi))
+        return UidSet.fromPairs(pairs)
+
+
+class UidMap(object):
+    """
+    The UID => SHA1 map of a folder (see EmailFolder.msgs). It behaves like a
+    dict of string UIDs and hex SHA1 values, but the UIDs are kept in a sorted
+    array, and the SHA1s as 20 byte binary digests in a parallel byte array.
+    That's 24 bytes per message instead of the ~200 bytes taken by a dict
+    entry and its two strings.
+
+    The UIDs of a SHA1 can be looked up too (see uidOf). The reverse map that
+    takes is only built the first time it's needed, and is kept up to date
+    after that. It's not saved with the index (see __getstate__): only a
+    restore and compact look UIDs up, and building it is a single pass over
+    the arrays, no slower than loading it would be. Saving it (or, with the
+    SQLite index, indexing membership by SHA1) would about double the size of
+    the folder maps, which backups load but never look up by SHA1.
+    """
+    __slots__ = ('uids', 'digests', 'unsorted', 'other', 'reverse', 'added')
+
+    def __init__(self, items=()):
+        self.uids = array('I')
+        self.digests = bytearray()
+
+        # UID => digest of the UIDs not added in ascending order. Merged into
+        # the arrays when needed (see sort)
+        self.unsorted = {}
+
+        # UID => value of the values that are not SHA1s
+        self.other = {}
+
+        # Digest => UID (or tuple of UIDs if several messages have the same
+        # SHA1). None until needed (see uidsOf)
+        self.reverse = None
+
+        # The UIDs set since the last takeAdded(), or None if not recorded
+        # (see track)
+        self.added = None
+
+        if hasattr(items, 'items'):
+            items = items.items()
+        for uid, sha1 in sorted([(long(uid), sha1) for uid, sha1 in items]):
+            self[uid] = sha1
+
+    def find(self, uid):
+        i = bisect_left(self.uids, uid)
+        if i < len(self.uids) and self.uids[i] == uid:
+            return i
+        return -1
+
+    def digest(self, i):
+        return str(self.digests[20 * i : 20 * i + 20])
+
+    def sort(self):
+        """Merges the UIDs that were added out of order"""
+        if not len(self.unsorted):
+            return
+        items = merge(((self.uids[i], self.digest(i)) for i in xrange(len(self.uids))),
+                      sorted(self.unsorted.items()))
+        uids = array('I')
+        digests = bytearray()
+        for uid, digest in items:
+            uids.append(uid)
+            digests.extend(digest)
+        self.uids, self.digests, self.unsorted = uids, digests, {}
+
+    def __getitem__(self, uid):
+        uid = long(uid)
+        if self.other.has_key(uid):
+            return self.other[uid]
+        if self.unsorted.has_key(uid):
+            return hexlify(self.unsorted[uid])
+        i = self.find(uid)
+        if i < 0:
+            raise KeyError(str(uid))
+        return hexlify(self.digest(i))
+
+    def __setitem__(self, uid, sha1):
+        uid = long(uid)
+        if self.has_key(uid):
+            del self[uid]
+        if self.added is not None:
+            self.added.append(uid)
+
+        if not sha1Match.match(sha1):
+            self.other[uid] = sha1
+            return
+
+        digest = unhexlify(sha1)
+        if not len(self.uids) or uid > self.uids[-1]:
+            self.uids.append(uid)
+            self.digests.extend(digest)
+        else:
+            self.unsorted[uid] = digest
+            if len(self.unsorted) > 4096:
+                self.sort()
+        self.link(digest, uid)
+
+    def __delitem__(self, uid):
+        uid = long(uid)
+        if self.other.has_key(uid):
+            del self.other[uid]
+        elif self.unsorted.has_key(uid):
+            self.unlink(self.unsorted.pop(uid), uid)
+        else:
+            i = self.find(uid)
+            if i < 0:
+                raise KeyError(str(uid))
+            self.unlink(self.digest(i), uid)
+            del self.uids[i]
+            del self.digests[20 * i : 20 * i + 20]
+
+    def link(self, digest, uid):
+        if self.reverse is None:
+            return
+        uid = int(uid)
+        uids = self.reverse.get(digest)
+        if uids is None:
+            self.reverse[digest] = uid
+        elif isinstance(uids, tuple):
+            self.reverse[digest] = uids + (uid,)
+        else:
+            self.reverse[digest] = (uids, uid)
+
+    def unlink(self, digest, uid):
+        if self.reverse is None:
+            return
+        uids = self.reverse.get(digest)
+        if isinstance(uids, tuple):
+            uids = tuple([u for u in uids if u != uid])
+            self.reverse[digest] = uids[0] if len(uids) == 1 else uids
+        elif uids == uid:
+            del self.reverse[digest]
+
+    def track(self):
+        """Starts recording the UIDs set (see Checkpoint.save)"""
+        self.added = []
+
+    def takeAdded(self):
+        """Returns the UIDs set since the last call (or since track())"""
+        added, self.added = self.added, []
+        return [str(uid) for uid in added]
+
+    def uidsOf(self, sha1):
+        """Returns the UIDs (strings) whose value is sha1"""
+        if not sha1Match.match(sha1):
+            return [str(uid) for uid in sorted([uid for uid, val in self.other.items() if val == sha1])]
+
+        if self.reverse is None:
+            self.reverse = {}
+            for i in xrange(len(self.uids)):
+                self.link(self.digest(i), self.uids[i])
+            for uid, digest in self.unsorted.items():
+                self.link(digest, uid)
+
+        uids = self.reverse.get(unhexlify(sha1), ())
+        if not isinstance(uids, tuple):
+            uids = (uids,)
+        return [str(uid) for uid in sorted(uids)]
+
+    def uidOf(self, sha1, default=None):
+        """
+        Returns the UID whose value is sha1 (the highest one if there are
+        several), or default if there is none.
+        """
+        uids = self.uidsOf(sha1)
+        if not len(uids):
+            return default
+        return uids[-1]
+
+    def has_key(self, uid):
+        uid = long(uid)
+        return self.other.has_key(uid) or self.unsorted.has_key(uid) or self.find(uid) >= 0
+
+    __contains__ = has_key
+
+    def get(self, uid, default=None):
+        try:
+            return self[uid]
+        except KeyError:
+            return default
+
+    def __len__(self):
+        return len(self.uids) + len(self.unsorted) + len(self.other)
+
+    def iteritems(self):
+        self.sort()
+        for i in xrange(len(self.uids)):
+            yield (str(self.uids[i]), hexlify(self.digest(i)))
+        for uid, val in self.other.items():
+            yield (str(uid), val)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        self.sort()
+        return [str(uid) for uid in self.uids] + [str(uid) for uid in self.other.keys()]
+
+    def values(self):
+        return [sha1 for uid, sha1 in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def clear(self):
+        self.__init__()
+
+    def copy(self):
+        new = UidMap()
+        new.uids = array('I', self.uids)
+        new.digests = bytearray(self.digests)
+        new.unsorted = dict(self.unsorted)
+        new.other = dict(self.other)
+        if self.reverse is not None:
+            new.reverse = dict(self.reverse)
+        return new
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __getstate__(self):
+        # Without the reverse map, rebuilt when needed after loading
+        self.sort()
+        return (sys.byteorder, self.uids.tostring(), str(self.digests), self.other)
+
+    def __setstate__(self, state):
+        byteorder, uids, digests, self.other = state
+        self.uids = array('I')
+        self.uids.fromstring(uids)
+        if byteorder != sys.byteorder:
+            self.uids.byteswap()
+        self.digests = bytearray(digests)
+        self.unsorted = {}
+        self.reverse = None
+        self.added = None
+
+
+class MsgStore(object):
+    """
+    The messages of a backup directory. With the "files" layout, each message
+    is in its own file: backupDir/sha[0:2]/sha. With the "pack" layout, new
+    messages are appended to pack files instead (see PackSet). Messages can be
+    compressed, in which case the name of their file ends with the extension of
+    the compression format. New messages are written in the format and layout
+    chosen for the backup directory (see setFormat, setLayout), but messages in
+    any format or layout can be read.
+
+    The SHA1 of the (uncompressed) body of each message written is kept in
+    backupDir/BaGoMa.sums, so corrupted messages can be found later (see
+    checksum). Like the pack index, it has one line per change:
+        sha1 body-sha1
+        sha1 -                              (the message was removed)
+    """
+    Extensions = {'none':'', 'gzip':'.gz', 'zstd':'.zst'}
+    Layouts = ['files', 'pack']
+    PackDir = 'packs'
+
+    def __init__(self, backupDir):
+        self.backupDir = backupDir
+        self.configFile = os.path.join(backupDir, "BaGoMa.store")
+        self.format = 'none'
+        self.layout = 'files'
+        if os.path.exists(self.configFile):
+            self.readConfig()
+        self.packDir = os.path.join(backupDir, MsgStore.PackDir)
+        self.recoverPacks()
+        self.packs = PackSet(self.packDir)
+        # The directories known to exist (see makeDir)
+        self.dirs = set()
+        # Files written since the last sync()
+        self.unsynced = []
+        self.sumsFile = os.path.join(backupDir, "BaGoMa.sums")
+        # Key = sha1, value = the SHA1 of its body. Loaded when first needed
+        self.sums = None
+        # BaGoMa.sums lines not written yet (see sync)
+        self.unsummed = []
+        self.lock = threading.Lock()
+
+    def readConfig(self):
+        config = ConfigParser.RawConfigParser()
+        try:
+            config.read(self.configFile)
+        except ConfigParser.MissingSectionHeaderError:
+            # Older versions only wrote the format
+            with open(self.configFile, 'r') as f:
+                self.format = f.read().strip()
+            return
+        if config.has_option('store', 'format'):
+            self.format = config.get('store', 'format')
+        if config.has_option('store', 'layout'):
+            self.layout = config.get('store', 'layout')
+
+    def saveConfig(self):
+        if not os.path.exists(self.backupDir):
+            os.makedirs(self.backupDir)
+        config = ConfigParser.RawConfigParser()
+        config.add_section('store')
+        config.set('store', 'format', self.format)
+        config.set('store', 'layout', self.layout)
+        with open(self.configFile, 'w') as f:
+            config.write(f)
+
+    @staticmethod
+    def available():
+        """The formats that can be used on this system"""
+        return [fmt for fmt in sorted(MsgStore.Extensions.keys()) if fmt != 'zstd' or zstandard is not None]
+
+    def setFormat(self, format):
+        """Sets the format of the new messages written to the backup directory"""
+        self.format = format
+        self.saveConfig()
+
+    def setLayout(self, layout):
+        """Sets the layout of the new messages written to the backup directory"""
+        self.layout = layout
+        self.saveConfig()
+
+    @staticmethod
+    def parseName(fname):
+        """Returns (sha1, format) of a file name, or (fname, None)"""
+        for fmt, ext in MsgStore.Extensions.items():
+            if len(ext) and fname.endswith(ext):
+                return (fname[:-len(ext)], fmt)
+        if fname.endswith('.tmp') or fname.endswith('.part'):
+            return (fname, None)
+        return (fname, 'none')
+
+    @staticmethod
+    def skipPacks(fnames):
+        """Keeps os.path.walk out of the pack directories"""
+        fnames[:] = [f for f in fnames if f not in (MsgStore.PackDir, MsgStore.PackDir + '.new',
+                                                    MsgStore.PackDir + '.old')]
+
+    def path(self, sha1, format=None):
+        return os.path.join(self.backupDir, sha1[0:2], sha1 + MsgStore.Extensions[format or self.format])
+
+    def partPath(self, sha1):
+        """The file a large message is downloaded to (see ImapServer.saveLargeMsg)"""
+        return os.path.join(self.backupDir, sha1[0:2], sha1 + '.part')
+
+    def removePart(self, sha1):
+        part = self.partPath(sha1)
+        os.remove(part)
+        if self.layout == 'pack':
+            # Otherwise pack stores don't use the shard directories
+            dir = os.path.dirname(part)
+            self.dirs.discard(dir)
+            try:
+                os.rmdir(dir)
+            except OSError:
+                pass
+
+    def find(self, sha1):
+        """Returns (path, format) of the file containing sha1, or (None, None) if it's not in a file"""
+        for fmt in [self.format] + [f for f in MsgStore.Extensions.keys() if f != self.format]:
+            path = self.path(sha1, fmt)
+            # Older versions left empty files behind when a FETCH failed
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                return (path, fmt)
+        return (None, None)
+
+    def exists(self, sha1):
+        return sha1 in self.packs or self.find(sha1)[0] is not None
+
+    def packed(self):
+        """The SHA1s of the messages in pack files"""
+        return self.packs.keys()
+
+    def makeDir(self, dir):
+        if dir not in self.dirs:
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # Another download thread could have just created it
+                if not os.path.isdir(dir):
+                    raise
+            self.dirs.add(dir)
+
+    def create(self, sha1, compressed=False, size=None):
+        """
+        Returns a MsgWriter to write sha1 to (in the store's format and
+        layout). If compressed is True, the data written to it must already be
+        in the store's format. If size is given, the message is only saved if
+        that many bytes were written. The message only shows up in the store
+        once the MsgWriter is closed, and is on disk after the next sync().
+        """
+        if self.layout == 'pack':
+            dir = self.packDir
+        else:
+            dir = os.path.join(self.backupDir, sha1[0:2])
+        self.makeDir(dir)
+        # Compressed data is re-written by compact, and keeps its checksum
+        # (the MsgWriter's digest is None)
+        return MsgWriter(dir, self.format, size, lambda tmpPath, digest: self.adopt(sha1, tmpPath, digest),
+                         compressed)
+
+    def adopt(self, sha1, path, digest=None):
+        """
+        Adds path, a complete message file in the store's format, to the store
+        as sha1. digest is the SHA1 of its (uncompressed) contents, or None to
+        keep the one already known. With the files layout, path is renamed to
+        the message file. With the pack layout, it's appended to the pack and
+        left for the caller to remove.
+        """
+        if self.layout == 'pack':
+            self.packs.appendFile(sha1, path, self.format)
+        else:
+            self.makeDir(os.path.join(self.backupDir, sha1[0:2]))
+            self.commit(path, self.path(sha1))
+        if digest is not None:
+            self.setChecksum(sha1, digest)
+
+    def commit(self, tmpPath, path):
+        if os.name == 'nt' and os.path.exists(path):
+            # Windows can't rename over an existing file
+            os.remove(path)
+        os.rename(tmpPath, path)
+        with self.lock:
+            self.unsynced.append(path)
+
+    def loadSums(self):
+        """Call with self.lock held"""
+        if self.sums is not None:
+            return
+        self.sums = {}
+        if os.path.exists(self.sumsFile):
+            with open(self.sumsFile, 'rb') as f:
+                lines = f.readlines()
+        else:
+            lines = []
+        for line in lines + [line + '\n' for line in self.unsummed]:
+            fields = line.split()
+            if len(fields) != 2 or not line.endswith('\n'):
+                # Cut short by a crash
+                continue
+            if fields[1] == '-':
+                self.sums.pop(fields[0], None)
+            else:
+                self.sums[fields[0]] = fields[1]
+
+    def checksum(self, sha1):
+        """The SHA1 of the body of sha1 when it was saved, or None if it's not known"""
+        with self.lock:
+            self.loadSums()
+            return self.sums.get(sha1)
+
+    def setChecksum(self, sha1, digest):
+        """digest is None if sha1 was removed"""
+        with self.lock:
+            self.unsummed.append("%s %s" % (sha1, digest or '-'))
+            if self.sums is not None:
+                if digest is None:
+                    self.sums.pop(sha1, None)
+                else:
+                    self.sums[sha1] = digest
+
+    def pruneSums(self, keep):
+        """Re-writes BaGoMa.sums with only the messages in keep"""
+        with self.lock:
+            self.loadSums()
+            self.sums = dict([(sha1, digest) for sha1, digest in self.sums.items() if sha1 in keep])
+            self.unsummed = []
+            tmpPath = self.sumsFile + '.tmp'
+            with open(tmpPath, 'wb') as f:
+                f.write(''.join(["%s %s\n" % item for item in sorted(self.sums.items())]))
+                f.flush()
+                os.fsync(f.fileno())
+            if os.name == 'nt' and os.path.exists(self.sumsFile):
+                os.remove(self.sumsFile)
+            os.rename(tmpPath, self.sumsFile)
+
+    def sync(self):
+        """Flushes the messages written since the last sync to disk"""
+        with self.lock:
+            paths, self.unsynced = self.unsynced, []
+            sums, self.unsummed = self.unsummed, []
+
+        dirs = set()
+        for path in paths:
+            fsyncPath(path)
+            dirs.add(os.path.dirname(path))
+        if os.name != 'nt':
+            # So the renames are on disk too
+            for dir in dirs:
+                fsyncPath(dir)
+        self.packs.sync()
+        if len(sums):
+            # Only once the messages they are for are on disk
+            with open(self.sumsFile, 'ab') as f:
+                f.write(''.join([line + '\n' for line in sums]))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read(self, sha1):
+        """Returns the (uncompressed) contents of sha1"""
+        path, fmt = self.find(sha1)
+        if path is not None:
+            return MsgStore.readFile(path, fmt)
+        if sha1 in self.packs:
+            return MsgStore.decompress(*self.packs.read(sha1))
+        raise IOError("Missing message file: %s" % sha1)
+
+    def open(self, sha1):
+        """
+        Returns (file, size) to read the (uncompressed) contents of sha1 from.
+        Uncompressed message files are read from disk as the caller goes, the
+        others are decompressed in memory first.
+        """
+        path, fmt = self.find(sha1)
+        if path is not None and fmt == 'none':
+            return (open(path, 'rb'), os.path.getsize(path))
+        data = self.read(sha1)
+        return (StringIO(data), len(data))
+
+    def readHeaders(self, sha1):
+        """
+        Returns the headers of sha1 (up to the first empty line), reading and
+        decompressing only as much of the message as needed.
+        """
+        path, fmt = self.find(sha1)
+        if path is not None:
+            return MsgStore.readHeadersAt(path, fmt)
+        elif sha1 in self.packs:
+            path, offset, length, fmt = self.packs.locate(sha1)
+            return MsgStore.readHeadersAt(path, fmt, offset, length)
+        raise IOError("Missing message file: %s" % sha1)
+
+    @staticmethod
+    def readHeadersAt(path, format, offset=0, length=None):
+        """
+        Returns the headers of the message at offset in path (length bytes
+        long, or up to the end of the file), like readHeaders. Doesn't need a
+        MsgStore, so it can run in other processes (see rehashShard).
+        """
+        decompressor = MsgStore.decompressor(format)
+        headers = ''
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while length is None or length > 0:
+                chunk = f.read(8192 if length is None else min(length, 8192))
+                if not len(chunk):
+                    break
+                if length is not None:
+                    length -= len(chunk)
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                # The end of the headers can straddle two chunks
+                start = max(len(headers) - 3, 0)
+                headers += chunk
+                end = hdrEndMatch.search(headers, start)
+                if end is not None:
+                    return headers[:end.start()]
+        return headers
+
+    @staticmethod
+    def readFile(path, format):
+        return ''.join(MsgStore.readChunks(path, format))
+
+    @staticmethod
+    def readChunks(path, format):
+        """Yields the (uncompressed) contents of a message file, a chunk at a time"""
+        decompressor = MsgStore.decompressor(format)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(65536)
+                if not len(chunk):
+                    break
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                yield chunk
+        if decompressor is not None and hasattr(decompressor, 'flush'):
+            yield decompressor.flush()
+
+    def move(self, sha1From, sha1To):
+        path, fmt = self.find(sha1From)
+        if path is None:
+            self.packs.rename(sha1From, sha1To)
+        else:
+            # Creates directories as needed
+            os.renames(path, self.path(sha1To, fmt))
+        digest = self.checksum(sha1From)
+        if digest is not None:
+            self.setChecksum(sha1To, digest)
+            self.setChecksum(sha1From, None)
+
+    def remove(self, sha1):
+        path, fmt = self.find(sha1)
+        if path is None:
+            self.packs.remove(sha1)
+        else:
+            os.remove(path)
+        if self.checksum(sha1) is not None:
+            self.setChecksum(sha1, None)
+
+    def recoverPacks(self):
+        """Finishes (or discards) a repack that was interrupted (see swapPacks)"""
+        if os.path.isdir(self.packDir + '.old'):
+            if not os.path.isdir(self.packDir) and os.path.isdir(self.packDir + '.new'):
+                os.rename(self.packDir + '.new', self.packDir)
+            shutil.rmtree(self.packDir + '.old')
+        if os.path.isdir(self.packDir + '.new'):
+            shutil.rmtree(self.packDir + '.new')
+
+    def newPacks(self):
+        """Returns an empty PackSet to repack the messages into (see swapPacks)"""
+        self.recoverPacks()
+        return PackSet(self.packDir + '.new')
+
+    def swapPacks(self, packs):
+        """Replaces the pack files with the ones created by newPacks"""
+        self.sync()
+        packs.close()
+        self.packs.close()
+        if os.path.isdir(self.packDir):
+            os.rename(self.packDir, self.packDir + '.old')
+        if os.path.isdir(packs.dir):
+            os.rename(packs.dir, self.packDir)
+        self.recoverPacks()
+        self.packs = PackSet(self.packDir)
+
+    @staticmethod
+    def compressor(format):
+        if format == 'gzip':
+            # wbits=31 writes a gzip header, so the files can be inspected with zcat
+            return zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif format == 'zstd':
+            return zstandard.ZstdCompressor().compressobj()
+        return None
+
+    @staticmethod
+    def decompressor(format):
+        if format == 'gzip':
+            return zlib.decompressobj(31)
+        elif format == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj()
+        return None
+
+    @staticmethod
+    def compress(data, format):
+        compressor = MsgStore.compressor(format)
+        if compressor is None:
+            return data
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def decompress(data, format):
+        decompressor = MsgStore.decompressor(format)
+        if decompressor is None:
+            return data
+        data = decompressor.decompress(data)
+        if hasattr(decompressor, 'flush'):
+            data += decompressor.flush()
+        return data
+
+
+class PackSet(object):
+    """
+    Append-only pack files (dir/pack-NNNNNN.pack) holding many messages back
+    to back, and an index (dir/index) of where each message is. The index is a
+    text file with one line per change:
+        sha1 pack offset length format
+        sha1 -                              (the message was removed)
+    Later lines override earlier ones. Messages are read through mmap.
+    """
+    MaxSize = 256 * 1024 * 1024
+    Entry = struct.Struct('<IQI')
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.indexFile = os.path.join(dir, 'index')
+        # Key = sha1, value = Entry + format
+        self.entries = {}
+        self.packNo = 1
+        self.pack = None
+        self.index = None
+        # Key = pack number, value = mmap of the pack file
+        self.maps = {}
+        # Index lines not written yet (see sync)
+        self.unlogged = []
+        self.lock = threading.Lock()
+
+        if os.path.exists(self.indexFile):
+            with open(self.indexFile, 'rb') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == '-':
+                        self.entries.pop(fields[0], None)
+                    elif len(fields) == 5 and line.endswith('\n'):
+                        packNo, offset, length = [int(n) for n in fields[1:4]]
+                        self.entries[fields[0]] = PackSet.Entry.pack(packNo, offset, length) + fields[4]
+                        self.packNo = max(self.packNo, packNo)
+
+    def __contains__(self, sha1):
+        return sha1 in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def packPath(self, packNo):
+        return os.path.join(self.dir, "pack-%06d.pack" % packNo)
+
+    def open(self):
+        if not os.path.exists(self.dir):
+            os.makedirs(self.dir)
+        if os.path.exists(self.indexFile) and os.path.getsize(self.indexFile):
+            with open(self.indexFile, 'rb+') as f:
+                size = os.path.getsize(self.indexFile)
+                f.seek(max(size - 4096, 0))
+                tail = f.read()
+                if not tail.endswith('\n'):
+                    # Drop the line cut short by a crash (ignored when loading)
+                    f.truncate(size - len(tail) + tail.rfind('\n') + 1)
+        self.index = open(self.indexFile, 'ab')
+        self.pack = open(self.packPath(self.packNo), 'ab')
+        self.pack.seek(0, os.SEEK_END)
+
+    def flushLog(self):
+        """Writes the index lines once the data they point to is on disk. Call with self.lock held"""
+        if not len(self.unlogged):
+            return
+        if self.index is None:
+            self.open()
+        self.pack.flush()
+        os.fsync(self.pack.fileno())
+        self.index.write(''.join([line + '\n' for line in self.unlogged]))
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self.unlogged = []
+
+    def sync(self):
+        with self.lock:
+            self.flushLog()
+
+    def append(self, sha1, data, format):
+        """
+        Appends the (already compressed) data of sha1 to the current pack. data
+        is a string, or a file to copy. Until the next sync(), the message can
+        be read, but a crash would lose it.
+        """
+        length = len(data) if type(data) == StringType else os.fstat(data.fileno()).st_size
+        with self.lock:
+            if self.pack is None:
+                self.open()
+            offset = self.pack.tell()
+            if offset > 0 and offset + length > PackSet.MaxSize:
+                self.flushLog()
+                self.pack.close()
+                self.packNo += 1
+                self.pack = open(self.packPath(self.packNo), 'ab')
+                self.pack.seek(0, os.SEEK_END)
+                offset = self.pack.tell()
+            if type(data) == StringType:
+                self.pack.write(data)
+            else:
+                shutil.copyfileobj(data, self.pack, 65536)
+            # So it can be read through mmap
+            self.pack.flush()
+            self.unlogged.append("%s %d %d %d %s" % (sha1, self.packNo, offset, length, format))
+            self.entries[sha1] = PackSet.Entry.pack(self.packNo, offset, length) + format
+
+    def appendFile(self, sha1, path, format):
+        with open(path, 'rb') as f:
+            self.append(sha1, f, format)
+
+    def locate(self, sha1):
+        """Returns (pack file, offset, length, format) of sha1"""
+        entry = self.entries[sha1]
+        packNo, offset, length = PackSet.Entry.unpack(entry[:PackSet.Entry.size])
+        return (self.packPath(packNo), offset, length, entry[PackSet.Entry.size:])
+
+    def read(self, sha1):
+        """Returns (data, format) of sha1, as stored in the pack"""
+        entry = self.entries[sha1]
+        packNo, offset, length = PackSet.Entry.unpack(entry[:PackSet.Entry.size])
+        with self.lock:
+            pack = self.maps.get(packNo)
+            if pack is None or offset + length > len(pack):
+                # Not mapped yet, or it grew since
+                with open(self.packPath(packNo), 'rb') as f:
+                    pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[packNo] = pack
+        if offset + length > len(pack):
+            raise IOError("Pack %s is truncated: missing %s" % (self.packPath(packNo), sha1))
+        return (pack[offset:offset + length], entry[PackSet.Entry.size:])
+
+    def rename(self, sha1From, sha1To):
+        with self.lock:
+            entry = self.entries.pop(sha1From)
+            packNo, offset, length = PackSet.Entry.unpack(entry[:PackSet.Entry.size])
+            self.unlogged.append("%s %d %d %d %s" % (sha1To, packNo, offset, length, entry[PackSet.Entry.size:]))
+            self.unlogged.append("%s -" % sha1From)
+            self.entries[sha1To] = entry
+            self.flushLog()
+
+    def remove(self, sha1):
+        with self.lock:
+            del self.entries[sha1]
+            self.unlogged.append("%s -" % sha1)
+            self.flushLog()
+
+    def close(self):
+        """Flushes the pack files to disk, and closes them"""
+        with self.lock:
+            self.flushLog()
+            for f in (self.pack, self.index):
+                if f is not None:
+                    f.close()
+            self.pack = None
+            self.index = None
+            for pack in self.maps.values():
+                pack.close()
+            self.maps = {}
+
+
+class MsgWriter(object):
+    """
+    Streams a message to a temporary file in dir, compressing it (unless it
+    is compressed already) and computing the SHA1 of the data written as it
+    goes (see MsgStore.create). When closed, the file is handed over to
+    done(tmpPath, digest). If the write is aborted or falls short of the
+    expected size, the file is deleted instead.
+    """
+    def __init__(self, dir, format, size, done, compressed=False):
+        fd, self.tmpPath = tempfile.mkstemp(suffix='.tmp', dir=dir)
+        # mkstemp ignores the umask
+        os.chmod(self.tmpPath, 0666 & ~umask)
+        self.file = os.fdopen(fd, 'wb')
+        self.compressor = None if compressed else MsgStore.compressor(format)
+        self.expected = size
+        self.size = 0
+        self.sha1 = None if compressed else hashlib.sha1()
+        self.done = done
+
+    def write(self, data):
+        self.size += len(data)
+        if self.sha1 is not None:
+            self.sha1.update(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.file.write(data)
+
+    def close(self):
+        try:
+            if self.compressor is not None:
+                self.file.write(self.compressor.flush())
+            self.file.close()
+            if self.expected is not None and self.size != self.expected:
+                raise IOError("Expected %d bytes, got %d" % (self.expected, self.size))
+            self.done(self.tmpPath, self.digest())
+            logger.debug("Saved %d bytes, SHA1 %s" % (self.size, self.digest()))
+        finally:
+            if os.path.exists(self.tmpPath):
+                os.remove(self.tmpPath)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmpPath)
+
+    def digest(self):
+        return self.sha1.hexdigest() if self.sha1 is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, excTb):
+        if excType is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PartWriter(object):
+    """
+    Appends a chunk of a large message to its .part file, adding it to sha1 as
+    it goes (see ImapServer.saveLargeMsg).
+    """
+    def __init__(self, path, sha1):
+        self.file = open(path, 'ab')
+        self.sha1 = sha1
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha1.update(data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excVal, excTb):
+        self.file.close()
+
+
+# The permissions of the message files (see MsgWriter)
+umask = os.umask(022)
+os.umask(umask)
+
+def fsyncPath(path):
+    # Windows can only flush files opened for writing, and not directories
+    fd = os.open(path, os.O_RDWR if os.name == 'nt' else os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Key = backupDir, value = MsgStore
+msgStores = {}
+msgStoresLock = threading.Lock()
+
+def msgStore(backupDir):
+    # Called by the download threads too
+    with msgStoresLock:
+        if not msgStores.has_key(backupDir):
+            msgStores[backupDir] = MsgStore(backupDir)
+        return msgStores[backupDir]
+
 
 def status(msg, log2logger=True):
     """Logs a status message (or object)"""
@@ -124,24 +1272,222 @@ def progressCli(msg):
 def progressGui(msg):
     status(msg + "\n")
 
+
+class Throttle(object):
+    """
+    Paces the commands all the connections send to the server, so that a
+    backup goes as fast as the server allows instead of going full speed until
+    the account gets locked out for a while.
+
+    Before each command, it waits for the pause after the previous one. When
+    the server says it's throttling us, the pause is doubled and the transfer
+    rate is capped to half of what it was, then the command is sent again (see
+    ImapServer._simple_command). Each command that goes through shortens the
+    pause, and the cap goes up a little every second, so the rate creeps back
+    up to just below the limit.
+    """
+    # Gmail answers "NO [THROTTLED]", or drops the connection with "BYE
+    # Account exceeded command or bandwidth limits"
+    Pattern = re.compile(r'THROTTLED|exceeded command or bandwidth limits', re.IGNORECASE)
+
+    # How many times a throttled command is sent again
+    Retries = 10
+
+    MaxPause = 60.0
+
+    # Bytes/second, and bytes/second added every second
+    MinRate = 256 * 1024
+    RateStep = 64 * 1024
+
+    # Seconds over which the transfer rate is measured. The rate isn't capped
+    # if less than MinWindowBytes were received in that time, since it must be
+    # the number of commands that's over the limit.
+    Window = 10.0
+    MinWindowBytes = 1024 * 1024
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pause = 0.0
+        # Bytes/second, or None until the server throttles us
+        self.rate = None
+        # When the next command can be sent
+        self.next = 0.0
+        # When the last command was done
+        self.last = time.time()
+
+        self.windowStart = time.time()
+        self.windowBytes = 0
+
+        self.commands = 0
+        self.throttled = 0
+        # Average seconds per command, with more weight on the last ones
+        self.latency = None
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(self.next, now)
+            self.next = slot + self.pause
+        if slot > now:
+            time.sleep(slot - now)
+
+    def done(self, elapsed, bytes, throttled):
+        with self.lock:
+            now = time.time()
+            self.commands += 1
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+
+            if now - self.windowStart > Throttle.Window:
+                self.windowStart, self.windowBytes = now - elapsed, 0
+            self.windowBytes += bytes
+
+            if throttled:
+                self.backOff(now)
+            else:
+                # One more command per second
+                self.pause /= 1 + self.pause
+                if self.pause < 0.01:
+                    self.pause = 0.0
+                if self.rate is not None:
+                    self.rate += Throttle.RateStep * (now - self.last)
+                    self.next = max(self.next, now) + bytes / self.rate
+            self.last = now
+
+    def backOff(self, now=None):
+        """Called (with the lock held) when the server throttles us"""
+        if now is None:
+            now = time.time()
+        self.throttled += 1
+        self.pause = min(max(self.pause * 2, 1.0), Throttle.MaxPause)
+        if self.windowBytes >= Throttle.MinWindowBytes:
+            rate = self.windowBytes / max(now - self.windowStart, 0.001)
+            if self.rate is not None:
+                rate = min(rate, self.rate)
+            self.rate = max(rate / 2, Throttle.MinRate)
+        self.next = max(self.next, now + self.pause)
+        logger.warn("Throttled by the server. Pausing %.1fs between commands%s" %
+                    (self.pause, ", up to %d KB/s" % (self.rate / 1024) if self.rate else ""))
+
+    def __str__(self):
+        return "Throttled %d time(s) in %d command(s), %.2fs per command on average" % \
+                (self.throttled, self.commands, self.latency or 0)
+
+class DeflateFile(object):
+    """
+    Once COMPRESS=DEFLATE is on, replaces the file imaplib reads the server's
+    responses from, and inflates what comes from the SSL socket.
+    """
+    def __init__(self, sslobj, wire=''):
+        """wire is the compressed data already read from sslobj"""
+        self.sslobj = sslobj
+        self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buf = ''
+        if len(wire):
+            self.inflate(wire)
+
+    def fill(self):
+        data = self.sslobj.read(65536)
+        if not len(data):
+            return False
+        self.inflate(data)
+        return True
+
+    def inflate(self, data):
+        plain = self.inflater.decompress(data)
+        with ImapServer.StatsLock:
+            ImapServer.WireBytes += len(data)
+            ImapServer.PlainBytes += len(plain)
+        self.buf += plain
+
+    def read(self, size):
+        while len(self.buf) < size and self.fill():
+            pass
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def readline(self, limit=-1):
+        while True:
+            end = self.buf.find('\n') + 1
+            if end > 0 or (limit >= 0 and len(self.buf) >= limit) or not self.fill():
+                break
+        if end <= 0:
+            end = len(self.buf)
+        if limit >= 0:
+            end = min(end, limit)
+        line, self.buf = self.buf[:end], self.buf[end:]
+        return line
+
+    def close(self):
+        self.buf = ''
+
+
 class ImapServer(imaplib.IMAP4_SSL):
-    def __init__(self, serverAddr, serverPort, email, pwd):
+    # The UID commands that can be sent again after reconnecting (see retry)
+    RetryCommands = ('FETCH', 'SEARCH', 'STORE')
+
+    # For all the connections (see reconnect)
+    Reconnects = 0
+    LostTime = 0.0
+
+    # Bytes sent and received over compressed connections, on the wire and
+    # uncompressed. See deflate()
+    WireBytes = 0
+    PlainBytes = 0
+    StatsLock = threading.Lock()
+
+    # Shared by all the connections, since the server limits the account
+    Pacer = Throttle()
+
+    # How many commands fetchBatches() sends ahead with --engine pipelined.
+    # Only UID FETCH is pipelined. imaplib keeps the untagged FETCH responses
+    # of all the commands in flight in the same untagged_responses['FETCH']
+    # list, and the server is free to interleave them (RFC 3501 section 5.5),
+    # so fetchBatches() hands each response to its batch by its UID.
+    PipelineDepth = 8
+
+    # The longest sequence set sent with a single UID STORE (see storeFlags),
+    # or UID FETCH of X-GM-MSGID (see mapMsgIds)
+    MaxSeqSetLen = 8000
+
+    def __init__(self, serverAddr, serverPort, email, pwd, deflate=True):
+        """deflate is False to keep the connections uncompressed (see deflate())"""
         if pwd is None:
             pwd = getpass.getpass()
 
-        logger.info('Connecting to %s ...', options.server)
-        imaplib.IMAP4_SSL.__init__(self, serverAddr, serverPort)
+        # See saveMsgs()
+        self.literalSink = None
 
-        logger.info('Logging in as %s ...', email)
-        self.login(email, pwd)
+        # Bytes received on this connection. See _simple_command()
+        self.received = 0
+
+        # See clone()
+        self.connectArgs = (serverAddr, serverPort, email, pwd, deflate)
+
+        # (name, readonly, UIDVALIDITY) of the selected folder. See reconnect()
+        self.selected = None
+
+        self.connect()
 
         # Discover special folders by looking at flags (names changes with country):
         self.AllMailFolder = '[Gmail]/All Mail'
         self.IgnoredFolders = list(IgnoredFolders)
 
+        # Key = special folder flag (see SpecialFolderFlags), value = folder name
+        self.SpecialFolders = {'\\Inbox': 'INBOX'}
+
+        # Key = folder name, value = XLIST flags. See folderFlags()
+        self.xlistFlags = {}
+
+        # Cached result of getFolders()
+        self.folderNames = None
+
+        # Key = folder name, value = STATUS of the folder. See prescan()
+        self.folderStatus = None
+
         typ, data = self.xlist("", "*")
         for row in data:
             flags, delimiter, imap_folder = ImapServer.parseListResponse(row)
+            self.xlistFlags[ImapServer.normalize(imap_folder)] = flags
             flags = set(flags.split())
             if "\\Noselect" not in flags:
                 if "\\AllMail" in flags and "\\Noselect" not in flags:
@@ -149,6 +1495,174 @@ class ImapServer(imaplib.IMAP4_SSL):
                 elif IgnoredFolderFlags.intersection(flags):
                     self.IgnoredFolders.append(imap_folder)
 
+                for flag in flags.intersection(SpecialFolderFlags):
+                    if flag != '\\Inbox':
+                        self.SpecialFolders[flag] = imap_folder
+
+        # X-GM-LABELS calls it \Draft
+        if self.SpecialFolders.has_key('\\Drafts'):
+            self.SpecialFolders['\\Draft'] = self.SpecialFolders['\\Drafts']
+
+
+    def connect(self):
+        serverAddr, serverPort, email, pwd, deflate = self.connectArgs
+        logger.info('Connecting to %s ...', serverAddr)
+        # A new connection starts uncompressed. See deflate()
+        self.deflater = None
+        imaplib.IMAP4_SSL.__init__(self, serverAddr, serverPort)
+
+        logger.info('Logging in as %s ...', email)
+        self.login(email, pwd)
+
+        # The server can advertise more capabilities once we're logged in
+        typ, data = self.capability()
+        self.capabilities = tuple(data[-1].upper().split())
+
+        # See EmailFolder.fetchChanges()
+        self.condstore = self.qresync = False
+        extensions = [e for e in ('CONDSTORE', 'QRESYNC') if e in self.capabilities]
+        if 'ENABLE' in self.capabilities and len(extensions):
+            typ, data = self._simple_command('ENABLE', *extensions)
+            typ, data = self._untagged_response(typ, data, 'ENABLED')
+            enabled = ' '.join([d for d in data if d is not None]).upper().split()
+            self.qresync = 'QRESYNC' in enabled
+            # QRESYNC implies CONDSTORE
+            self.condstore = self.qresync or 'CONDSTORE' in enabled
+
+        if 'COMPRESS=DEFLATE' in self.capabilities and deflate:
+            self.deflate()
+
+
+    def deflate(self):
+        """
+        Turns on COMPRESS=DEFLATE (RFC 4978): from now on, everything sent
+        and received on this connection is compressed.
+        """
+        typ, data = self._simple_command('COMPRESS', 'DEFLATE')
+        if typ != 'OK':
+            logger.warn("Could not turn on compression: %s" % data)
+            return
+        self.deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        # The server can start compressing right after its OK, so what the
+        # plain file read ahead of it is already compressed
+        wire = self.file._rbuf.getvalue() if hasattr(self.file, '_rbuf') else ''
+        self.file.close()
+        self.file = DeflateFile(self.sslobj, wire)
+        logger.debug("Compression on")
+
+
+    def send(self, data):
+        if self.deflater is not None:
+            plain = len(data)
+            data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+            with ImapServer.StatsLock:
+                ImapServer.WireBytes += len(data)
+                ImapServer.PlainBytes += plain
+        imaplib.IMAP4_SSL.send(self, data)
+
+
+    def reconnect(self):
+        """
+        Opens a new connection to replace a dropped one, and selects the
+        folder that was selected again. Raises an error if its UIDVALIDITY
+        changed in the meantime, since its UIDs can't be used anymore.
+        """
+        try:
+            self.shutdown()
+        except:
+            pass
+        self.connect()
+        with ImapServer.StatsLock:
+            ImapServer.Reconnects += 1
+
+        if self.selected is not None:
+            name, readonly, uidValidity = self.selected
+            result, data = imaplib.IMAP4_SSL.select(self, name, readonly)
+            if result != 'OK':
+                raise self.abort("Could not select %s again" % name)
+            if self.untagged_responses.get('UIDVALIDITY', [None])[-1] != uidValidity:
+                raise self.error("The UIDVALIDITY of %s changed while reconnecting" % name)
+        logger.info("Reconnected")
+
+
+    def retry(self, method, *args):
+        """
+        Returns method(self, *args). If the connection drops, it reconnects
+        and calls the method again, up to options.reconnects times. It waits
+        before each attempt, twice as long as before each time (up to a
+        minute).
+        """
+        attempt = 0
+        delay = 1
+        lost = None
+        while True:
+            try:
+                result = method(self, *args)
+                if lost is not None:
+                    with ImapServer.StatsLock:
+                        ImapServer.LostTime += time.time() - lost
+                return result
+            except (socket.error, self.abort), e:
+                if lost is None:
+                    lost = time.time()
+                if Throttle.Pattern.search(str(e)):
+                    with ImapServer.Pacer.lock:
+                        ImapServer.Pacer.backOff()
+                attempt += 1
+                if attempt > options.reconnects:
+                    raise
+                logger.warn("Connection lost (%s). Reconnecting in %d second(s) (%d/%d)" %
+                            (e, delay, attempt, options.reconnects))
+                time.sleep(delay)
+                delay = min(delay * 2, 60)
+                try:
+                    self.reconnect()
+                except (socket.error, self.abort), e:
+                    logger.warn("Could not reconnect: %s" % e)
+
+
+    def uid(self, command, *args):
+        if command.upper() in ImapServer.RetryCommands:
+            return self.retry(imaplib.IMAP4_SSL.uid, command, *args)
+        return imaplib.IMAP4_SSL.uid(self, command, *args)
+
+
+    def select(self, mailbox='INBOX', readonly=False):
+        result, data = self.retry(imaplib.IMAP4_SSL.select, mailbox, readonly)
+        if result == 'OK':
+            # imaplib leaves it for the caller (see EmailFolder.parseSelectRsp)
+            self.selected = (mailbox, readonly, self.untagged_responses.get('UIDVALIDITY', [None])[-1])
+        return (result, data)
+
+
+    def close(self):
+        self.selected = None
+        return imaplib.IMAP4_SSL.close(self)
+
+
+    def clone(self):
+        """Opens and authenticates another connection to the same server"""
+        return self.__class__(*self.connectArgs)
+
+
+    def _simple_command(self, name, *args):
+        """
+        Every command goes through here. It is paced by ImapServer.Pacer, and
+        sent again if the server throttles it.
+        """
+        # imaplib forgets the APPEND literal once it's sent
+        literal = self.literal
+        for attempt in range(Throttle.Retries + 1):
+            ImapServer.Pacer.wait()
+            start, received = time.time(), self.received
+            self.literal = literal
+            typ, data = imaplib.IMAP4_SSL._simple_command(self, name, *args)
+            throttled = typ == 'NO' and Throttle.Pattern.search(' '.join([str(d) for d in data])) is not None
+            ImapServer.Pacer.done(time.time() - start, self.received - received, throttled)
+            if not throttled:
+                break
+        return (typ, data)
+
 
     def xlist(self, directory, pattern):
         """
@@ -162,16 +1676,137 @@ class ImapServer(imaplib.IMAP4_SSL):
         return self._untagged_response(typ, data, name)
 
 
+    def read(self, size):
+        """
+        imaplib reads every literal with read(). If self.literalSink (see
+        saveMsgs) returns a writer for it, the literal is streamed to that
+        writer as it comes from the server, and an empty literal is returned
+        instead, so message bodies are never held in memory whole.
+        """
+        self.received += size
+        writer = None
+        if self.literalSink is not None and self.mo is not None:
+            # imaplib just matched the literal's envelope
+            writer = self.literalSink(self.mo.string, size)
+        if writer is None:
+            return imaplib.IMAP4_SSL.read(self, size)
+
+        with writer:
+            while size > 0:
+                chunk = imaplib.IMAP4_SSL.read(self, min(size, 65536))
+                if not len(chunk):
+                    raise self.abort("Connection closed in the middle of a message")
+                writer.write(chunk)
+                size -= len(chunk)
+        return ''
+
+
+    def readline(self):
+        line = imaplib.IMAP4_SSL.readline(self)
+        self.received += len(line)
+        return line
+
+
     def getFolders(self):
         """Retruns a list of selectable folders on this server"""
-        typ, data = self.list(pattern='*')
-        folders = []
-        for row in data:
-            flags, delimiter, imap_folder = ImapServer.parseListResponse(row)
-            flags = flags.split()
-            if "\\Noselect" not in flags:
-                folders.append(imap_folder)
-        return folders
+        if self.folderNames is None:
+            typ, data = self.list(pattern='*')
+            self.folderNames = []
+            for row in data:
+                flags, delimiter, imap_folder = ImapServer.parseListResponse(row)
+                flags = flags.split()
+                if "\\Noselect" not in flags:
+                    self.folderNames.append(imap_folder)
+        return list(self.folderNames)
+
+
+    def create(self, mailbox):
+        self.folderNames = None
+        return imaplib.IMAP4_SSL.create(self, mailbox)
+
+
+    @staticmethod
+    def normalize(folderName):
+        """INBOX is case-insensitive (GMail's XLIST calls it "Inbox")"""
+        if folderName.upper() == 'INBOX':
+            return 'INBOX'
+        return folderName
+
+
+    def folderFlags(self, folderName):
+        """
+        Returns the XLIST flags of folderName. The XLIST done when logging in
+        is used if the folder existed back then.
+        """
+        name = ImapServer.normalize(folderName)
+        if not self.xlistFlags.has_key(name):
+            result, data = self.xlist("", folderName)
+            if result != 'OK' or data[0] is None:
+                return None
+            self.xlistFlags[name] = ImapServer.parseListResponse(data[0])[0]
+        return self.xlistFlags[name]
+
+
+    def prescan(self, folderNames):
+        """
+        Retrieves the STATUS of all the folders in folderNames, using a single
+        LIST-STATUS command if the server supports it. See isUnchanged().
+        """
+        items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+        if self.condstore:
+            items.append('HIGHESTMODSEQ')
+        items = '(%s)' % ' '.join(items)
+
+        if 'LIST-STATUS' in self.capabilities:
+            typ, data = self._simple_command('LIST', '""', '*', 'RETURN', '(STATUS %s)' % items)
+            self.response('LIST')
+            rsp = self.response('STATUS')[1]
+        else:
+            rsp = []
+            for folderName in folderNames:
+                typ, data = self.status(folderName, items)
+                if typ == 'OK':
+                    rsp.extend(data)
+
+        self.folderStatus = {}
+        for row in [r for r in rsp if type(r) == StringType]:
+            match = stsRspMatch.match(row)
+            if match is None:
+                continue
+            values = match.group('items').split()
+            self.folderStatus[match.group('name').strip('"')] = dict(
+                    [(key.upper(), long(val)) for key, val in zip(values[0::2], values[1::2])])
+
+        logger.debug(pprint.pformat(self.folderStatus))
+
+
+    def isUnchanged(self, oldFld):
+        """
+        Returns True if the STATUS from prescan() shows that nothing changed in
+        the folder since oldFld was fully indexed. Such folders don't need to
+        be selected or indexed again.
+        """
+        if oldFld is None or self.folderStatus is None:
+            return False
+
+        # The UIDs left out of msgs as duplicates don't make it partial
+        current = self.folderStatus.get(oldFld.name)
+        if current is None or len(oldFld.msgs) + len(oldFld.dupUIDs) != len(oldFld.UIDs):
+            return False
+
+        # UIDs only go up, so if a message is added UIDNEXT changes, and if
+        # one is removed (and none added) MESSAGES changes.
+        if current.get('UIDVALIDITY') != oldFld['UIDVALIDITY'] or \
+                current.get('UIDNEXT') != oldFld['UIDNEXT'] or \
+                current.get('MESSAGES') != len(oldFld.UIDs):
+            return False
+
+        # Flag changes matter only for All Mail (see EmailFolder.fetchChanges)
+        if oldFld.name == self.AllMailFolder and current.has_key('HIGHESTMODSEQ') and \
+                current['HIGHESTMODSEQ'] != oldFld.get('HIGHESTMODSEQ'):
+            return False
+
+        return True
 
 
     @staticmethod
@@ -188,26 +1823,261 @@ class ImapServer(imaplib.IMAP4_SSL):
 
         Returns the new UID assigned to the uploaded message, or None if it fails.
         """
-        sha = msg['sha1']
-        fullPath = os.path.join(backupDir, sha[0:2], sha)
-        if not os.path.isfile(fullPath):
-            logger.warn("Missing %s - can not upload %s" % (sha, fullPath))
-            return None
-        f = open(fullPath, "rb")
-        flags = msg['flags']
-        date = imaplib.Internaldate2tuple("INTERNALDATE \"" + msg['internaldate'] + "\"")
-        result, data = self.append(destFolder, flags, date, f.read())
-        f.close()
+        newUid = self.uploadMsgs(backupDir, [msg], destFolder).get(msg['sha1'])
+        if newUid is not None:
+            msg['uid'] = newUid
+        return newUid
 
-        # full data is: ('OK', ['[APPENDUID 1 11920] (Success)'])
-        # data[0] format is: [APPENDUID UIDVALIDITY UID]
-        match = re.search(r'APPENDUID (\d+) (\d+)', data[0])
-        if result == 'OK' and match:
-            msg['uid'] = match.group(2)
-            return msg['uid']
-        else:
-            logger.warn("Unable to upload message %s to %s", fullPath, destFolder)
-            return None
+
+    def uploadMsgs(self, backupDir, msgs, destFolder, done=None):
+        """
+        Uploads msgs (EmailMsg objects) to destFolder. If the server supports
+        MULTIAPPEND (RFC 3502), up to options.appendBatch messages (and
+        options.appendSize KB) are sent with each APPEND command, otherwise
+        (or if that fails) one message per APPEND. The message files are
+        streamed from disk (see appendFiles), and only the files of the
+        messages being sent are open.
+
+        @param done Optional function called with a list of (msg, newUid) as
+            soon as the messages of each APPEND command are uploaded.
+
+        Returns a dict that maps the SHA1 of the messages uploaded => their
+        new UID, or None if the server didn't say (see APPENDUID in RFC 4315).
+        """
+        store = msgStore(backupDir)
+        todo = []
+        for msg in msgs:
+            if store.exists(msg['sha1']):
+                todo.append(msg)
+            else:
+                logger.warn("Missing %s - can not upload %s" % (msg['sha1'], store.path(msg['sha1'])))
+
+        def append(group):
+            """Sends a single APPEND for group, a list of (msg, file, size)"""
+            msgs = [msg for msg, f, size in group]
+            files = [(msg['flags'], msg['internaldate'], f, size) for msg, f, size in group]
+            # If the connection drops before the server answers, the
+            # messages are sent again, and could end up there twice.
+            result, data = self.retry(ImapServer.appendFiles, destFolder, files)
+
+            # full data is: ('OK', ['[APPENDUID 1 11920:11921] (Success)'])
+            match = re.search(r'APPENDUID (\d+) ([\d:,]+)', data[0] or '')
+            if result != 'OK':
+                return None
+            newUids = expandUidSet(match.group(2)) if match else []
+            if len(newUids) != len(msgs):
+                newUids = [None] * len(msgs)
+            for msg, newUid in zip(msgs, newUids):
+                uploaded[msg['sha1']] = newUid
+            if done is not None:
+                done(zip(msgs, newUids))
+            return newUids
+
+        def appendAll(msgs, maxCount):
+            """Appends msgs maxCount at a time. Returns the ones that could not be uploaded."""
+            opened = ((msg,) + store.open(msg['sha1']) for msg in msgs)
+            failed = []
+            for group in groupBySize(opened, lambda item: item[2], maxCount, options.appendSize * 1024):
+                try:
+                    if append(group) is None:
+                        failed.extend([msg for msg, f, size in group])
+                finally:
+                    for msg, f, size in group:
+                        f.close()
+            return failed
+
+        uploaded = {}
+        failed = todo
+        if len(todo) > 1 and 'MULTIAPPEND' in self.capabilities and options.appendBatch > 1:
+            failed = appendAll(todo, options.appendBatch)
+            if len(failed):
+                logger.warn("Failed to upload %d message(s) several at a time to %s. Uploading them one at a time." %
+                            (len(failed), destFolder))
+
+        for msg in appendAll(failed, 1):
+            logger.warn("Unable to upload message %s to %s", msg['sha1'], destFolder)
+
+        return uploaded
+
+
+    def appendFiles(self, mailbox, msgs):
+        """
+        Sends a single APPEND command for msgs, a list of (flags, internaldate,
+        file, size). More than one message needs MULTIAPPEND. Unlike imaplib's
+        append(), each message is sent as it's read from its file.
+
+        Returns (result, data) of the command. It's sent again if the server
+        throttles it (see Throttle).
+        """
+        for attempt in range(Throttle.Retries + 1):
+            for flags, date, f, size in msgs:
+                f.seek(0)
+            ImapServer.Pacer.wait()
+            start, received = time.time(), self.received
+            result, data = self.appendOnce(mailbox, msgs)
+            throttled = result == 'NO' and Throttle.Pattern.search(' '.join([str(d) for d in data])) is not None
+            ImapServer.Pacer.done(time.time() - start, self.received - received, throttled)
+            if not throttled:
+                break
+        return (result, data)
+
+
+    def appendOnce(self, mailbox, msgs):
+        """
+        Sends the APPEND command of appendFiles() once. Like imaplib's
+        _command(), it's only sent in the states APPEND is allowed in, and the
+        untagged OK, NO and BAD responses of the previous commands are
+        forgotten first.
+        """
+        if self.state not in imaplib.Commands['APPEND']:
+            raise self.error("command APPEND illegal in state %s, only allowed in states %s" %
+                             (self.state, ', '.join(imaplib.Commands['APPEND'])))
+        for typ in ('OK', 'NO', 'BAD'):
+            self.untagged_responses.pop(typ, None)
+
+        tag = self._new_tag()
+        line = '%s APPEND %s' % (tag, self._checkquote(mailbox))
+        try:
+            for flags, date, f, size in msgs:
+                self.send('%s (%s) "%s" {%d}%s' % (line, flags, date, size, imaplib.CRLF))
+                line = ''
+                # Wait for the server to ask for the message
+                while self._get_response():
+                    if self.tagged_commands[tag]:
+                        return self._command_complete('APPEND', tag)
+
+                while True:
+                    chunk = f.read(65536)
+                    if not len(chunk):
+                        break
+                    self.send(chunk)
+            self.send(imaplib.CRLF)
+        except socket.error, e:
+            raise self.abort('socket error: %s' % e)
+
+        try:
+            return self._command_complete('APPEND', tag)
+        finally:
+            # Also in the tagged response (see uploadMsgs). Otherwise they
+            # would pile up, one for every APPEND of the restore
+            self.untagged_responses.pop('APPENDUID', None)
+
+
+    def copyMsgs(self, uids, destFolder):
+        """
+        Copies the messages with the given UIDs from the selected folder to
+        destFolder with a single UID COPY. If it fails, each half is copied by
+        itself, and so on, to find the messages that can't be copied without a
+        round trip to the server for every message.
+
+        Returns (copied, failed, uidValidity) where copied maps the UID of each
+        message copied to its UID in destFolder (None if the server didn't say,
+        see COPYUID in RFC 4315), failed is the list of UIDs that could not be
+        copied, and uidValidity is the UIDVALIDITY of destFolder given with
+        the new UIDs (None if the server didn't say).
+        """
+        copied = {}
+        failed = []
+        uidValidity = None
+
+        batches = [[str(uid) for uid in uids]] if len(uids) else []
+        while len(batches):
+            batch = batches.pop()
+            result, data = self.uid('COPY', compressUidSet(batch), destFolder)
+            result, data = self._untagged_response(result, data, 'COPYUID')
+            if result == 'OK':
+                if data[-1] is not None and len(data[-1].split()) == 3:
+                    # "UIDVALIDITY source-UIDs destination-UIDs"
+                    uidValidity, srcSet, dstSet = data[-1].split()
+                    newUids = dict(zip(expandUidSet(srcSet), expandUidSet(dstSet)))
+                    for uid in batch:
+                        if newUids.has_key(uid):
+                            copied[uid] = newUids[uid]
+                        else:
+                            # UID COPY skips the UIDs that don't exist
+                            failed.append(uid)
+                else:
+                    for uid in batch:
+                        copied[uid] = None
+            elif len(batch) == 1:
+                failed.extend(batch)
+            else:
+                # The first half is copied first
+                batches.append(batch[len(batch) / 2:])
+                batches.append(batch[:len(batch) / 2])
+
+        return (copied, failed, uidValidity)
+
+
+    def fetchFlags(self, uids, batchSz=None):
+        """
+        Returns a dict that maps UID => FLAGS of the messages in uids, queried
+        batchSz at a time (all at once if None). The messages that are not in
+        the selected folder anymore are left out.
+        """
+        batchSz = batchSz or max(len(uids), 1)
+        batches = [uids[start:start + batchSz] for start in range(0, len(uids), batchSz)]
+        flags = {}
+        for batch, result, data in self.fetchBatches(batches, '(UID FLAGS)', self.pipelineDepth()):
+            if result != 'OK':
+                logger.warn("Failed to retrieve the flags of %d message(s)" % len(batch))
+                continue
+            for row in [r for r in data if type(r) == StringType]:
+                uid = uIdMatch.search(row)
+                msgFlags = flagsMatch.search(row)
+                if uid is not None and msgFlags is not None:
+                    flags[uid.group(1)] = msgFlags.group(1)
+        return flags
+
+
+    def storeFlags(self, uidFlags):
+        """
+        Sets the FLAGS of the messages in the selected folder. uidFlags maps
+        UID => flags. The messages that get the same flags are all set with a
+        single UID STORE, split only if its sequence set gets too long (see
+        MaxSeqSetLen).
+
+        Returns (commands, failed) where commands is the number of UID STORE
+        commands sent, and failed is the list of UIDs whose flags could not be
+        set.
+        """
+        # Key = flags, value = the UIDs that get them
+        groups = {}
+        for uid, flags in uidFlags.items():
+            groups.setdefault(flags, []).append(uid)
+
+        commands = 0
+        failed = []
+        for flags, uids in groups.items():
+            for uidSet in ImapServer.splitUidSet(uids, ImapServer.MaxSeqSetLen):
+                result, data = self.uid('STORE', str(uidSet), 'FLAGS.SILENT', '(%s)' % flags)
+                commands += 1
+                if result != 'OK':
+                    logger.warn("Could not set the flags (%s) of %d message(s)" % (flags, len(uidSet)))
+                    failed.extend(uidSet)
+        return (commands, failed)
+
+
+    @staticmethod
+    def splitUidSet(uids, maxLen):
+        """
+        Splits uids into UidSets whose sequence set (ex: "1:4,7,9:12") is at
+        most maxLen characters long (unless a single range is longer).
+        """
+        sets = []
+        pairs = []
+        length = 0
+        for lo, hi in UidSet(uids).pairs():
+            seqLen = len(str(lo) if lo == hi else '%d:%d' % (lo, hi)) + 1
+            if len(pairs) and length + seqLen > maxLen:
+                sets.append(UidSet.fromPairs(pairs))
+                pairs = []
+                length = 0
+            pairs.append((lo, hi))
+            length += seqLen
+        if len(pairs):
+            sets.append(UidSet.fromPairs(pairs))
+        return sets
 
 
     def saveMsg(self, uid, shaHex, backupDir, folderName=None):
@@ -225,11 +2095,7 @@ class ImapServer(imaplib.IMAP4_SSL):
         if backupDir is None or not os.path.exists(backupDir):
             return False
 
-        dir = os.path.join(backupDir, shaHex[0:2])
-        if not os.path.exists(dir):
-            os.makedirs(dir)
-
-        fullPath = os.path.join(dir, shaHex)
+        store = msgStore(backupDir)
 
         if folderName is not None:
             result, data = self.select(folderName, readonly=True)
@@ -237,15 +2103,17 @@ class ImapServer(imaplib.IMAP4_SSL):
                 logger.error("Failed to select folder: " + folderName)
                 return False
 
-        if not os.path.exists(fullPath):
-            # "with" not available until 2.6
-            with open(fullPath, "wb") as msgFile:
+        if not store.exists(shaHex):
+            self.literalSink = lambda envelope, size: store.create(shaHex, size=size)
+            try:
                 result, msgBody = self.uid('FETCH', uid, "RFC822")
-                if result == 'OK':
-                    msgFile.write(msgBody[0][1])
-                    return True
-                else:
-                    logger.error("Failed to retrieve UID %d from server" % (uid))
+            finally:
+                self.literalSink = None
+            if result == 'OK' and store.exists(shaHex):
+                store.sync()
+                return True
+            else:
+                logger.error("Failed to retrieve UID %s from server" % (uid))
         else:
             # This could be because the previous backup did not finish
             # (message was D/L'ed but folder indexing did not complete, so we
@@ -256,22 +2124,395 @@ class ImapServer(imaplib.IMAP4_SSL):
         return False
 
 
-    def saveAllMsgs(self, backupDir, oldMsgs, oldFlds):
+    def pipelineDepth(self):
+        """How many commands fetchBatches() can send ahead (see --engine)"""
+        return ImapServer.PipelineDepth if options.engine == 'pipelined' else 1
+
+
+    def fetchBatches(self, batches, items, depth=1):
+        """
+        Generator that does a UID FETCH of items for each list of UIDs in
+        batches, and yields (batch, result, data) in the same order.
+
+        With depth > 1, up to depth commands are sent before waiting for the
+        response to the first one (pipelining, see RFC 3501 section 5.5), so
+        the server is never idle waiting for the next command. The responses
+        read with those of an earlier command are set aside for their own
+        batch (see PipelineDepth). Nothing else can be sent on this connection
+        until the generator is done. If the connection drops, the remaining
+        batches are fetched one command at a time (see retry). A batch that
+        gets a BAD is yielded like a NO.
         """
-        Saves all new messages to the backupDir.
+        def fetch(batch):
+            try:
+                return self.uid('FETCH', compressUidSet(batch), items)
+            except self.abort:
+                raise
+            except self.error, e:
+                return ('BAD', [str(e)])
+
+        if depth <= 1:
+            for batch in batches:
+                result, data = fetch(batch)
+                yield (batch, result, data)
+            return
+
+        # (index in batches, tag, when it was sent) of the commands in flight
+        pending = deque()
+        # Key = index in batches, value = (result, data) not yielded yet
+        results = {}
+        attempts = {}
+        sent = done = 0
+        # Key = UID, value = index in batches of the command in flight for it
+        owners = {}
+        # Key = index in batches, value = its FETCH responses read early
+        early = {}
+
+        def send(i):
+            ImapServer.Pacer.wait()
+            tag = self._command('UID', 'FETCH', compressUidSet(batches[i]), items)
+            pending.append((i, tag, time.time()))
+            for uid in batches[i]:
+                owners[str(uid)] = i
+
+        def sort(i, data):
+            """Returns the FETCH responses in data (and read early) for batches[i]"""
+            mine = early.pop(i, [])
+            for uid, response in ImapServer.splitFetch(data):
+                j = owners.get(uid, i)
+                if j == i:
+                    mine.extend(response)
+                else:
+                    early.setdefault(j, []).extend(response)
+            return mine or [None]
+
+        try:
+            while done < len(batches):
+                while sent < len(batches) and len(pending) < depth:
+                    send(sent)
+                    sent += 1
+
+                i, tag, start = pending.popleft()
+                received = self.received
+                try:
+                    result, data = self._command_complete('UID', tag)
+                except self.abort:
+                    raise
+                except self.error, e:
+                    # Only this batch failed. The next responses are still
+                    # good.
+                    result, data = ('BAD', [str(e)])
+                result, data = self._untagged_response(result, data, 'FETCH')
+                data = sort(i, data)
+                throttled = result == 'NO' and Throttle.Pattern.search(' '.join([str(d) for d in data])) is not None
+                ImapServer.Pacer.done(time.time() - start, self.received - received, throttled)
+                if throttled and attempts.get(i, 0) < Throttle.Retries:
+                    attempts[i] = attempts.get(i, 0) + 1
+                    send(i)
+                    continue
+
+                results[i] = (result, data)
+                for uid in batches[i]:
+                    if owners.get(str(uid)) == i:
+                        del owners[str(uid)]
+                while results.has_key(done):
+                    result, data = results.pop(done)
+                    yield (batches[done], result, data)
+                    done += 1
+        except (socket.error, self.abort), e:
+            logger.warn("Connection lost with %d command(s) in flight (%s)" % (len(pending), e))
+            pending.clear()
+            for i in range(done, len(batches)):
+                result, data = results.pop(i, None) or fetch(batches[i])
+                yield (batches[i], result, data)
+        finally:
+            # The caller stopped early. Nothing else can be sent until the
+            # responses to the commands in flight are read.
+            for i, tag, start in pending:
+                try:
+                    self._command_complete('UID', tag)
+                    self._untagged_response('OK', [None], 'FETCH')
+                except:
+                    break
+
+
+    @staticmethod
+    def splitFetch(data):
+        """
+        Yields (UID, items) for each FETCH response in data, as imaplib returns
+        them: a response is a tuple for each of its literals, followed by the
+        rest of it. The UID is None if the response doesn't have one.
+        """
+        responses = []
+        for item in data:
+            if item is None:
+                continue
+            if not len(responses) or not isinstance(responses[-1][-1], tuple):
+                responses.append([])
+            responses[-1].append(item)
+        for response in responses:
+            match = uIdMatch.search(' '.join([i[0] if isinstance(i, tuple) else i for i in response]))
+            yield (match.group(1) if match else None, response)
+
+
+    def fetchSizes(self, uids, withDates=False, batchSz=None):
+        """
+        Returns a dict that maps UID => RFC822.SIZE of the messages in uids,
+        or UID => (RFC822.SIZE, INTERNALDATE in seconds) if withDates is True.
+        The messages are queried batchSz at a time (all at once if None).
+        """
+        items = '(RFC822.SIZE INTERNALDATE)' if withDates else '(RFC822.SIZE)'
+        batchSz = batchSz or max(len(uids), 1)
+        batches = [uids[start:start + batchSz] for start in range(0, len(uids), batchSz)]
+        sizes = {}
+        for batch, result, data in self.fetchBatches(batches, items, self.pipelineDepth()):
+            if result != 'OK':
+                continue
+            for row in [r for r in data if type(r) == StringType]:
+                uid = uIdMatch.search(row)
+                size = sizeMatch.search(row)
+                if uid is None or size is None:
+                    continue
+                if withDates:
+                    date = imaplib.Internaldate2tuple(row)
+                    sizes[uid.group(1)] = (int(size.group(1)), time.mktime(date) if date else 0)
+                else:
+                    sizes[uid.group(1)] = int(size.group(1))
+        return sizes
+
+
+    def schedule(self, uids, order, budget=None):
+        """
+        Returns the uids (of messages to download) sorted by order: uid (as
+        is), newest (most recent INTERNALDATE first), smallest (smallest
+        RFC822.SIZE first), or balanced (alternating between the newest and
+        the smallest).
+
+        If a budget is given, it's told the size of each message (see
+        Budget.spend). With the uid order, the sizes come with the headers
+        instead (see saveAllMsgs).
+        """
+        if order == 'uid':
+            return uids
+
+        info = self.fetchSizes(uids, True, options.batchSize)
+        if budget is not None:
+            budget.sizes.update([(uid, size) for uid, (size, date) in info.items()])
+
+        # Messages the server did not report on go last
+        newest = sorted(uids, key=lambda uid: -info.get(uid, (0, 0))[1])
+        smallest = sorted(uids, key=lambda uid: info.get(uid, (sys.maxint, 0))[0])
+        if order == 'newest':
+            return newest
+        elif order == 'smallest':
+            return smallest
+
+        scheduled = []
+        taken = set()
+        for pair in zip(newest, smallest):
+            for uid in pair:
+                if uid not in taken:
+                    taken.add(uid)
+                    scheduled.append(uid)
+        return scheduled
+
+
+    def saveLargeMsg(self, uid, shaHex, size, backupDir):
+        """
+        Saves a large message in chunks (BODY.PEEK[]<offset.length>). The
+        chunks are appended to a .part file, so if the download is interrupted,
+        the next backup resumes it from where it stopped. The SHA1 of the body
+        is computed as the chunks arrive, and if the store doesn't compress
+        messages, the .part file becomes the message file as it is. The folder
+        to save from should be selected before calling this method.
+
+        @param size The RFC822.SIZE of the message
+
+        Returns True if the message was saved.
+        """
+        store = msgStore(backupDir)
+        part = store.partPath(shaHex)
+        store.makeDir(os.path.dirname(part))
+        partSize = lambda: os.path.getsize(part) if os.path.exists(part) else 0
+        done = partSize()
+        sha1 = hashlib.sha1()
+        if done > size:
+            os.remove(part)
+            done = 0
+        elif done > 0:
+            logger.info("Resuming UID %s at %d/%d KB" % (uid, done / 1024, size / 1024))
+            for chunk in MsgStore.readChunks(part, 'none'):
+                sha1.update(chunk)
+
+        chunkSize = options.chunkSize * 1024
+        # The size of the chunks received
+        lengths = []
+        def chunkWriter(envelope, length):
+            if 'BODY[]' not in envelope.upper():
+                return None
+            lengths.append(length)
+            return PartWriter(part, sha1)
+
+        def fetchChunk(self):
+            # If the connection drops mid-chunk, the next one starts after
+            # what was received of it
+            return imaplib.IMAP4_SSL.uid(self, 'FETCH', uid, 'BODY.PEEK[]<%d.%d>' % (partSize(), chunkSize))
+
+        self.literalSink = chunkWriter
+        try:
+            while done < size:
+                del lengths[:]
+                result, data = self.retry(fetchChunk)
+                if result != 'OK' or not len(lengths) or partSize() <= done:
+                    logger.error("Failed to retrieve UID %s from server at %d/%d KB" %
+                                 (uid, done / 1024, size / 1024))
+                    return False
+                fsyncPath(part)
+                done = partSize()
+                if lengths[-1] < chunkSize:
+                    # The end of the message
+                    break
+        finally:
+            self.literalSink = None
+
+        if done != size:
+            logger.warn("UID %s: RFC822.SIZE is %d, but got %d bytes" % (uid, size, done))
+        if store.format == 'none':
+            store.adopt(shaHex, part, sha1.hexdigest())
+            if os.path.exists(part):
+                store.removePart(shaHex)
+        else:
+            with open(part, 'rb') as f:
+                with store.create(shaHex, size=done) as msgFile:
+                    shutil.copyfileobj(f, msgFile, 65536)
+            store.removePart(shaHex)
+        store.sync()
+        return True
+
+
+    def saveMsgs(self, uidSha, backupDir, sizes=None):
+        """
+        Saves many mail messages locally using a single UID FETCH command. Each
+        message is streamed to its file as it arrives from the server (see
+        read), and the files are flushed to disk together at the end.
+        The folder to save from should be selected before calling this method.
+        If backupDir does not exist, nothing is saved.
+
+        Messages larger than options.largeMsgSize KB are downloaded in chunks
+        instead (see saveLargeMsg).
+
+        @param uidSha A list of (uid, shaHex) tuples of the messages to save
+        @param backupDir The directory to save them to
+        @param sizes Optional dict that maps UID => RFC822.SIZE (see
+            EmailMsg.fetchAll). The sizes missing from it are asked for.
+
+        Returns (saved, failed) where saved is the number of messages saved,
+        and failed is the list of (uid, shaHex) of the messages that could not
+        be saved.
+        """
+
+        if backupDir is None or not os.path.exists(backupDir) or len(uidSha) == 0:
+            return (0, [])
+
+        store = msgStore(backupDir)
+
+        # Key = UID, value = SHA1 of the messages we still need
+        todo = {}
+        for uid, shaHex in uidSha:
+            if store.exists(shaHex):
+                # See saveMsg()
+                logger.warn("File %s already exists." % (shaHex))
+            else:
+                todo[str(uid)] = shaHex
+
+        # Key = UID, value = (SHA1, RFC822.SIZE) of the large messages
+        large = {}
+        if options.largeMsgSize > 0 and len(todo):
+            sizes = sizes or {}
+            unknown = [uid for uid in todo.keys() if uid not in sizes]
+            fetched = self.fetchSizes(unknown) if len(unknown) else {}
+            for uid in todo.keys():
+                size = sizes.get(uid, fetched.get(uid))
+                if size is not None and size > options.largeMsgSize * 1024:
+                    large[uid] = (todo.pop(uid), size)
+
+        sizes = []
+        def msgWriter(envelope, size):
+            match = uIdMatch.search(envelope)
+            if match is None or not todo.has_key(match.group(1)):
+                return None
+
+            sizes.append(size)
+            return store.create(todo[match.group(1)], size=size)
+
+        def fetchRemaining(self):
+            # If the connection drops, only what's not saved yet is fetched again
+            remaining = [uid for uid, shaHex in todo.items() if not store.exists(shaHex)]
+            if not len(remaining):
+                return ('OK', [])
+            return imaplib.IMAP4_SSL.uid(self, 'FETCH', compressUidSet(remaining), 'RFC822')
+
+        start = time.time()
+        if len(todo):
+            self.literalSink = msgWriter
+            try:
+                result, data = self.retry(fetchRemaining)
+            finally:
+                self.literalSink = None
+                store.sync()
+
+            if result != 'OK':
+                logger.warn("Failed to FETCH %d message(s) in bulk" % len(todo))
+
+        elapsed = max(time.time() - start, 0.001)
+        logger.info("Downloaded %d message(s), %d KB in %.1fs (%.1f KB/s)" %
+                (len(sizes), sum(sizes) / 1024, elapsed, sum(sizes) / 1024.0 / elapsed))
+
+        # Whatever the bulk FETCH did not deliver is retried one at a time
+        saved = len(todo)
+        todo = dict([(uid, shaHex) for uid, shaHex in todo.items() if not store.exists(shaHex)])
+        saved -= len(todo)
+        for uid, shaHex in todo.items():
+            if self.saveMsg(uid, shaHex, backupDir):
+                saved += 1
+
+        for uid, (shaHex, size) in large.items():
+            if self.saveLargeMsg(uid, shaHex, size, backupDir):
+                saved += 1
+
+        return (saved, [(uid, shaHex) for uid, shaHex in uidSha if not store.exists(shaHex)])
+
+
+    def saveAllMsgs(self, backupDir, oldMsgs, oldFlds, checkpoint=None, budget=None):
+        """
+        Saves all new messages to the backupDir, in the order chosen with
+        options.order (see schedule).
 
         @param backupDir The directory to save the messages in
         @param oldMsgs A dictionary of old messages that have been previously
             saved. If there are none, this should be an empty dict.
         @param oldFlds A dictionary of old folders that have been previously
             saved. If there are none, this should be an empty dict.
+        @param checkpoint Optional Checkpoint used to periodically save the
+            messages downloaded so far.
+        @param budget Optional Budget. Once it runs out, the remaining
+            messages are left out of the index, so the next backup downloads
+            them.
         """
 
         messages = {}
 
         folderName = self.AllMailFolder
+        if self.isUnchanged(oldFlds.get(folderName, None)):
+            status("No new messages in %s\n" % folderName)
+            folder = oldFlds[folderName]
+            for sha in folder.msgs.values():
+                messages[sha] = oldMsgs[sha]
+                messages[sha]['folder'] = [ folderName ]
+            return (messages, folder)
+
         logger.info("Downloading messages from %s" % folderName)
-        folder = EmailFolder(self, folderName)
+        folder = EmailFolder(self, folderName, oldFlds.get(folderName, None))
         if not folder.OK:
             # TODO: Error handling
             logger.error("Unable to select folder: %s" % folderName)
@@ -281,17 +2522,35 @@ class ImapServer(imaplib.IMAP4_SSL):
             # Lucky for us. UIDVALIDITY has not changed.
             msgUIDs = folder.carryOver(oldFlds[folderName], messages, oldMsgs, appendFolder=False)
         else:
-            msgUIDs = folder.UIDs
+            msgUIDs = list(folder.UIDs)
 
         msgCnt = len(msgUIDs)
         status("Retained %5d message(s). Need to D/L %5d new message(s).\n" % (len(messages), msgCnt))
+        msgUIDs = self.schedule(msgUIDs, options.order, budget)
         saved = i = 0
+        # The (uid, sha1) of messages waiting to be downloaded with saveMsgs()
+        pending = []
+        # The (uid, dupSha1) of the duplicates
+        dups = []
+        connections = options.connections
+        if options.engine == 'pipelined':
+            # The headers are fetched with pipelined commands, so the bodies
+            # need a connection of their own
+            connections = max(connections, 2)
+        # Key = UID, value = RFC822.SIZE, filled in as the headers arrive
+        sizes = budget.sizes if budget is not None else {}
+        pool = DownloadPool(self, folderName, backupDir, connections, sizes)
+        depth = self.pipelineDepth() if len(pool.workers) else 1
         try:
-            for uid in msgUIDs:
+            for uid, msg in EmailMsg.fetchAll(self, msgUIDs, options.batchSize, depth, sizes):
+                if budget is not None and budget.exhausted():
+                    status("\n", False)
+                    logger.warn("%s. Leaving %d message(s) for the next backup." % (budget, msgCnt - i))
+                    break
+
                 i += 1
-                msg = EmailMsg(self, uid)
                 if not msg.OK:
-                    logger.error("Could not retrieve UID %d from folder %s", uid, folderName)
+                    logger.error("Could not retrieve UID %s from folder %s", uid, folderName)
                     # TODO: Error handling
                     continue
 
@@ -300,51 +2559,124 @@ class ImapServer(imaplib.IMAP4_SSL):
                 if messages.has_key(sha1):
                     old = messages[sha1]
                     dupSha1 = "__%s.%s" % (sha1, uid)
-                    self.saveMsg(uid, dupSha1, backupDir)
+                    pending.append((uid, dupSha1))
+                    dups.append((uid, dupSha1))
+                    if budget is not None:
+                        budget.spend(uid)
                     logger.warn("Duplicate SHA1 found. UID: %s & %s. Saved to SHA1: %s" % (old['uid'], uid, dupSha1))
                     logger.debug("InternalDate: %s -- %s" % (old['internaldate'], msg['internaldate']))
                 else:
                     if not oldMsgs.has_key(sha1):
-                        self.saveMsg(uid, sha1, backupDir)
-                        saved += 1
+                        pending.append((uid, sha1))
+                        if budget is not None:
+                            budget.spend(uid)
                     messages[sha1] = msg
                     folder.msgs[uid] = sha1
 
+                if len(pending) >= options.batchSize:
+                    pool.submit(pending)
+                    pending = []
+
+                if checkpoint is not None and checkpoint.due():
+                    pool.submit(pending)
+                    pending = []
+                    checkpoint.save(messages, folder, pool.unsaved())
+
                 progress('\r%.0f%% %d/%d ' % (i * 100.0 /msgCnt, i, msgCnt))
+
+            pool.submit(pending)
+            pending = []
         except:
             status("\n", False)
-            logger.debug("Saved %d/%d messages (%d candidates)" % (saved, msgCnt, i))
+            logger.debug("Saved %d/%d messages (%d candidates)" % (pool.saved, msgCnt, i))
             logger.exception("Could not save all messages")
 
+        saved, failed = pool.close()
+
+        # Don't index messages that might not have been downloaded. They
+        # will be picked up by the next backup.
+        for uid, sha1 in pending + failed:
+            if folder.msgs.get(uid) == sha1:
+                del folder.msgs[uid]
+                del messages[sha1]
+        notSaved = set(pending + failed)
+        folder.dupUIDs = UidSet([uid for uid, dupSha1 in dups if (uid, dupSha1) not in notSaved])
+
         #if len(messages) < 20:
         #    logger.debug(pprint.pformat(messages))
         status("\nSaved %s new message(s)\n" % (saved))
         return (messages, folder)
 
 
-    def indexAllFolders(self, messages, oldFlds, allMailFld):
+    def indexAllFolders(self, messages, oldFlds, allMailFld, checkpoint=None):
         """
         After doing saveAllMsgs(), this function finds all folders/tags with which a
         message is tagged.
+
+        On GMail, the folders of every message come from a single pass over
+        All Mail (see fetchLabels). That only replaces the header FETCH: a
+        folder's UIDs are its own, so every folder that changed is still
+        selected to list its UIDs, and its new UIDs are looked up by
+        X-GM-MSGID (see mapMsgIds) to build its msgs.
+
+        If a checkpoint is provided, the folders indexed so far are periodically
+        saved with it.
         """
         folderInfo = {allMailFld.name:allMailFld}
         ignoreFolders = [self.AllMailFolder] + self.IgnoredFolders
 
         try:
-            for folderName in [f for f in self.getFolders() if f not in ignoreFolders]:
+            folderNames = [f for f in self.getFolders() if f not in ignoreFolders]
+            unchanged = [f for f in folderNames if self.isUnchanged(oldFlds.get(f, None))]
+            if len(unchanged):
+                logger.info("%d/%d folder(s) have not changed" % (len(unchanged), len(folderNames)))
+
+            # GMail can tell us the labels (folders) of every message from All
+            # Mail, in which case the folders are only indexed to find their
+            # UIDs (and the SHA1 of the new ones, by X-GM-MSGID).
+            labels = msgIds = unlabeled = None
+            if 'X-GM-EXT-1' in self.capabilities and len(unchanged) < len(folderNames):
                 try:
-                    folder = self.indexOneFolder(messages, oldFlds.get(folderName, None), folderName)
+                    labels, msgIds, unlabeled = self.fetchLabels(allMailFld)
                 except:
-                    logger.exception("Could not proerly index folder: %s." % (folderName))
-                    folder = None
-
-                if folder is not None:
-                    folderInfo[folderName] = folder
-                else:
+                    logger.exception("Could not retrieve the message labels. Indexing folder by folder.")
+                    labels = msgIds = unlabeled = None
+
+            indexed = self.indexFolders([f for f in folderNames if f not in unchanged],
+                                        oldFlds, msgIds, checkpoint)
+            for folderName in folderNames:
+                if folderName in unchanged:
+                    folderInfo[folderName] = oldFlds[folderName]
+                elif indexed.get(folderName) is not None:
+                    folderInfo[folderName] = indexed[folderName]
+                elif oldFlds.has_key(folderName):
                     # Keep old folder data, otherwise we'll have to fully re-index next time
-                    if oldFlds.has_key(folderName):
-                        folderInfo[folderName] = oldFlds[folderName]
+                    folderInfo[folderName] = oldFlds[folderName]
+
+            # The folders are added to the messages in the same order however
+            # they were indexed, so the result doesn't depend on which folder
+            # finished first.
+            for folderName in folderNames:
+                if labels is not None:
+                    sha1s = labels.get(folderName, [])
+                    if len(unlabeled) and folderInfo.has_key(folderName):
+                        sha1s = sha1s + [sha1 for sha1 in folderInfo[folderName].msgs.values() if sha1 in unlabeled]
+                elif folderInfo.has_key(folderName):
+                    sha1s = folderInfo[folderName].msgs.values()
+                else:
                     continue
+
+                arrived = 0
+                for sha1 in sha1s:
+                    if not messages.has_key(sha1):
+                        arrived += 1
+                    elif folderName not in messages[sha1]['folder']:
+                        messages[sha1].addFolder(folderName)
+
+                if arrived and labels is None:
+                    # saveAllMsgs found all the messages there were, unless
+                    # new ones arrived since
+                    logger.warn("%d new message(s) arrived in %s while indexing ?" % (arrived, folderName))
         except:
             logger.exception("Could not index all folders.")
             # Old folder info is better than no info at all.
@@ -353,7 +2685,214 @@ class ImapServer(imaplib.IMAP4_SSL):
         return (folderInfo, messages)
 
 
-    def indexOneFolder(self, messages, oldFld, folderName):
+    def indexFolders(self, folderNames, oldFlds, msgIds=None, checkpoint=None):
+        """
+        Indexes every folder in folderNames (see indexOneFolder) over up to
+        options.connections connections, each one indexing a folder at a time.
+
+        Returns a dict that maps the folder name => EmailFolder, or None if the
+        folder could not be indexed.
+        """
+        indexed = {}
+
+        def index(server, folderName, checkpoint):
+            try:
+                return server.indexOneFolder(None, oldFlds.get(folderName, None), folderName, msgIds, checkpoint)
+            except:
+                logger.exception("Could not properly index folder: %s." % (folderName))
+                return None
+
+        def done(folderName, folder):
+            indexed[folderName] = folder
+            if folder is not None and checkpoint is not None:
+                checkpoint.update(folder)
+                if checkpoint.due(0):
+                    checkpoint.save()
+
+        sessions = [self]
+        for n in range(1, min(options.connections, len(folderNames))):
+            try:
+                sessions.append(self.clone())
+            except:
+                logger.exception("Could not open indexing connection %d" % n)
+
+        if len(sessions) == 1:
+            for folderName in folderNames:
+                done(folderName, index(self, folderName, checkpoint))
+            return indexed
+
+        logger.info("Indexing %d folder(s) over %d connections" % (len(folderNames), len(sessions)))
+        queue = Queue.Queue()
+        for folderName in folderNames:
+            queue.put(folderName)
+        results = Queue.Queue()
+
+        def work(server):
+            while True:
+                try:
+                    folderName = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                # The index is only written by this thread (see done), so the
+                # partially indexed folders are not checkpointed.
+                results.put((folderName, index(server, folderName, None)))
+
+        workers = []
+        for session in sessions:
+            worker = threading.Thread(target=work, args=(session,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        while len(indexed) < len(folderNames):
+            try:
+                # With a timeout, so that Ctrl-C isn't blocked
+                folderName, folder = results.get(True, 1)
+            except Queue.Empty:
+                continue
+            done(folderName, folder)
+
+        for worker in workers:
+            worker.join()
+        for session in sessions[1:]:
+            try:
+                if session.state == 'SELECTED':
+                    session.close()
+                session.logout()
+            except:
+                logger.exception("Closing indexing connection")
+
+        return indexed
+
+
+    def fetchLabels(self, allMailFld):
+        """
+        Retrieves the GMail labels (X-GM-LABELS) and message ID (X-GM-MSGID) of
+        every message in allMailFld with batched FETCH commands.
+
+        Returns (labels, msgIds, unlabeled) where labels maps folder name =>
+        list of SHA1 of the messages in that folder, msgIds maps X-GM-MSGID =>
+        SHA1, and unlabeled is the set of SHA1 whose labels could not be
+        retrieved. Those are left out of msgIds, so indexOneFolder() finds them
+        by their headers.
+
+        The labels give the folders of each message, but not its UID in those
+        folders, so they can't fill EmailFolder.msgs by themselves.
+        """
+        result, data = self.select(allMailFld.name, readonly=True)
+        if result != 'OK':
+            raise self.error("Failed to select folder: " + allMailFld.name)
+
+        uids = allMailFld.msgs.keys()
+        status("Retrieving labels for %d message(s)\n" % len(uids))
+        labels = {}
+        msgIds = {}
+        unlabeled = set()
+        batches = [uids[start:start + options.batchSize] for start in range(0, len(uids), options.batchSize)]
+        for batch, result, data in self.fetchBatches(batches, '(UID X-GM-MSGID X-GM-LABELS)', self.pipelineDepth()):
+            if result != 'OK':
+                logger.warn("Failed to FETCH the labels of %d message(s)" % len(batch))
+                data = []
+
+            found = set()
+            for rsp in ImapServer.joinLiterals(data):
+                uid = uIdMatch.search(rsp)
+                msgId = gmMsgIdMatch.search(rsp)
+                lbls = gmLabelsMatch.search(rsp)
+                if uid is None or msgId is None or lbls is None:
+                    # Unsolicited FETCH response (ex: flag updates)
+                    continue
+
+                sha1 = allMailFld.msgs.get(uid.group(1))
+                if sha1 is None:
+                    continue
+
+                found.add(uid.group(1))
+                msgIds[msgId.group(1)] = sha1
+                for label in ImapServer.parseLabels(lbls.group(1)):
+                    folderName = self.SpecialFolders.get(label, label)
+                    labels.setdefault(folderName, []).append(sha1)
+
+            for uid in batch:
+                if uid not in found:
+                    unlabeled.add(allMailFld.msgs[uid])
+
+            progress('\r%.0f%% %d/%d ' % (len(msgIds) * 100.0 / len(uids), len(msgIds), len(uids)))
+
+        status("\n", False)
+        if len(unlabeled):
+            logger.warn("Could not retrieve the labels of %d message(s). Indexing them folder by folder." % len(unlabeled))
+        return (labels, msgIds, unlabeled)
+
+
+    @staticmethod
+    def joinLiterals(data):
+        """
+        Returns the FETCH responses in the imaplib data as strings. imaplib
+        splits a response at each literal, into (text, literal) tuples followed
+        by a string with the rest. The literals are turned into quoted strings.
+        """
+        rows = []
+        head = ''
+        for part in data:
+            if part is None:
+                continue
+            if type(part) == TupleType:
+                text, literal = part
+                head += literalMatch.sub('', text) + '"%s"' % re.sub(r'(["\\])', r'\\\1', literal)
+            else:
+                rows.append(head + part)
+                head = ''
+        return rows
+
+
+    @staticmethod
+    def parseLabels(line):
+        """Parses the contents of the list returned for X-GM-LABELS"""
+        labels = []
+        for quoted, atom in gmLabelMatch.findall(line):
+            if len(atom):
+                labels.append(atom)
+            else:
+                labels.append(re.sub(r'\\(.)', r'\1', quoted))
+        return labels
+
+
+    def mapMsgIds(self, folder, msgUIDs, msgIds):
+        """
+        Finds the SHA1 of the msgUIDs in the folder by their X-GM-MSGID instead
+        of retrieving their headers. The folder must be selected. The
+        responses are tiny, so unlike the headers they are not fetched
+        options.batchSize at a time: a single UID FETCH goes over the sequence
+        set of all the msgUIDs, split only if it gets too long (see
+        MaxSeqSetLen).
+
+        Returns the UIDs that could not be found in msgIds.
+        """
+        unknown = []
+        batches = [list(uidSet) for uidSet in ImapServer.splitUidSet(msgUIDs, ImapServer.MaxSeqSetLen)]
+        for batch, result, data in self.fetchBatches(batches, '(UID X-GM-MSGID)', self.pipelineDepth()):
+            if result != 'OK':
+                unknown.extend(batch)
+                continue
+
+            found = {}
+            for rsp in [r for r in data if type(r) == StringType]:
+                uid = uIdMatch.search(rsp)
+                msgId = gmMsgIdMatch.search(rsp)
+                if uid is not None and msgId is not None and msgIds.has_key(msgId.group(1)):
+                    found[uid.group(1)] = msgIds[msgId.group(1)]
+
+            for uid in batch:
+                if found.has_key(str(uid)):
+                    folder.msgs[uid] = found[str(uid)]
+                else:
+                    unknown.append(uid)
+
+        return unknown
+
+
+    def indexOneFolder(self, messages, oldFld, folderName, msgIds=None, checkpoint=None):
         """
         Creates an EmailFolder object and populates its EmailFolder.msgs
         dictionary that maps UID => SHA1, either by copying the UID/SHA1 from
@@ -367,8 +2906,13 @@ class ImapServer(imaplib.IMAP4_SSL):
         @param oldFld       If None, the new folder is fully indexed, otherwise
                             reuse the oldFld data to initialize the new folder.
         @param folderName   Name of the folder to index - mandatory
+        @param msgIds       Optional X-GM-MSGID => SHA1 map (see fetchLabels).
+                            Messages found in it don't need their headers
+                            retrieved.
+        @param checkpoint   Optional Checkpoint used to periodically save the
+                            partially indexed folder.
         """
-        folder = EmailFolder(self, folderName)
+        folder = EmailFolder(self, folderName, oldFld)
         if folder.OK:
             status("Indexing: %s\n" % imap_utf7.decode(folderName))
         else:
@@ -378,17 +2922,22 @@ class ImapServer(imaplib.IMAP4_SSL):
         if folder.sameUidVal(oldFld):
             msgUIDs = folder.carryOver(oldFld, messages, None)
         else:
-            msgUIDs = folder.UIDs
+            msgUIDs = list(folder.UIDs)
+
+        if msgIds is not None and len(msgUIDs):
+            unknown = self.mapMsgIds(folder, msgUIDs, msgIds)
+            if checkpoint is not None and checkpoint.due(len(msgUIDs) - len(unknown)):
+                checkpoint.save(folder=folder)
+            msgUIDs = unknown
 
         msgCnt = len(msgUIDs)
         status("Retained %5d message(s). Need to transfer %5d message(s).\n" % (len(folder.msgs), msgCnt))
         i = 0
         try:
-            for uid in msgUIDs:
+            for uid, msg in EmailMsg.fetchAll(self, msgUIDs, options.batchSize, self.pipelineDepth()):
                 i += 1
-                msg = EmailMsg(self, uid)
                 if not msg.OK:
-                    logger.error("Could not retrieve UID %d from folder %s", uid, folderName)
+                    logger.error("Could not retrieve UID %s from folder %s", uid, folderName)
                     # TODO: Error handling
                     continue
 
@@ -396,20 +2945,381 @@ class ImapServer(imaplib.IMAP4_SSL):
                 if messages is not None:
                     sha1 = msg['sha1']
                     if messages.has_key(sha1) and folderName not in messages[sha1]['folder']:
-                        messages[sha1]['folder'].append(folderName)
+                        messages[sha1].addFolder(folderName)
                     else:
                         # Assumes saveAllMsgs was called first, and messages
                         # contains a full list of all current SHA1's
                         logger.warn("New message arrived in %s while indexing %d/%d ?" % (folderName, i, msgCnt))
 
-                progress('\r%.0f%% %d/%d ' % (i * 100.0 / msgCnt, i, msgCnt))
-        except:
-            status("\n", False)
-            logger.debug("Indexed %d/%d" % (i, msgCnt))
-            logger.exception("Could not fully index folder %s" % folderName)
+                if checkpoint is not None and checkpoint.due():
+                    checkpoint.save(folder=folder)
+
+                progress('\r%.0f%% %d/%d ' % (i * 100.0 / msgCnt, i, msgCnt))
+        except:
+            status("\n", False)
+            logger.debug("Indexed %d/%d" % (i, msgCnt))
+            logger.exception("Could not fully index folder %s" % folderName)
+
+        status("\n", False)
+        return folder
+
+
+class DownloadPool(object):
+    """
+    Downloads batches of messages (see ImapServer.saveMsgs) over several server
+    connections in parallel. The pool is only used for the message bodies. The
+    caller retrieves the headers and updates the message/folder indexes on its
+    own connection, so duplicate SHA1 handling is not affected by the order in
+    which the bodies arrive.
+
+    With a single connection, the batches are downloaded by the caller's server
+    as soon as they are submitted. sizes (UID => RFC822.SIZE) is passed on to
+    saveMsgs, and can be added to after the pool is created.
+    """
+    def __init__(self, server, folderName, backupDir, connections, sizes=None):
+        self.server = server
+        self.backupDir = backupDir
+        self.sizes = sizes
+        self.saved = 0
+
+        # The (uid, sha1) of the messages that could not be saved
+        self.failed = []
+
+        # The batches submitted to the workers that are not done yet
+        self.queued = []
+
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(maxsize=2 * connections)
+        self.workers = []
+
+        for n in range(1, connections):
+            try:
+                session = server.clone()
+                result, data = session.select(folderName, readonly=True)
+                if result != 'OK':
+                    logger.error("Failed to select folder: " + folderName)
+                    continue
+            except:
+                logger.exception("Could not open download connection %d" % n)
+                continue
+
+            worker = threading.Thread(target=self.work, args=(session,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        if len(self.workers):
+            logger.info("Downloading messages over %d connections" % len(self.workers))
+
+
+    def submit(self, uidSha):
+        """Queues a list of (uid, sha1) for download"""
+        if len(uidSha) == 0:
+            return
+
+        if len(self.workers):
+            batch = list(uidSha)
+            with self.lock:
+                self.queued.append(batch)
+            self.queue.put(batch)
+        else:
+            saved, failed = self.server.saveMsgs(uidSha, self.backupDir, self.sizes)
+            self.saved += saved
+            self.failed.extend(failed)
+
+
+    def work(self, session):
+        while True:
+            uidSha = self.queue.get()
+            if uidSha is None:
+                break
+
+            try:
+                saved, failed = session.saveMsgs(uidSha, self.backupDir, self.sizes)
+                with self.lock:
+                    self.saved += saved
+                    self.failed.extend(failed)
+            except:
+                logger.exception("Could not save %d message(s)" % len(uidSha))
+                with self.lock:
+                    self.failed.extend(uidSha)
+
+            with self.lock:
+                self.queued.remove(uidSha)
+
+        try:
+            session.close()
+            session.logout()
+        except:
+            logger.exception("Closing download connection")
+
+
+    def unsaved(self):
+        """
+        Returns the (uid, sha1) of the submitted messages that are not saved
+        yet, or that could not be saved.
+        """
+        with self.lock:
+            return self.failed + sum(self.queued, [])
+
+
+    def close(self):
+        """
+        Waits for all queued batches to finish.
+
+        Returns (saved, failed) where saved is the number of messages saved,
+        and failed is the list of (uid, sha1) of the messages that might not
+        have been saved.
+        """
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        return (self.saved, self.failed)
+
+
+class Checkpoint(object):
+    """
+    Periodically saves the partial results of a backup to the index, so an
+    interrupted backup can resume from the last checkpoint instead of starting
+    over. A checkpoint is due every msgCount messages or every seconds
+    (whichever comes first). Either one can be 0 to disable it.
+
+    The folders that have not been indexed yet are saved with their old data,
+    and a partially indexed folder is saved with the messages indexed so far.
+    The next backup retrieves the rest (see EmailFolder.carryOver).
+
+    The flags of the messages already in the index are only written by the
+    final save, so the folders are checkpointed with their old HIGHESTMODSEQ.
+    The next backup then asks the server again for the flags that changed.
+
+    Each checkpoint only writes what changed since the previous one (see
+    PickleIndex.addFlds), so they don't get slower as the backup goes on.
+    """
+    def __init__(self, index, msgCount, seconds, flds):
+        self.index = index
+        self.msgCount = msgCount
+        self.seconds = seconds
+        self.count = 0
+        self.last = time.time()
+
+        self.oldFlds = flds
+
+        # Only what changed since the previous checkpoint is written. Key =
+        # folder name, value = the folder to write whole with the next
+        # checkpoint (see update)
+        self.replaced = {}
+
+        # Key = folder name, value = (folder, its msgs, UIDs held back) of the
+        # folders already written whole, whose new messages are written as
+        # they're added (see UidMap.track)
+        self.tracked = {}
+
+        # False until the messages are first written
+        self.msgsWritten = False
+
+    def update(self, folder):
+        """Saves a folder that is fully indexed with the next checkpoints"""
+        tracked = self.tracked.get(folder.name)
+        if tracked is None or tracked[1] is not folder.msgs:
+            self.tracked.pop(folder.name, None)
+            self.replaced[folder.name] = self.stale(folder, folder.msgs)
+
+    def stale(self, folder, msgs):
+        """Returns a copy of folder, with msgs, and the old HIGHESTMODSEQ"""
+        folder = copy(folder)
+        folder.msgs = msgs
+        folder.pop('HIGHESTMODSEQ', None)
+        oldFld = self.oldFlds.get(folder.name)
+        if oldFld is not None and oldFld.has_key('HIGHESTMODSEQ'):
+            folder['HIGHESTMODSEQ'] = oldFld['HIGHESTMODSEQ']
+        return folder
+
+    def due(self, msgs=1):
+        self.count += msgs
+        if self.msgCount > 0 and self.count >= self.msgCount:
+            return True
+        return self.seconds > 0 and time.time() - self.last >= self.seconds
+
+    def save(self, messages=None, folder=None, unsaved=()):
+        """
+        @param messages The messages to save (if any). Only messages that are
+            not in the index yet are written (see SqliteIndex.addMsgs).
+        @param folder   A partially indexed folder.
+        @param unsaved  The (uid, sha1) of messages whose body is not on disk
+            yet. They are left out of the checkpoint.
+        """
+        unsaved = set([(str(uid), sha1) for uid, sha1 in unsaved])
+        replaced, self.replaced = self.replaced, {}
+        newMsgs = {}
+
+        if folder is not None:
+            tracked = self.tracked.get(folder.name)
+            if tracked is None or tracked[1] is not folder.msgs:
+                # The first checkpoint of this folder writes it whole. The
+                # next ones only write the messages added since.
+                msgs = folder.msgs.copy()
+                held = []
+                for uid, sha1 in unsaved:
+                    if msgs.get(uid) == sha1:
+                        del msgs[uid]
+                        held.append(uid)
+                replaced[folder.name] = self.stale(folder, msgs)
+                folder.msgs.track()
+                self.tracked[folder.name] = (folder, folder.msgs, held)
+                if messages is not None and not self.msgsWritten:
+                    newMsgs = dict([(sha1, messages[sha1]) for sha1 in msgs.values() if messages.has_key(sha1)])
+
+        if messages is not None and folder is None:
+            if not self.msgsWritten:
+                newMsgs = dict(messages)
+            else:
+                for fld in replaced.values():
+                    for sha1 in fld.msgs.values():
+                        if messages.has_key(sha1):
+                            newMsgs[sha1] = messages[sha1]
+            for uid, sha1 in unsaved:
+                newMsgs.pop(sha1, None)
+
+        # Key = folder name, value = (the folder without its msgs, the (uid,
+        # sha1) added to it)
+        added = {}
+        for name, (fld, msgs, held) in self.tracked.items():
+            entries = []
+            stillHeld = []
+            for uid in held + msgs.takeAdded():
+                sha1 = msgs.get(uid)
+                if sha1 is None:
+                    continue
+                if (uid, sha1) in unsaved:
+                    stillHeld.append(uid)
+                else:
+                    entries.append((uid, sha1))
+                    if messages is not None and messages.has_key(sha1):
+                        newMsgs[sha1] = messages[sha1]
+            self.tracked[name] = (fld, msgs, stillHeld)
+            if not replaced.has_key(name):
+                added[name] = (self.stale(fld, UidMap()), entries)
+
+        if messages is not None:
+            self.msgsWritten = True
+        if len(newMsgs):
+            self.index.addMsgs(newMsgs)
+        self.index.addFlds(replaced, added)
+
+        if folder is None:
+            logger.info("Checkpoint saved")
+        else:
+            logger.info("Checkpoint saved (%s: %d message(s))" % (folder.name, len(folder.msgs) - len(self.tracked[folder.name][2])))
+        self.count = 0
+        self.last = time.time()
+
+
+class Budget(object):
+    """
+    Limits how long a backup downloads messages (maxSecs, counted from when
+    the Budget is created) and how much it downloads (maxBytes, counted with
+    the RFC822.SIZE of each message, see ImapServer.saveAllMsgs). Either one can
+    be 0 for no limit. The batches already submitted when the budget runs out
+    are still downloaded, so it can be exceeded by a few batches.
+    """
+    def __init__(self, maxSecs, maxBytes):
+        self.maxSecs = maxSecs
+        self.maxBytes = maxBytes
+        self.start = time.time()
+        self.bytes = 0
+
+        # Key = UID, value = RFC822.SIZE
+        self.sizes = {}
+
+    def spend(self, uid):
+        self.bytes += self.sizes.get(uid, 0)
+
+    def exhausted(self):
+        if self.maxBytes > 0 and self.bytes >= self.maxBytes:
+            return True
+        return self.maxSecs > 0 and time.time() - self.start >= self.maxSecs
+
+    def __str__(self):
+        return "Download budget used up (%.1f MB in %.1f minutes)" % \
+                (self.bytes / 1024.0 / 1024, (time.time() - self.start) / 60)
+
+
+class RestoreJournal(object):
+    """
+    Remembers the messages uploaded by a restore (see restoreAllMailFld) until
+    the restored index is saved, so that if the restore is interrupted, the
+    next one doesn't upload them again. Each message is a "SHA1 UID
+    UIDVALIDITY" line ("SHA1 - UIDVALIDITY" if the server didn't give its UID),
+    on disk as soon as the APPEND command that uploaded it is done.
+
+    Once the index is saved, only the messages that are still not in All Mail
+    are kept, as "SHA1 pending" lines (see reset). They have no UID in the
+    index, so the next restore looks for them by SHA1.
+    """
+    FileName = 'restore.journal'
+    Pending = 'pending'
+
+    def __init__(self, backupDir):
+        self.path = os.path.join(backupDir, RestoreJournal.FileName)
+        self.file = None
 
-        status("\n", False)
-        return folder
+    def load(self, uidValidity):
+        """
+        Returns a dict that maps SHA1 => UID (None if unknown) of the messages
+        uploaded to a folder that still has the same UIDVALIDITY.
+        """
+        uploaded = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    fields = line.split()
+                    # The last line could be partially written
+                    if len(fields) == 3 and fields[2] == str(uidValidity):
+                        uploaded[fields[0]] = fields[1] if fields[1] != '-' else None
+        return uploaded
+
+    def loadPending(self):
+        """Returns the SHA1 of the messages the last restore left out of All Mail"""
+        pending = set()
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == RestoreJournal.Pending:
+                        pending.add(fields[0])
+        return pending
+
+    def add(self, sha1Uids, uidValidity):
+        """Records the (SHA1, UID) of the messages uploaded by one command"""
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+        self.file.write(''.join(["%s %s %s\n" % (sha1, uid or '-', uidValidity) for sha1, uid in sha1Uids]))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def remove(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def reset(self, pending):
+        """
+        Called once the restored index is saved. Only the SHA1 of the pending
+        messages (still not in All Mail) are kept.
+        """
+        self.remove()
+        if not len(pending):
+            return
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            f.write(''.join(["%s %s\n" % (sha1, RestoreJournal.Pending) for sha1 in sorted(pending)]))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpPath, self.path)
 
 
 class EmailFolder(dict):
@@ -420,23 +3330,34 @@ class EmailFolder(dict):
         3. The UIDs of all messages in the folder
 
     Only the first 2 items are saved when the folder info is serialized to disk
+
+    If oldFld (the same folder from the previous backup) is provided, only the
+    changes since then are retrieved when the server allows it (see
+    fetchChanges).
     """
-    def __init__(self, server, folder):
+    def __init__(self, server, folder, oldFld=None):
         self.OK = False
         self.name = folder
 
-        # Key = UID, value = SHA1. See also getSha2Uid().
-        self.msgs = {}
+        # Key = UID, value = SHA1. See also UidMap.uidOf().
+        self.msgs = UidMap()
 
         # The UIDs in this folder, as reported by the server.
         # After a folder is indexed, this should be == self.msgs.keys()
         # This is maintained separate from self.msgs because when a folder
         # object is created by this __init__, all we have is UIDs.
-        self.UIDs = []
+        self.UIDs = UidSet()
 
-        result, data = server.xlist("", folder)
-        if result == 'OK':
-            flags, delimiter, imap_folder = ImapServer.parseListResponse(data[0])
+        # The UIDs left out of self.msgs because their SHA1 is already in
+        # All Mail (see ImapServer.saveAllMsgs)
+        self.dupUIDs = UidSet()
+
+        # Key = UID, value = FLAGS of the messages whose flags changed since
+        # oldFld was saved. Consumed by carryOver().
+        self.changedFlags = {}
+
+        flags = server.folderFlags(folder)
+        if flags is not None:
             self.update( {'Type' : frozenset(flags.split()).intersection(SpecialFolderFlags)} )
         else:
             self.update( {'Type' : frozenset()} )
@@ -446,6 +3367,10 @@ class EmailFolder(dict):
         if result == 'OK':
             self.update( EmailFolder.parseSelectRsp(server) )
 
+            if self.fetchChanges(server, oldFld):
+                self.OK = True
+                return
+
             # result, data = server.uid('SEARCH', 'ALL')
             # For large folders, a "UID SEARCH ALL" could produce a very large response,
             # so we'll break it down into blocks of listSz
@@ -458,20 +3383,55 @@ class EmailFolder(dict):
             if lastMsg == 0:
                 # Empty folder
                 self.OK = True
+            elif 'ESEARCH' in server.capabilities and self.searchAll(server):
+                self.OK = True
             else:
+                uids = []
                 for minMax in [(s, s + listSz - 1) for s in range(1, lastMsg + 1, listSz)]:
                     result, data = server.uid('SEARCH', '%d:%d' % minMax)
                     if result == 'OK':
-                        self.UIDs.extend( data[0].split() )
+                        uids.extend( data[0].split() )
                         self.OK = True
                     else:
                         self.OK = False
                         logger.warn("Could not retrieve all UIDs from: " + self.name)
                         break
+                self.UIDs = UidSet(uids)
         else:
             logger.warn("Could not select folder: " + self.name)
 
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not isinstance(self.msgs, UidMap):
+            # Older versions used a dict
+            self.msgs = UidMap(self.msgs)
+        self.__dict__.setdefault('dupUIDs', UidSet())
+
+
+    def searchAll(self, server):
+        """
+        Retrieves all the UIDs with a single ESEARCH (RFC 4731) command. The
+        server returns them as a compact sequence set (ex: "1:4,7,9:12")
+        instead of a list of every UID.
+        """
+        server.response('ESEARCH')      # Discard stale responses
+        result, data = server.uid('SEARCH', 'RETURN', '(ALL)', 'ALL')
+        if result != 'OK':
+            logger.warn("ESEARCH failed on: " + self.name)
+            return False
+
+        for rsp in server.response('ESEARCH')[1]:
+            if rsp is not None:
+                # No "ALL" if there are no matches
+                match = esearchMatch.search(rsp)
+                if match is not None:
+                    self.UIDs = UidSet.parse(match.group(1))
+                return True
+
+        return False
+
+
     @staticmethod
     def parseSelectRsp(server):
         FLAGS = imaplib.ParseFlags( server.response('FLAGS')[1][0] )
@@ -481,10 +3441,86 @@ class EmailFolder(dict):
         UIDNEXT = int(server.response('UIDNEXT')[1][0])
         result = {'FLAGS':FLAGS, 'UIDVALIDITY':UIDVALIDITY, 'RECENT':RECENT,
                 'EXISTS':EXISTS, 'UIDNEXT':UIDNEXT}
+
+        # Only sent by servers with CONDSTORE enabled
+        HIGHESTMODSEQ = server.response('HIGHESTMODSEQ')[1][0]
+        if HIGHESTMODSEQ is not None:
+            result['HIGHESTMODSEQ'] = long(HIGHESTMODSEQ)
+
         logger.debug(pprint.pformat(result))
         return result
 
 
+    def fetchChanges(self, server, oldFld):
+        """
+        Uses CONDSTORE/QRESYNC to retrieve only what changed in this folder
+        since oldFld was saved:
+            1. The FLAGS of the messages that changed (All Mail only, since
+               that's where the message flags are taken from)
+            2. The UIDs of the expunged messages (VANISHED). QRESYNC only.
+
+        Returns True if self.UIDs could be computed from oldFld and the
+        changes, in which case the UIDs don't need to be retrieved from the
+        server.
+        """
+        if not server.condstore or not self.has_key('HIGHESTMODSEQ') or not self.sameUidVal(oldFld):
+            return False
+
+        # Backups made before CONDSTORE support have no HIGHESTMODSEQ. All the
+        # flags are retrieved once to refresh them.
+        modseq = oldFld.get('HIGHESTMODSEQ', 0)
+        wantFlags = self.name == server.AllMailFolder
+        vanished = server.qresync and modseq > 0
+        if not wantFlags and not vanished:
+            return False
+
+        server.response('VANISHED')     # Discard stale responses
+        if vanished:
+            modifier = '(CHANGEDSINCE %d VANISHED)' % modseq
+        else:
+            modifier = '(CHANGEDSINCE %d)' % modseq
+        result, data = server.uid('FETCH', '1:*', '(UID FLAGS)', modifier)
+        if result != 'OK':
+            logger.warn("Could not retrieve the changes to %s" % self.name)
+            # Retry from the same point next time
+            if modseq > 0:
+                self['HIGHESTMODSEQ'] = modseq
+            else:
+                del self['HIGHESTMODSEQ']
+            return False
+
+        if wantFlags:
+            for rsp in [r for r in data if type(r) == StringType]:
+                uid = uIdMatch.search(rsp)
+                flags = flagsMatch.search(rsp)
+                if uid is not None and flags is not None:
+                    self.changedFlags[uid.group(1)] = flags.group(1)
+            logger.info("Flags changed on %d message(s) in %s" % (len(self.changedFlags), self.name))
+
+        if not vanished:
+            return False
+
+        gone = UidSet()
+        for rsp in server.response('VANISHED')[1]:
+            if rsp is not None:
+                gone = gone.union(UidSet.parse(rsp.split()[-1]))
+
+        # New messages
+        result, data = server.uid('SEARCH', 'UID', '%d:*' % oldFld['UIDNEXT'])
+        if result != 'OK':
+            return False
+        newUIDs = UidSet([uid for uid in data[0].split() if int(uid) >= oldFld['UIDNEXT']])
+
+        self.UIDs = UidSet.of(oldFld.UIDs).difference(gone).union(newUIDs)
+        if len(self.UIDs) != self['EXISTS']:
+            logger.warn("Expected %d UIDs in %s. Found %d. Retrieving all of them." % (self['EXISTS'], self.name, len(self.UIDs)))
+            self.UIDs = UidSet()
+            return False
+
+        logger.info("%s: %d new, %d expunged message(s)" % (self.name, len(newUIDs), len(gone)))
+        return True
+
+
 
     def sameUidVal(self, otherFld):
         if otherFld is not None:
@@ -492,12 +3528,6 @@ class EmailFolder(dict):
         else:
             return False
 
-    def getSha2Uid(self):
-        sha2Uid = {}
-        for uid, sha in self.msgs.items():
-            sha2Uid[sha] = uid
-        return sha2Uid
-
 
     def uidDiffIntersect(self, otherFld):
         """
@@ -509,14 +3539,14 @@ class EmailFolder(dict):
             that haven't changed.
         """
         if self.sameUidVal(otherFld):
-            thisUid = set(self.UIDs)
-            thatUid = set(otherFld.UIDs)
+            thisUid = UidSet.of(self.UIDs)
+            thatUid = UidSet.of(otherFld.UIDs)
 
             # These are the new msgUIDs that were added since the last backup
             diff = list(thisUid.difference(thatUid))
 
             # These are the messages that haven't changed
-            intersection = list(thisUid.intersection(thatUid))
+            intersection = thisUid.intersection(thatUid)
             return (diff, intersection)
         else:
             return (None, None)
@@ -547,44 +3577,244 @@ class EmailFolder(dict):
 
             if oldMsgs is not None:
                 messages[sha] = oldMsgs[sha]
+                if self.changedFlags.has_key(uid):
+                    messages[sha]['flags'] = self.changedFlags[uid]
 
             if messages is not None:
                 if appendFolder:
-                    messages[sha]['folder'].append(self.name)
+                    messages[sha].addFolder(self.name)
                 else:
                     messages[sha]['folder'] = [ self.name ]
 
             self.msgs[uid] = oldFld.msgs[uid]
 
+        self.changedFlags = {}
         return msgUIDs
 
 
-class EmailMsg(dict):
-    def __init__(self, server, uid):
-        """The folder must be selected on the server before this function is called"""
+class EmailMsg(object):
+    """
+    The meta-data of a message. It's accessed like a dict (msg['flags']), but
+    since the index holds one for every message, it's stored compactly: the
+    UID as an integer, the INTERNALDATE as seconds since the epoch (see
+    parseDate), and the flags and folder list shared between all the messages
+    that have the same ones. The SHA1 is kept as a hex string: it's the same
+    string object as the message's key in the message index, so a digest
+    would take more memory, not less.
+    """
+    # The message data items needed to compute the SHA1. RFC822.SIZE is
+    # only passed on to the downloads (see fetchAll).
+    FetchItems = '(UID FLAGS INTERNALDATE RFC822.SIZE ' \
+                 'BODY[HEADER.FIELDS (FROM TO CC DATE SUBJECT X-GMAIL-RECEIVED MESSAGE-ID)])'
+
+    Keys = ('uid', 'flags', 'internaldate', 'sha1', 'folder')
+    __slots__ = Keys + ('OK',)
+
+    # The folder lists (tuples) shared by the messages
+    FolderLists = {}
+
+    def __init__(self, server, uid, fetchRsp=None):
+        """
+        The folder must be selected on the server before this function is called
+
+        @param fetchRsp Optional ("uid internaldate", "headers") pair already
+            retrieved from the server (see fetchAll). If present, the server is
+            not queried again.
+        """
         self.OK = False
 
-        result, data = server.uid('FETCH', uid, '(UID FLAGS INTERNALDATE BODY[HEADER.FIELDS (FROM TO CC DATE SUBJECT X-GMAIL-RECEIVED MESSAGE-ID)])')
-        # data == [("uid internaldate", "headers"), ')']
-        if result == 'OK':
-            try:
-                # The UID changes based on the selected folder, but when serializing
-                # we always serialize the UID for AllMailFolder
-                self['uid'] = uIdMatch.search(data[0][0]).group(1)
-                self['flags'] = flagsMatch.search(data[0][0]).group(1)
-                self['internaldate'] = intDateMatch.search(data[0][0]).group(1)
+        if fetchRsp is None:
+            result, data = server.uid('FETCH', uid, EmailMsg.FetchItems)
+            # data == [("uid internaldate", "headers"), ')']
+            if result != 'OK':
+                return
+            fetchRsp = data[0]
+
+        try:
+            # The UID changes based on the selected folder, but when serializing
+            # we always serialize the UID for AllMailFolder
+            self['uid'] = uIdMatch.search(fetchRsp[0]).group(1)
+            self['flags'] = flagsMatch.search(fetchRsp[0]).group(1)
+            self['internaldate'] = intDateMatch.search(fetchRsp[0]).group(1)
 
-                parser = HeaderParser()
-                msg = parser.parsestr(data[0][1], headersonly=True)
-                self['sha1'] = EmailMsg.computeSha1(self['internaldate'], msg)
+            parser = HeaderParser()
+            msg = parser.parsestr(fetchRsp[1], headersonly=True)
+            self['sha1'] = EmailMsg.computeSha1(self['internaldate'], msg)
 
-                # The list of folders in which this message appears
-                self['folder'] = []
+            # The list of folders in which this message appears
+            self['folder'] = []
 
-                self.OK = True
-            except:
-                logger.exception("Error retrieving message")
-                self.OK = False
+            self.OK = True
+        except:
+            logger.exception("Error retrieving message")
+            self.OK = False
+
+
+    def __getitem__(self, key):
+        if key not in EmailMsg.Keys or not hasattr(self, key):
+            raise KeyError(key)
+        if key == 'uid':
+            return str(self.uid)
+        elif key == 'internaldate':
+            return EmailMsg.formatDate(self.internaldate)
+        return getattr(self, key)
+
+    def __setitem__(self, key, val):
+        if key == 'uid':
+            val = int(val)
+        elif key == 'internaldate':
+            val = EmailMsg.parseDate(val)
+        elif key == 'flags':
+            val = intern(val)
+        elif key == 'folder':
+            val = tuple(val)
+            val = EmailMsg.FolderLists.setdefault(val, val)
+        elif key not in EmailMsg.Keys:
+            raise KeyError(key)
+        setattr(self, key, val)
+
+    def has_key(self, key):
+        return key in EmailMsg.Keys and hasattr(self, key)
+
+    __contains__ = has_key
+
+    def get(self, key, default=None):
+        if self.has_key(key):
+            return self[key]
+        return default
+
+    def keys(self):
+        return [key for key in EmailMsg.Keys if hasattr(self, key)]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, items):
+        for key, val in items.items():
+            self[key] = val
+
+    def addFolder(self, folderName):
+        self['folder'] = self.folder + (folderName,)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getstate__(self):
+        return (dict(self.items()), getattr(self, 'OK', False))
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Older versions (see reconstruct)
+            self.OK = state.get('OK', False)
+        else:
+            items, self.OK = state
+            self.update(items)
+
+
+    @staticmethod
+    def parseDate(date):
+        """
+        Returns the INTERNALDATE string (ex: "17-Jul-2012 02:44:25 +0000") as
+        seconds since the epoch. GMail gives them in UTC. Dates in any other
+        form are returned as they are, since the SHA1 is computed from the
+        exact string (see formatDate).
+        """
+        if type(date) in (IntType, LongType):
+            return date
+        match = utcDateMatch.match(date)
+        if match is None or match.group(2) not in MON:
+            return date
+        day, mon, year, hour, minute, sec = match.groups()
+        secs = calendar.timegm((int(year), MON.index(mon) + 1, int(day), int(hour), int(minute), int(sec)))
+        if secs < 0 or EmailMsg.formatDate(secs) != date:
+            # Out of range fields (ex: 31-Feb). Windows can't format dates
+            # before 1970.
+            return date
+        return secs
+
+    @staticmethod
+    def formatDate(date):
+        """The INTERNALDATE string of a date returned by parseDate"""
+        if type(date) not in (IntType, LongType):
+            return date
+        t = time.gmtime(date)
+        return '%02d-%s-%04d %02d:%02d:%02d +0000' % (t.tm_mday, MON[t.tm_mon - 1], t.tm_year,
+                                                      t.tm_hour, t.tm_min, t.tm_sec)
+
+
+    @staticmethod
+    def fetchAll(server, uids, batchSz, depth=1, sizes=None):
+        """
+        Generator that retrieves the headers of the messages in uids using a
+        single UID FETCH command for every batchSz messages, instead of a round
+        trip to the server for each message. Up to depth commands are sent
+        ahead (see ImapServer.fetchBatches). If sizes is given, the
+        RFC822.SIZE of each message is added to it (UID => size) before the
+        message is yielded.
+
+        Yields (uid, EmailMsg) tuples in the same order as uids, except that
+        with depth > 1 the messages missing from the bulk responses come last.
+        The folder must be selected on the server before this function is
+        called.
+        """
+        batches = [uids[start:start + batchSz] for start in range(0, len(uids), batchSz)]
+        # Nothing can be sent while pipelined commands are in flight
+        retry = []
+        for batch, result, data in server.fetchBatches(batches, EmailMsg.FetchItems, depth):
+            if result == 'OK':
+                fetched = EmailMsg.splitFetchRsp(data)
+                if sizes is not None:
+                    for uid, (envelope, literal) in fetched.items():
+                        size = sizeMatch.search(envelope)
+                        if size is not None:
+                            sizes[uid] = int(size.group(1))
+            else:
+                logger.warn("Failed to FETCH %d message(s) in bulk. Retrying one at a time." % len(batch))
+                fetched = {}
+
+            for uid in batch:
+                # Messages missing from the bulk response are retried by
+                # themselves so errors are reported the same way as before.
+                rsp = fetched.get(str(uid))
+                if rsp is None and depth > 1:
+                    retry.append(uid)
+                else:
+                    yield (uid, EmailMsg(server, uid, rsp))
+
+        for uid in retry:
+            yield (uid, EmailMsg(server, uid, None))
+
+
+    @staticmethod
+    def splitFetchRsp(data):
+        """
+        Splits the imaplib data returned by a multi-message FETCH into a
+        dictionary that maps UID => ("uid internaldate", "headers").
+
+        imaplib returns each message as a (envelope, literal) tuple followed by
+        a string with whatever came after the literal (usually just ')'). That
+        string is appended to the envelope since the server is free to send
+        some of the data items (ex: FLAGS) after the literal.
+        """
+        fetched = []
+        item = None
+        for part in data:
+            if type(part) == TupleType:
+                item = [part[0], part[1]]
+                fetched.append(item)
+            elif item is not None and part is not None:
+                item[0] += part
+                item = None
+            else:
+                # Unsolicited FETCH responses (ex: flag updates) without a literal
+                item = None
+
+        rsp = {}
+        for envelope, literal in fetched:
+            match = uIdMatch.search(envelope)
+            if match:
+                rsp[match.group(1)] = (envelope, literal)
+        return rsp
 
 
     @staticmethod
@@ -618,11 +3848,7 @@ class EmailMsg(dict):
 
     @staticmethod
     def move(shaHexFrom, shaHexTo, backupDir):
-        srcPath = os.path.join(backupDir, shaHexFrom[0:2], shaHexFrom)
-        dstPath = os.path.join(backupDir, shaHexTo[0:2], shaHexTo)
-
-        # Creates directories as needed
-        os.renames(srcPath, dstPath)
+        msgStore(backupDir).move(shaHexFrom, shaHexTo)
 
 
 class dict2xml(object):
@@ -678,14 +3904,14 @@ class Stats(object):
     """
 
     @staticmethod
-    def extractStats(backupDir, msgIndexFile, fldIndexFile):
+    def extractStats(backupDir, index):
         """
         TODO:
             Messages received per day
             Messages sent per day
         """
-        msgIndex = deserialize(msgIndexFile)
-        fldIndex = deserialize(fldIndexFile)
+        msgIndex = index.loadMsgs()
+        fldIndex = index.loadFlds()
 
         timeStats = {'Yrs':{}, 'DOW':{}, 'Hrs':{}}
         stats = {'CountTotalMsgs':0, 'CountListMsgs':0,
@@ -701,9 +3927,11 @@ class Stats(object):
         idx = 0
         status("Computing stats for %d message(s).\n" % (len(msgIndex)))
 
+        store = msgStore(backupDir)
         for sha1 in msgIndex.keys():
             idx += 1
-            fp = open(os.path.join(backupDir, sha1[0:2], sha1), 'r')
+            # Only the headers are parsed
+            fp = StringIO(store.readHeaders(sha1))
 
             firstLine = fp.readline()
             if firstLine.startswith('>From - '):
@@ -818,30 +4046,347 @@ def rotateFile(fName, levels, move=False):
     return True
 
 
-def backup(server, backupDir, msgIndexFile, fldIndexFile):
+class PickleIndex(object):
+    """
+    Stores the message index (SHA1 => EmailMsg) and the folder index (folder
+    name => EmailFolder) in two pickle files that are rewritten whole on
+    every save. What the checkpoints add in between is appended to a third
+    one (see addMsgs, addFlds), and merged in when the indexes are loaded.
+    """
+    def __init__(self, backupDir):
+        self.msgIndexFile = os.path.join(backupDir, "msgIndex.pickle")
+        self.fldIndexFile = os.path.join(backupDir, "fldIndex.pickle")
+        self.checkpointFile = os.path.join(backupDir, "checkpoint.pickle")
+        # The indexes saved whole (see saved)
+        self.savedWhole = set()
+
+    def exists(self):
+        return (os.path.exists(self.msgIndexFile) and os.path.exists(self.fldIndexFile)) or \
+               os.path.exists(self.checkpointFile)
+
+    def loadMsgs(self):
+        messages = deserialize(self.msgIndexFile)
+        for record in self.checkpoints():
+            if record[0] == 'msgs':
+                for sha1, msg in record[1].items():
+                    messages.setdefault(sha1, msg)
+        return messages
+
+    def loadFlds(self):
+        flds = deserialize(self.fldIndexFile)
+        for record in self.checkpoints():
+            if record[0] == 'flds':
+                replaced, added = record[1:]
+                flds.update(replaced)
+                for name, (header, entries) in added.items():
+                    folder = flds.get(name)
+                    if folder is None:
+                        continue
+                    msgs = folder.msgs
+                    folder.__dict__.update(header.__dict__)
+                    folder.clear()
+                    folder.update(header)
+                    folder.msgs = msgs
+                    for uid, sha1 in entries:
+                        folder.msgs[uid] = sha1
+        return flds
+
+    def checkpoints(self):
+        """Yields the records appended by the checkpoints since the last save"""
+        if not os.path.exists(self.checkpointFile):
+            return
+        with open(self.checkpointFile, 'rb') as f:
+            unpickler = pickle.Unpickler(f)
+            unpickler.find_global = findGlobal
+            while True:
+                try:
+                    record = unpickler.load()
+                except EOFError:
+                    return
+                except:
+                    # The last record could be partially written
+                    logger.warn("Ignoring the end of %s" % self.checkpointFile)
+                    return
+                yield record
+
+    def append(self, record):
+        self.savedWhole.clear()
+        with open(self.checkpointFile, 'ab') as f:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def saved(self, which):
+        """The checkpoints are dropped once both indexes are saved whole"""
+        self.savedWhole.add(which)
+        if len(self.savedWhole) == 2:
+            self.savedWhole.clear()
+            if os.path.exists(self.checkpointFile):
+                os.remove(self.checkpointFile)
+
+    def saveMsgs(self, messages):
+        serialize(self.msgIndexFile, messages)
+        self.saved('msgs')
+
+    def addMsgs(self, messages):
+        """Adds the messages that are not in the index yet"""
+        self.append(('msgs', messages))
+
+    def saveFlds(self, flds):
+        serialize(self.fldIndexFile, flds)
+        self.saved('flds')
+
+    def addFlds(self, replaced, added):
+        """
+        @param replaced Key = folder name, value = EmailFolder to save whole.
+        @param added    Key = folder name, value = (EmailFolder, [(uid, sha1)])
+            where the EmailFolder replaces the folder data except its msgs,
+            which get the (uid, sha1) added.
+        """
+        self.append(('flds', replaced, added))
+
+    def rotate(self):
+        if os.path.exists(self.checkpointFile):
+            # The rotated copies would miss what it holds
+            self.saveMsgs(self.loadMsgs())
+            self.saveFlds(self.loadFlds())
+        rotateFile(self.msgIndexFile, 5)
+        rotateFile(self.fldIndexFile, 5)
+
+
+class SqliteIndex(object):
+    """
+    Stores the message and folder indexes in an SQLite database. Only the rows
+    that changed since the database was last saved are written, each save in
+    a single transaction, so an interrupted save leaves the previous index
+    intact.
+
+    Tables:
+        messages    One row per EmailMsg (the SHA1, the All Mail UID, the
+                    flags, the internaldate and the folders it appears in)
+        folders     One row per EmailFolder (the SELECT data, the folder type,
+                    the UIDs reported by the server and the duplicate UIDs)
+        membership  One row per EmailFolder.msgs entry (folder, UID => SHA1)
+    """
+    Schema = """
+        CREATE TABLE IF NOT EXISTS messages (
+            sha1 TEXT PRIMARY KEY, uid INTEGER, flags TEXT,
+            internaldate TEXT, folders TEXT);
+        CREATE TABLE IF NOT EXISTS folders (
+            name TEXT PRIMARY KEY, uidvalidity INTEGER, uidnext INTEGER,
+            "exists" INTEGER, recent INTEGER, highestmodseq INTEGER,
+            type TEXT, flags TEXT, uids TEXT, dupuids TEXT);
+        CREATE TABLE IF NOT EXISTS membership (
+            folder TEXT, uid INTEGER, sha1 TEXT, PRIMARY KEY (folder, uid));
+        """
+
+    def __init__(self, backupDir):
+        if sqlite3 is None:
+            raise ImportError("The sqlite3 module is not available")
+        self.dbFile = os.path.join(backupDir, "index.sqlite")
+        self.db = sqlite3.connect(self.dbFile)
+        self.db.text_factory = str
+        self.db.executescript(SqliteIndex.Schema)
+
+    def exists(self):
+        return self.db.execute("SELECT 1 FROM folders LIMIT 1").fetchone() is not None
+
+    def migrate(self, pickleIndex):
+        """One-shot import of the pickled indexes into an empty database"""
+        if self.exists() or not pickleIndex.exists():
+            return
+        status("Migrating %s and %s to %s\n" % (pickleIndex.msgIndexFile, pickleIndex.fldIndexFile, self.dbFile))
+        self.saveMsgs(pickleIndex.loadMsgs())
+        self.saveFlds(pickleIndex.loadFlds())
+
+    def loadMsgs(self):
+        messages = {}
+        for sha1, uid, flags, internaldate, folders in self.db.execute(
+                "SELECT sha1, uid, flags, internaldate, folders FROM messages"):
+            # EmailMsg.__init__ would query the server
+            msg = EmailMsg.__new__(EmailMsg)
+            msg.update({'sha1':sha1, 'uid':str(uid), 'flags':flags,
+                'internaldate':internaldate, 'folder':SqliteIndex.splitNames(folders)})
+            msg.OK = True
+            messages[sha1] = msg
+        return messages
+
+    def loadFlds(self):
+        flds = {}
+        for row in self.db.execute("SELECT * FROM folders"):
+            name, UIDVALIDITY, UIDNEXT, EXISTS, RECENT, HIGHESTMODSEQ, Type, FLAGS, uids, dupUids = row
+            folder = EmailFolder.__new__(EmailFolder)
+            for key, val in [('UIDVALIDITY', UIDVALIDITY), ('UIDNEXT', UIDNEXT),
+                    ('EXISTS', EXISTS), ('RECENT', RECENT), ('HIGHESTMODSEQ', HIGHESTMODSEQ)]:
+                if val is not None:
+                    folder[key] = val
+            folder['Type'] = frozenset(Type.split())
+            folder['FLAGS'] = tuple(FLAGS.split())
+            folder.OK = True
+            folder.name = name
+            folder.msgs = UidMap()
+            folder.UIDs = UidSet.parse(uids) if len(uids) else UidSet()
+            folder.dupUIDs = UidSet.parse(dupUids) if dupUids else UidSet()
+            folder.changedFlags = {}
+            flds[name] = folder
+
+        for name, uid, sha1 in self.db.execute("SELECT folder, uid, sha1 FROM membership"):
+            if flds.has_key(name):
+                flds[name].msgs[str(uid)] = sha1
+        return flds
+
+    def saveMsgs(self, messages):
+        """Writes the messages that were added, changed or removed"""
+        changed = []
+        gone = []
+        seen = set()
+        for row in self.db.execute("SELECT sha1, uid, flags, internaldate, folders FROM messages"):
+            sha1 = row[0]
+            if messages.has_key(sha1):
+                seen.add(sha1)
+                newRow = SqliteIndex.msgRow(sha1, messages[sha1])
+                if newRow != row:
+                    changed.append(newRow)
+            else:
+                gone.append((sha1,))
+
+        changed.extend([SqliteIndex.msgRow(sha1, msg) for sha1, msg in messages.items() if sha1 not in seen])
+
+        with self.db:
+            self.db.executemany("DELETE FROM messages WHERE sha1 = ?", gone)
+            self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)", changed)
+        logger.debug("Index: %d message(s) changed, %d removed" % (len(changed), len(gone)))
+
+    def addMsgs(self, messages):
+        """
+        Writes only the messages that are not in the index yet. The folders of
+        the messages already in the index are left alone until saveMsgs.
+        """
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)",
+                [SqliteIndex.msgRow(sha1, msg) for sha1, msg in messages.items()])
+        logger.debug("Index: %d message(s) added" % len(messages))
+
+    def saveFlds(self, flds):
+        """Writes the folders, and the folder messages, that changed"""
+        oldRows = {}
+        for row in self.db.execute("SELECT * FROM folders"):
+            oldRows[row[0]] = row
+
+        with self.db:
+            for name in [n for n in oldRows.keys() if not flds.has_key(n)]:
+                self.db.execute("DELETE FROM folders WHERE name = ?", (name,))
+                self.db.execute("DELETE FROM membership WHERE folder = ?", (name,))
+
+            for name, folder in flds.items():
+                row = SqliteIndex.fldRow(folder)
+                if row != oldRows.get(name):
+                    self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+
+                oldMsgs = dict([(str(uid), sha1) for uid, sha1 in self.db.execute(
+                    "SELECT uid, sha1 FROM membership WHERE folder = ?", (name,))])
+                gone = [(name, long(uid)) for uid in oldMsgs.keys() if not folder.msgs.has_key(uid)]
+                changed = [(name, long(uid), sha1) for uid, sha1 in folder.msgs.items() if oldMsgs.get(uid) != sha1]
+                self.db.executemany("DELETE FROM membership WHERE folder = ? AND uid = ?", gone)
+                self.db.executemany("INSERT OR REPLACE INTO membership VALUES (?, ?, ?)", changed)
+
+    def addFlds(self, replaced, added):
+        """Writes only the given folders (see PickleIndex.addFlds)"""
+        with self.db:
+            for name, folder in replaced.items():
+                self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", SqliteIndex.fldRow(folder))
+                self.db.execute("DELETE FROM membership WHERE folder = ?", (name,))
+                self.db.executemany("INSERT INTO membership VALUES (?, ?, ?)",
+                    [(name, long(uid), sha1) for uid, sha1 in folder.msgs.items()])
+
+            for name, (folder, entries) in added.items():
+                self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", SqliteIndex.fldRow(folder))
+                self.db.executemany("INSERT OR REPLACE INTO membership VALUES (?, ?, ?)",
+                    [(name, long(uid), sha1) for uid, sha1 in entries])
+
+    def rotate(self):
+        # Each save is a transaction. There is no partially written file to
+        # fall back from.
+        pass
+
+    @staticmethod
+    def msgRow(sha1, msg):
+        return (sha1, long(msg['uid']), msg['flags'], msg['internaldate'], '\n'.join(msg['folder']))
+
+    @staticmethod
+    def fldRow(folder):
+        return (folder.name, folder.get('UIDVALIDITY'), folder.get('UIDNEXT'),
+                folder.get('EXISTS'), folder.get('RECENT'), folder.get('HIGHESTMODSEQ'),
+                ' '.join(sorted(folder['Type'])), ' '.join(folder.get('FLAGS', ())),
+                str(UidSet.of(folder.UIDs)), str(folder.dupUIDs))
+
+    @staticmethod
+    def splitNames(names):
+        if len(names):
+            return names.split('\n')
+        return []
+
+
+def openIndex(backupDir, format):
+    """
+    Returns the index store of backupDir. If format is None, an existing SQLite
+    index is used, otherwise the pickles.
+    """
+    pickleIndex = PickleIndex(backupDir)
+    if format is None:
+        if os.path.exists(os.path.join(backupDir, "index.sqlite")):
+            format = 'sqlite'
+        else:
+            format = 'pickle'
+
+    if format == 'pickle':
+        return pickleIndex
+
+    index = SqliteIndex(backupDir)
+    index.migrate(pickleIndex)
+    return index
+
+
+def backup(server, backupDir, index):
     """
     Backs up the current state of the server. All messages are saved in
-    backupDir, and metadata goes in the msgIndexFile and fldIndexFile.
+    backupDir, and metadata goes in the index (see PickleIndex, SqliteIndex).
     """
 
     # If backupDir does not exist, nothing is saved, so create it first.
     if not os.path.exists(backupDir):
         os.makedirs(backupDir)
 
-    oldMsgs = deserialize(msgIndexFile)
-    oldFlds = deserialize(fldIndexFile)
-    rotateFile(msgIndexFile, 5)
-    rotateFile(fldIndexFile, 5)
+    oldMsgs = index.loadMsgs()
+    oldFlds = index.loadFlds()
+    index.rotate()
+
+    # Find the folders that haven't changed since the last backup
+    server.prescan([f for f in server.getFolders() if f not in server.IgnoredFolders])
+
+    budget = None
+    if options.maxDuration > 0 or options.maxBytes > 0:
+        budget = Budget(options.maxDuration * 60, options.maxBytes * 1024 * 1024)
 
-    messages, allMailFld = server.saveAllMsgs(backupDir, oldMsgs, oldFlds)
+    checkpoint = Checkpoint(index, options.checkpointMsgs, options.checkpointSecs, oldFlds)
+    messages, allMailFld = server.saveAllMsgs(backupDir, oldMsgs, oldFlds, checkpoint, budget)
     if len(messages) >= 0:
         # Save msgIndex first, in case we run into problems later
-        if len(msgIndexFile) > 0: serialize(msgIndexFile, messages)
+        checkpoint.update(allMailFld)
+        checkpoint.save(messages)
 
-        newFlds, messages = server.indexAllFolders(messages, oldFlds, allMailFld)
+        newFlds, messages = server.indexAllFolders(messages, oldFlds, allMailFld, checkpoint)
 
-        if len(msgIndexFile) > 0: serialize(msgIndexFile, messages)
-        if len(fldIndexFile) > 0: serialize(fldIndexFile, newFlds)
+        if len(allMailFld.msgs) < len(allMailFld.UIDs):
+            # Some messages were not downloaded (ex: the budget ran out). Keep
+            # them out of the other folders too, so the index stays consistent
+            # and the next backup indexes them along with the download.
+            for folder in newFlds.values():
+                for uid in [uid for uid, sha1 in folder.msgs.items() if not messages.has_key(sha1)]:
+                    del folder.msgs[uid]
+
+        index.saveMsgs(messages)
+        index.saveFlds(newFlds)
 
         #if len(messages) < 20:
         #    logger.debug(pprint.pformat(messages))
@@ -849,20 +4394,25 @@ def backup(server, backupDir, msgIndexFile, fldIndexFile):
         logger.info("Not enough messages to back up")
 
 
-def restore(server, backupDir, msgIndexFile, fldIndexFile):
+def restore(server, backupDir, index):
     """
     Restores messages from the local backup. For messages that are already on
-    the server, it restores the labels that were attached to the message when
-    the backup was made.
+    the server, it restores the labels and the flags that were attached to the
+    message when the backup was made.
     """
-    if not os.path.exists(backupDir) or not os.path.exists(msgIndexFile) or not os.path.exists(fldIndexFile):
+    if not os.path.exists(backupDir) or not index.exists():
         return False
 
-    oldMsgs = deserialize(msgIndexFile)
-    oldFlds = deserialize(fldIndexFile)
+    oldMsgs = index.loadMsgs()
+    oldFlds = index.loadFlds()
 
-    if not restoreAllMailFld(server, backupDir, oldMsgs, oldFlds[server.AllMailFolder]):
+    journal = RestoreJournal(backupDir)
+    pending = restoreAllMailFld(server, backupDir, oldMsgs, oldFlds[server.AllMailFolder], journal)
+    if pending is None:
         return False
+    pending = set(pending)
+
+    restoreFlags(server, oldMsgs, oldFlds[server.AllMailFolder])
 
     currFolderNames = server.getFolders()
     oldNames = oldFlds.keys()
@@ -892,8 +4442,7 @@ def restore(server, backupDir, msgIndexFile, fldIndexFile):
         if oldFld.sameUidVal(folder):
             # Great. No need to re-index this folder.
             logger.debug("Restoring %s by UID", folderName)
-            newUid = set(folder.UIDs)
-            msgUIDs = list(oldUid.difference(newUid))
+            msgUIDs = [uid for uid in oldUid if uid not in folder.UIDs]
             missingSha1 = [oldFld.msgs[uid] for uid in msgUIDs]
         else:
             # UIDVALIDITY changed. Need to re-index.
@@ -908,20 +4457,37 @@ def restore(server, backupDir, msgIndexFile, fldIndexFile):
                 updateLocalUIDs(oldFld, folder)
 
         server.select(server.AllMailFolder)
-        copied = 0
-
-        for sha1 in missingSha1:
-            # This assumes msg['uid'] has been updated to the current UID in AllMail
-            allMailUid = oldMsgs[sha1]['uid']
-            # Not copying all msgs with a single COPY command (COPY 1 5 8 Destination)
-            # b/c we lose fine grained error logging.
-            result, data = server.uid("COPY", allMailUid, folderName)
-            if result != 'OK':
-                logger.error("Failed to copy %s (UID: %s) to %s" % (sha1, allMailUid, folderName))
-            else:
-                copied += 1
 
-        if copied > 0:
+        # This assumes msg['uid'] has been updated to the current UID in AllMail.
+        # The UID of the pending messages could be another message's.
+        allMailUids = dict([(oldMsgs[sha1]['uid'], sha1) for sha1 in missingSha1 if sha1 not in pending])
+        if len(allMailUids) < len(missingSha1):
+            logger.warn("Not copying %d message(s) to %s until they are in %s" %
+                        (len(missingSha1) - len(allMailUids), folderName, server.AllMailFolder))
+        newUids, failed, uidValidity = server.copyMsgs(allMailUids.keys(), folderName)
+        for allMailUid in failed:
+            logger.error("Failed to copy %s (UID: %s) to %s" % (allMailUids[allMailUid], allMailUid, folderName))
+        copied = len(newUids)
+
+        # Key = SHA1, value = its new UID in the folder
+        sha2newUid = dict([(allMailUids[uid], newUid) for uid, newUid in newUids.items()])
+        if copied > 0 and None not in sha2newUid.values() and \
+           uidValidity is not None and int(uidValidity) == int(folder['UIDVALIDITY']):
+            # The server told us the new UIDs (COPYUID), no need to re-index
+            if oldFld.sameUidVal(folder):
+                for uid in msgUIDs:
+                    sha1 = oldFld.msgs[uid]
+                    if sha2newUid.has_key(sha1):
+                        del( oldFld.msgs[uid] )
+                        oldFld.msgs[ sha2newUid[sha1] ] = sha1
+                oldFld.UIDs = UidSet(oldFld.msgs.keys())
+            elif copied == len(missingSha1):
+                for sha1, newUid in sha2newUid.items():
+                    folder.msgs[newUid] = sha1
+                updateLocalUIDs(oldFld, folder)
+            # Otherwise, we'll continue restoring by SHA1 until all the messages
+            # have been restored, and then we'll call updateLocalUIDs()
+        elif copied > 0:
             # Need to figure out the new UID of the messages that were copied.
             # This is more expensive than it needs to be. Would be nice if the IMAP
             # COPY command returned the new UID, like the IMAP APPEND command does.
@@ -937,170 +4503,612 @@ def restore(server, backupDir, msgIndexFile, fldIndexFile):
                 # until all the messages have been restore, and then we'll call
                 # updateLocalUIDs()
                 folder = server.indexOneFolder(None, oldFld, folderName)
-                sha2newUid = folder.getSha2Uid()
                 for uid in oldUid:
                     sha1 = oldFld.msgs[uid]
-                    if uid != sha2newUid[sha1]:
+                    newUid = folder.msgs.uidOf(sha1)
+                    if newUid is not None and uid != newUid:
                         del( oldFld.msgs[uid] )
-                        oldFld.msgs[ sha2newUid[sha1] ] = sha1
-                oldFld.UIDs = list(oldFld.msgs.keys())
+                        oldFld.msgs[newUid] = sha1
+                oldFld.UIDs = UidSet(oldFld.msgs.keys())
 
         status("Copied %d/%d messages from %s to %s\n" % (copied, len(missingSha1), server.AllMailFolder, folderName))
 
-    serialize(fldIndexFile, oldFlds)
-    serialize(msgIndexFile, oldMsgs)
+    # The UIDs were changed locally, so the next backup can not rely on
+    # HIGHESTMODSEQ to find what changed on the server.
+    for oldFld in oldFlds.values():
+        oldFld.pop('HIGHESTMODSEQ', None)
+
+    index.saveFlds(oldFlds)
+    index.saveMsgs(oldMsgs)
+
+    # The index has the new UIDs now. The messages that are not in All Mail
+    # yet have none, and are looked for by SHA1 next time (see
+    # restoreAllMailFld).
+    journal.reset(pending)
 
 
 def updateLocalUIDs(oldFld, newFld):
     """
         Precondition: newFld must contain a superset of the messages in oldFld.
+        The messages that turn out not to be in newFld (the server doesn't
+        report the UIDs a COPY skipped) are dropped.
     """
-    sha2newUid = newFld.getSha2Uid()
-
     # Key = UID, value = SHA1
     oldSha1 = list(oldFld.msgs.values())
     oldFld.msgs.clear()
     for sha in oldSha1:
-        oldFld.msgs[ sha2newUid[sha] ] = sha
+        newUid = newFld.msgs.uidOf(sha)
+        if newUid is None:
+            logger.warn("%s is not in %s anymore" % (sha, newFld.name))
+            continue
+        oldFld.msgs[newUid] = sha
 
     oldFld['UIDVALIDITY'] = newFld['UIDVALIDITY']
-    oldFld.UIDs = list(oldFld.msgs.keys())
+    oldFld.UIDs = UidSet(oldFld.msgs.keys())
+
+
+def uploadAll(server, backupDir, msgs, destFolder, done=None):
+    """
+    Uploads msgs (see ImapServer.uploadMsgs) over up to options.connections
+    connections. Each connection takes options.appendBatch messages at a
+    time from a shared queue.
+
+    Returns a dict that maps the SHA1 of the messages uploaded => their new
+    UID (or None if unknown).
+    """
+    batchSz = max(options.appendBatch, 1)
+    batches = [msgs[start:start + batchSz] for start in range(0, len(msgs), batchSz)]
+    uploaded = {}
+    lock = threading.Lock()
+    def uploadedSome(msgUids, reported):
+        with lock:
+            for msg, newUid in msgUids:
+                reported[msg['sha1']] = newUid
+            if done is not None:
+                done(msgUids)
+
+    sessions = [server]
+    for n in range(1, min(options.connections, len(batches))):
+        try:
+            sessions.append(server.clone())
+        except:
+            logger.exception("Could not open upload connection %d" % n)
+
+    queue = Queue.Queue()
+    for batch in batches:
+        queue.put(batch)
+    # The sessions whose connection was lost
+    lost = set()
+
+    def work(session):
+        while True:
+            try:
+                batch = queue.get_nowait()
+            except Queue.Empty:
+                break
+            # Key = SHA1, value = new UID of the messages of this batch
+            # already uploaded
+            reported = {}
+            try:
+                newUids = session.uploadMsgs(backupDir, batch, destFolder,
+                                             lambda msgUids: uploadedSome(msgUids, reported))
+            except (socket.error, session.abort), e:
+                # Could not reconnect (see ImapServer.retry). The other
+                # connections can still upload the rest of the batch.
+                logger.error("Upload connection lost (%s)" % e)
+                lost.add(session)
+                rest = [msg for msg in batch if not reported.has_key(msg['sha1'])]
+                if len(rest):
+                    queue.put(rest)
+                with lock:
+                    uploaded.update(reported)
+                break
+            except:
+                logger.exception("Could not upload %d message(s)" % len(batch))
+                with lock:
+                    uploaded.update(reported)
+                continue
+            with lock:
+                uploaded.update(newUids)
+                progress('\r%.0f%% %d/%d ' % (len(uploaded) * 100.0 / len(msgs), len(uploaded), len(msgs)))
+
+    if len(sessions) > 1:
+        logger.info("Uploading %d message(s) over %d connections" % (len(msgs), len(sessions)))
+    workers = []
+    for session in sessions[1:]:
+        worker = threading.Thread(target=work, args=(session,))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    work(server)
+    for worker in workers:
+        worker.join()
+    # The rest of a batch whose connection was lost after the others were done
+    for session in sessions:
+        if session not in lost and not queue.empty():
+            work(session)
+
+    for session in sessions[1:]:
+        try:
+            session.logout()
+        except:
+            logger.exception("Closing upload connection")
+
+    if len(msgs):
+        status("\n", False)
+    return uploaded
 
 
-def restoreAllMailFld(server, backupDir, oldMsgs, oldFld):
+def restoreAllMailFld(server, backupDir, oldMsgs, oldFld, journal):
+    """
+    Uploads the messages missing from All Mail, and updates their UIDs in
+    oldFld. The messages the last restore left pending (see RestoreJournal)
+    are looked for by SHA1.
+
+    Returns the SHA1 of the messages left out of oldFld.msgs because they have
+    no UID under the current UIDVALIDITY (the upload failed, or the server
+    didn't give their UID), or None if All Mail could not be selected. oldFld
+    only holds UIDs the server reported.
+    """
     folder = EmailFolder(server, server.AllMailFolder)
     if not folder.OK:
         logger.warn("Unable to restore mail to %s", server.AllMailFolder)
-        return False
+        return None
+
+    def moved(oldUid, sha1, newUid):
+        if oldUid is not None:
+            del( oldFld.msgs[oldUid] )
+        oldFld.msgs[newUid] = sha1
+        oldMsgs[sha1]['uid'] = newUid
+
+    # The messages uploaded by a restore that was interrupted
+    resumed = journal.load(folder['UIDVALIDITY'])
+    # The messages the last restore could not upload, or find the UID of.
+    # Backups drop them from the index, since they're not on the server.
+    leftOut = set([sha1 for sha1 in journal.loadPending() if oldMsgs.has_key(sha1)])
 
     uploaded = 0
+    pending = []
     if oldFld.sameUidVal(folder):
-        oldUid = set(oldFld.msgs.keys())
-        newUid = set(folder.UIDs)
-
-        # Missing messages
-        msgUIDs = list(oldUid.difference(newUid))
-
-        for uid in msgUIDs:
-            sha1 = oldFld.msgs[uid]
-            newUid = server.upload(backupDir, oldMsgs[sha1], server.AllMailFolder)
-            if newUid is not None:
-                del( oldFld.msgs[uid] )
-                oldFld.msgs[newUid] = sha1
-                uploaded += 1
+        for uid, sha1 in oldFld.msgs.items():
+            if uid not in folder.UIDs and resumed.get(sha1) is not None and resumed[sha1] in folder.UIDs:
+                moved(uid, sha1, resumed[sha1])
+
+        # Missing messages. The ones already uploaded without getting their
+        # UID are not uploaded again, but their old UID is gone.
+        unknown = set([sha1 for sha1, uid in resumed.items() if uid is None])
+        missing = []
+        for uid in oldFld.msgs.keys():
+            if uid in folder.UIDs:
+                continue
+            if oldFld.msgs[uid] in unknown:
+                pending.append(oldFld.msgs[uid])
+                del oldFld.msgs[uid]
+            else:
+                missing.append((uid, oldFld.msgs[uid]))
+        for sha1 in leftOut.difference(oldFld.msgs.values()):
+            newUid = resumed.get(sha1)
+            if newUid is not None and newUid in folder.UIDs:
+                moved(None, sha1, newUid)
+            elif sha1 in unknown:
+                pending.append(sha1)
             else:
-                # TODO: Error handling
-                logger.error("Failed to upload SHA1 %s to AllMail folder" % sha1)
+                missing.append((None, sha1))
     else:
         folder = server.indexOneFolder(None, oldFld, server.AllMailFolder)
-        oldSha1 = set(oldFld.msgs.values())
-        newSha1 = set(folder.msgs.values())
-        missingSha1 = list(oldSha1.difference(newSha1))
-
-        sha2oldUid = {}
-        for key, val in oldFld.msgs.items():
-            sha2oldUid[val] = key
-
-        for sha1 in missingSha1:
-            newUid = server.upload(backupDir, oldMsgs[sha1], server.AllMailFolder)
-            if newUid is not None:
-                del( oldFld.msgs[ sha2oldUid[sha1] ] )
-                oldFld.msgs[newUid] = sha1
-                uploaded += 1
-            else:
-                # TODO: Error handling
-                logger.error("Failed to upload SHA1 %s to AllMail folder" % sha1)
 
-        oldFld.UIDs = list(oldFld.msgs.keys())
-        oldFld['UIDVALIDITY'] = folder['UIDVALIDITY']
+        # The old UIDs now belong to other messages. The messages still on the
+        # server (including the ones resumed) get their new UID, and the
+        # missing ones get one once they're uploaded.
+        oldSha1 = set(oldFld.msgs.values()).union(leftOut)
+        oldFld.msgs.clear()
+        missing = []
+        for sha1 in oldSha1:
+            newUid = folder.msgs.uidOf(sha1)
+            if newUid is None:
+                missing.append((None, sha1))
+            else:
+                moved(None, sha1, newUid)
+
+    if len(resumed):
+        logger.info("Resuming the restore of %s (%d message(s) already uploaded)" %
+                    (server.AllMailFolder, len(resumed)))
+
+    newUids = uploadAll(server, backupDir, [oldMsgs[sha1] for uid, sha1 in missing],
+                        server.AllMailFolder, lambda msgUids: journal.add(
+                            [(msg['sha1'], newUid) for msg, newUid in msgUids], folder['UIDVALIDITY']))
+    for uid, sha1 in missing:
+        if newUids.get(sha1) is not None:
+            moved(uid, sha1, newUids[sha1])
+            uploaded += 1
+            continue
+        elif newUids.has_key(sha1):
+            logger.warn("Uploaded SHA1 %s to AllMail folder, but its new UID is unknown" % sha1)
+            uploaded += 1
+        else:
+            # TODO: Error handling
+            logger.error("Failed to upload SHA1 %s to AllMail folder" % sha1)
+        if uid is not None:
+            # No longer on the server under its old UID
+            del oldFld.msgs[uid]
+        pending.append(sha1)
+
+    oldFld.UIDs = UidSet(oldFld.msgs.keys())
+    if not oldFld.sameUidVal(folder):
+        if len(pending):
+            logger.warn("Keeping the old UIDVALIDITY of %s until %d more message(s) are restored" %
+                        (server.AllMailFolder, len(pending)))
+        else:
+            oldFld['UIDVALIDITY'] = folder['UIDVALIDITY']
         # TODO: Copy other fields?
 
     status("Uploaded %d messages to %s\n" % (uploaded, server.AllMailFolder))
-    return True
+    return pending
+
+
+def restoreFlags(server, oldMsgs, oldFld):
+    """
+    Sets the flags of the messages in All Mail back to the ones they had when
+    the backup was made. GMail shares the flags of a message between all its
+    labels, so the other folders don't need it.
+    """
+    result, data = server.select(server.AllMailFolder)
+    if result != 'OK':
+        logger.warn("Unable to restore the flags in %s", server.AllMailFolder)
+        return
+
+    # \Recent can only be set by the server
+    def canonical(flags):
+        return ' '.join(sorted(set(flags.split()).difference(['\\Recent'])))
+
+    status("Retrieving the flags of %d message(s)\n" % len(oldFld.msgs))
+    current = server.fetchFlags(oldFld.msgs.keys(), options.batchSize)
+
+    # Key = UID, value = the flags it had when the backup was made
+    changed = {}
+    for uid, flags in current.items():
+        sha1 = oldFld.msgs.get(uid)
+        if sha1 is None or not oldMsgs.has_key(sha1):
+            continue
+        flags = canonical(flags)
+        oldFlags = canonical(oldMsgs[sha1]['flags'])
+        if flags != oldFlags:
+            changed[uid] = oldFlags
+
+    commands, failed = server.storeFlags(changed)
+    status("Restored the flags of %d/%d message(s) in %s (%d command(s))\n" %
+           (len(changed) - len(failed), len(changed), server.AllMailFolder, commands))
 
 
 def purgeCallBack(arg, dirname, fnames):
-    msgIndex = arg
+    msgIndex, backupDir = arg
     progress("\r%s" % dirname)
-    for fname in [f for f in fnames if not re.search('pickle(\.\d+)?$', f)]:
-        if not msgIndex.has_key(fname) and os.path.isfile(fname):
-            status("Deleting stale file %s" % fname)
+    MsgStore.skipPacks(fnames)
+    if os.path.normpath(os.path.dirname(dirname)) != os.path.normpath(backupDir) or \
+            not shardMatch.match(os.path.basename(dirname)):
+        # Only the shard directories hold messages. The index, BaGoMa.store,
+        # the restore journal, etc. are left alone.
+        return
+    for fname in fnames:
+        if fname.endswith('.part'):
+            # A large message to resume downloading (see saveLargeMsg), unless
+            # it was indexed since
+            stale = msgIndex.has_key(fname[:-len('.part')])
+        else:
+            stale = not msgIndex.has_key(MsgStore.parseName(fname)[0])
+        if stale and os.path.isfile(os.path.join(dirname, fname)):
+            status("Deleting stale file %s\n" % os.path.join(dirname, fname))
             if options.dryRun: continue
             os.remove(os.path.join(dirname, fname))
 
 
-def reindexCallBack(arg, dirname, fnames):
+def rehashInit():
+    # Processes started from scratch (Windows) don't go through main()
+    global logger
+    if 'logger' not in globals():
+        logger = logging.getLogger(__name__)
+        logger.addHandler(logging.StreamHandler())
+
+
+def rehashShard(args):
+    """
+    Re-computes the SHA1 of the messages saved in one shard of the backup
+    directory (the messages whose SHA1 starts with the same two characters),
+    from their headers only. args is (dir, msgs, packed) where dir is the
+    directory of the shard, msgs maps the SHA1 of the messages in the index
+    => their internaldate, and packed maps the SHA1 of the ones in pack files
+    => their location (see PackSet.locate). Runs in a separate process with
+    --processes (see reindex), so it doesn't open the MsgStore: that would
+    recover the packs the parent process is using (see recoverPacks).
+
+    Returns (count, mismatches, errors) where count is the number of
+    messages checked, mismatches is a list of (old SHA1, new SHA1) of the
+    messages saved under the wrong SHA1, and errors is a list of (SHA1,
+    error) of the messages that could not be read or parsed, or whose
+    internaldate in the index is not a valid INTERNALDATE.
+    """
+    dir, msgs, packed = args
+
+    # Key = sha1, value = (path, format, offset, length)
+    locations = {}
+    for sha1, (path, offset, length, fmt) in packed.iteritems():
+        locations[sha1] = (path, fmt, offset, length)
+    if os.path.isdir(dir):
+        for fname in os.listdir(dir):
+            sha1, fmt = MsgStore.parseName(fname)
+            path = os.path.join(dir, fname)
+            # Files win over packs, and empty files don't count (see MsgStore.find)
+            if fmt is not None and msgs.has_key(sha1) and os.path.getsize(path) > 0:
+                locations[sha1] = (path, fmt, 0, None)
+
+    mismatches = []
+    errors = []
+    for oldSha1 in sorted(locations.keys()):
+        try:
+            # The SHA1 was computed from the INTERNALDATE string the server
+            # gave. One mangled in the index would make every message look
+            # saved under the wrong SHA1, and get renamed.
+            internaldate = msgs[oldSha1]
+            try:
+                valid = imaplib.Internaldate2tuple('INTERNALDATE "%s"' % internaldate) is not None
+            except (KeyError, ValueError, OverflowError):
+                valid = False
+            if not valid:
+                raise ValueError("Invalid internaldate in the index: %r" % (internaldate,))
+            headers = MsgStore.readHeadersAt(*locations[oldSha1])
+            if headers.startswith('>From - '):
+                # Broken headers that will trip up HeaderParser
+                headers = headers[headers.find('\n') + 1:]
+            pMsg = HeaderParser().parsestr(headers, headersonly=True)
+            sha1 = EmailMsg.computeSha1(internaldate, pMsg)
+        except Exception, e:
+            errors.append((oldSha1, str(e)))
+            continue
+        if sha1 != oldSha1:
+            mismatches.append((oldSha1, sha1))
+    return (len(locations), mismatches, errors)
+
+
+def reindex(backupDir, msgIndex, fldIndex):
     """
         Verifies that all files on disk are saved with the proper name (sha1).
 
         This function is useful if we ever change how the SHA1 is computed. It
         allows us to re-index the local storage and adjust our structures
         without having to re-download all the mail.
-    """
-    (msgIndex, fldIndex, backupDir) = arg
-    progress("\r%s" % dirname)
-    for oldSha1 in [f for f in fnames if msgIndex.has_key(f)]:
-        msg = msgIndex[oldSha1]
-        fp = open(os.path.join(dirname, oldSha1), 'r')
 
-        firstLine = fp.readline()
-        if firstLine.startswith('>From - '):
-            # Broken headers that will trip up HeaderParser
-            pass
-        else:
-            fp.seek(0)
+        The SHA1s are computed by options.processes processes, one shard
+        (sha1[0:2]) at a time. The store is only opened by this process,
+        which hands each shard its directory and where its packed messages
+        are. The files saved under the wrong SHA1 are then renamed, and the
+        index updated, by this process only.
+    """
+    store = msgStore(backupDir)
+    # Key = SHA1 prefix, value = {sha1: internaldate}
+    shards = {}
+    for sha1, msg in msgIndex.iteritems():
+        shards.setdefault(sha1[0:2], {})[sha1] = msg['internaldate']
+    # Key = SHA1 prefix, value = {sha1: location in the packs}
+    packed = {}
+    for sha1 in store.packed():
+        if msgIndex.has_key(sha1):
+            packed.setdefault(sha1[0:2], {})[sha1] = store.packs.locate(sha1)
+    tasks = [(os.path.join(backupDir, prefix), shards[prefix], packed.get(prefix, {}))
+             for prefix in sorted(shards.keys())]
+
+    pool = None
+    if options.processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(options.processes, len(tasks)), rehashInit)
+        results = pool.imap_unordered(rehashShard, tasks)
+    else:
+        results = (rehashShard(task) for task in tasks)
 
-        parser = HeaderParser()
-        pMsg = parser.parse(fp, headersonly=True)
-        fp.close()
-        sha1 = EmailMsg.computeSha1(msg['internaldate'], pMsg)
-        if sha1 != oldSha1:
-            # If the message is malformed, the parser could fail here, even
-            # though it succeeded in EmailMsg.__init__ because in EmailMsg the
-            # full headers were parsed by Google, and here by HeaderParser.
-            logger.debug("Mismatch %s vs %s", sha1, oldSha1)
-            set_trace()
-            fp = open(os.path.join(dirname, oldSha1), 'r')
-            parser = HeaderParser()
-            pMsg = parser.parse(fp, headersonly=True)
-            fp.close()
-            sha1 = EmailMsg.computeSha1(msg['internaldate'], pMsg)
+    start = time.time()
+    count = 0
+    mismatches = []
+    try:
+        for shardCount, shardMismatches, errors in results:
+            count += shardCount
+            mismatches.extend(shardMismatches)
+            for sha1, error in errors:
+                logger.warn("Could not re-compute the SHA1 of %s: %s" % (sha1, error))
+            elapsed = max(time.time() - start, 0.001)
+            progress("\r%d file(s) (%.0f files/s) " % (count, count / elapsed))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    elapsed = max(time.time() - start, 0.001)
+    status("\nRe-hashed %d file(s) in %.0f second(s) (%.0f files/s). %d saved under the wrong SHA1.\n" %
+           (count, elapsed, count / elapsed, len(mismatches)))
+
+    for oldSha1, sha1 in mismatches:
+        # If the message is malformed, the parser could fail here, even
+        # though it succeeded in EmailMsg.__init__ because in EmailMsg the
+        # full headers were parsed by Google, and here by HeaderParser.
+        logger.debug("Mismatch %s vs %s", sha1, oldSha1)
+        if options.dryRun: continue
 
-            if options.dryRun: continue
+        msg = msgIndex[oldSha1]
+        EmailMsg.move(oldSha1, sha1, backupDir)
+        msgIndex[sha1] = msg
+        del( msgIndex[oldSha1] )
+        for folder in msg['folder']:
+            for UID in fldIndex[folder].msgs.uidsOf(oldSha1):
+                fldIndex[folder].msgs[UID] = sha1
 
-            EmailMsg.move(oldSha1, sha1, backupDir)
-            msgIndex[sha1] = msg
-            del( msgIndex[oldSha1] )
-            for folder in msgIndex[sha1]['folder']:
-                for UID in [item[0] for item in fldIndex[folder].msgs.items() if item[1] is oldSha1]:
-                    fldIndex[folder].msgs[UID] = sha1
-        else:
-            pass
-            #logger.debug("Good match %s %s" % (dirname, sha1))
 
+def houseKeeping(backupDir, index, purge):
+    msgIndex = index.loadMsgs()
 
-def houseKeeping(backupDir, msgIndexFile, fldIndexFile, purge):
-    msgIndex = deserialize(msgIndexFile)
+    store = msgStore(backupDir)
 
     if purge:
         status("Purging stale messages\n")
-        os.path.walk(backupDir, purgeCallBack, msgIndex)
+        os.path.walk(backupDir, purgeCallBack, (msgIndex, backupDir))
+        for sha1 in [sha1 for sha1 in store.packed() if not msgIndex.has_key(sha1)]:
+            status("Deleting stale message %s\n" % sha1)
+            if options.dryRun: continue
+            store.remove(sha1)
+        if not options.dryRun:
+            store.sync()
+            store.pruneSums(msgIndex)
         status("\n", False)
     else:
         status("Re-indexing local messages\n")
-        fldIndex = deserialize(fldIndexFile)
-        os.path.walk(backupDir, reindexCallBack, (msgIndex, fldIndex, backupDir))
-        status("\n", False)
+        fldIndex = index.loadFlds()
+        reindex(backupDir, msgIndex, fldIndex)
         if options.dryRun: return
-        serialize(msgIndexFile, msgIndex)
-        serialize(fldIndexFile, fldIndex)
+        index.saveMsgs(msgIndex)
+        index.saveFlds(fldIndex)
+
+
+def convertMsg(store, totals, packs, sha1, data, fmt, path=None):
+    """
+    Re-writes one message (data, in the given format) in the store's format:
+    to packs, or to a file if packs is None. path is the file the message is
+    in (None if it's packed). Returns True if the message was re-written.
+    Messages that don't match the checksum they were saved with are reported,
+    and the ones that can't be decompressed are kept as they are.
+    """
+    start = time.time()
+    try:
+        raw = MsgStore.decompress(data, fmt)
+    except Exception, e:
+        logger.warn("Message %s is corrupted: %s" % (sha1, e))
+        totals['corrupted'] += 1
+        totals['msgs'] += 1
+        totals['stored'] += len(data)
+        if options.dryRun or path is not None:
+            return False
+        if packs is not None:
+            packs.append(sha1, data, fmt)
+        else:
+            store.makeDir(os.path.dirname(store.path(sha1, fmt)))
+            with open(store.path(sha1, fmt), 'wb') as f:
+                f.write(data)
+        return True
+    digest = store.checksum(sha1)
+    if digest is not None and hashlib.sha1(raw).hexdigest() != digest:
+        logger.warn("Message %s is corrupted: its contents changed since it was saved" % sha1)
+        # Converted as it is
+        totals['corrupted'] += 1
+    totals['readTime'] += time.time() - start
+    totals['msgs'] += 1
+    totals['raw'] += len(raw)
+
+    if options.dryRun or (packs is None and path is not None and fmt == store.format):
+        # Nothing to convert
+        totals['stored'] += len(data)
+        return False
+
+    start = time.time()
+    if fmt != store.format:
+        data = MsgStore.compress(raw, store.format)
+    if packs is not None:
+        packs.append(sha1, data, store.format)
+    else:
+        with store.create(sha1, compressed=True) as f:
+            f.write(data)
+    totals['writeTime'] += time.time() - start
+    totals['written'] += len(raw)
+    totals['stored'] += len(data)
+    totals['converted'] += 1
+    return True
+
+
+def convertCallBack(arg, dirname, fnames):
+    (store, totals, packs) = arg
+    progress("\r%s" % dirname)
+    MsgStore.skipPacks(fnames)
+    if dirname == store.backupDir:
+        return
+
+    converted = []
+    for fname in fnames:
+        sha1, fmt = MsgStore.parseName(fname)
+        path = os.path.join(dirname, fname)
+        if fmt is None or not os.path.isfile(path):
+            continue
+        if packs is not None and sha1 in packs:
+            # Packed already (see convertStore)
+            continue
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        if convertMsg(store, totals, packs, sha1, data, fmt, path) and packs is None and \
+                path != store.path(sha1):
+            converted.append(path)
+
+    # Packed files are removed once the new packs are in place (see
+    # removePackedCallBack), the others once the new files are on disk.
+    store.sync()
+    for path in converted:
+        os.remove(path)
+
+
+def removePackedCallBack(store, dirname, fnames):
+    MsgStore.skipPacks(fnames)
+    if dirname == store.backupDir:
+        return
+
+    removed = False
+    for fname in fnames:
+        sha1, fmt = MsgStore.parseName(fname)
+        if fmt is not None and sha1 in store.packs:
+            os.remove(os.path.join(dirname, fname))
+            removed = True
+    if removed and not os.listdir(dirname):
+        os.rmdir(dirname)
 
 
-def createMaildir(backupDir, msgIndexFile, emailAddr, maildir):
+def convertStore(backupDir):
+    """
+    Converts the messages to the format and layout of the backup directory (see
+    MsgStore.setFormat, MsgStore.setLayout), and reports how well the messages
+    compress. With the pack layout, all the messages (including the packed
+    ones) are re-packed, which reclaims the space of the removed messages.
+    """
+    store = msgStore(backupDir)
+    totals = {'msgs':0, 'converted':0, 'corrupted':0, 'raw':0, 'stored':0, 'written':0, 'readTime':0.0, 'writeTime':0.0}
+    status("Converting local messages to: %s, %s\n" % (store.format, store.layout))
+
+    if store.layout == 'pack':
+        packs = store.newPacks()
+        for sha1 in store.packed():
+            data, fmt = store.packs.read(sha1)
+            convertMsg(store, totals, packs, sha1, data, fmt)
+        os.path.walk(backupDir, convertCallBack, (store, totals, packs))
+        if not options.dryRun:
+            store.swapPacks(packs)
+            os.path.walk(backupDir, removePackedCallBack, store)
+    else:
+        os.path.walk(backupDir, convertCallBack, (store, totals, None))
+        for sha1 in [sha1 for sha1 in store.packed() if store.find(sha1)[0] is None]:
+            data, fmt = store.packs.read(sha1)
+            convertMsg(store, totals, None, sha1, data, fmt)
+        if not options.dryRun and len(store.packs):
+            store.swapPacks(store.newPacks())
+    status("\n", False)
+
+    MB = 1024.0 * 1024
+    status("%d message(s), %.1f MB stored in %.1f MB (ratio %.2f). Converted %d message(s).\n" %
+           (totals['msgs'], totals['raw'] / MB, totals['stored'] / MB,
+            totals['raw'] / max(totals['stored'], 1.0), totals['converted']))
+    if totals['corrupted']:
+        logger.error("%d message(s) are corrupted (see above)" % totals['corrupted'])
+    status("Read %.1f MB/s, wrote %.1f MB/s\n" %
+           (totals['raw'] / MB / max(totals['readTime'], 0.001),
+            totals['written'] / MB / max(totals['writeTime'], 0.001)))
+
+
+def createMaildir(backupDir, index, emailAddr, maildir):
     """
     Creates a Maildir type directory and sym-links all the backed-up email
     messages into it so that the mail can be inspected using a mail reader that
-    supports Maildir directly (ex: mutt).
+    supports Maildir directly (ex: mutt). Compressed and packed messages (see
+    MsgStore) are copied uncompressed instead.
 
     CAVEAT LECTOR: Any modifications made by the mail reader may corrupt the
     backup. BaGoMa will not check for local modifications. Renaming, moving, or
@@ -1115,8 +5123,7 @@ def createMaildir(backupDir, msgIndexFile, emailAddr, maildir):
     properly.
 
     @param backupDir The directory containing the backed up email
-    @param msgIndexFile
-    @param fldIndexFile
+    @param index The message index store (see openIndex)
     @param emailAddr Used to extract the host/domain name
     @param maildir The path to the Maildir type directory to be created. Must
     not exist, or the function will refuse to overwrite it.
@@ -1126,7 +5133,7 @@ def createMaildir(backupDir, msgIndexFile, emailAddr, maildir):
         logger.error("Maildir '%s' already exists. Refusing to overwrite." % (maildir))
         return
 
-    msgIndex = deserialize(msgIndexFile)
+    msgIndex = index.loadMsgs()
     hostname = emailMatch.search(emailAddr).group(3).lower()
     timestamp = int(time.time())
     deliveryId = 0
@@ -1134,11 +5141,14 @@ def createMaildir(backupDir, msgIndexFile, emailAddr, maildir):
     flagMap = {'\\Flagged' : 'F', '\\Seen' : 'S'}   # Gmail->Maildir mapping
     status("Creating Maildir '%s' for %d message(s).\n" % (maildir, msgCnt))
 
+    store = msgStore(backupDir)
     for (sha1, msg) in msgIndex.items():
-        srcFile = os.path.abspath( os.path.join(backupDir, sha1[0:2], sha1) )
-        if not os.path.exists(srcFile):
-            logger.debug("Skipping missing file/email: %s" % (srcFile))
+        srcFile, fmt = store.find(sha1)
+        if srcFile is None and not sha1 in store.packs:
+            logger.debug("Skipping missing file/email: %s" % (store.path(sha1)))
             continue
+        if srcFile is not None:
+            srcFile = os.path.abspath(srcFile)
 
         flags = list()
         for flag in msg['flags'].split(' '):
@@ -1157,21 +5167,25 @@ def createMaildir(backupDir, msgIndexFile, emailAddr, maildir):
                     os.makedirs(os.path.join(destDir, subDir), mode=0775)
             destDir = os.path.join(destDir, 'cur')
             msgLink = "%d.%06d_0.%s:2,%s" % (timestamp, deliveryId, hostname, flags)
-            os.symlink(srcFile, os.path.join(destDir, msgLink))
+            if fmt == 'none':
+                os.symlink(srcFile, os.path.join(destDir, msgLink))
+            else:
+                with open(os.path.join(destDir, msgLink), 'wb') as f:
+                    f.write(store.read(sha1))
             timestamp -= 1
 
         deliveryId += 1
         progress('\r%.0f%% %d/%d ' % (deliveryId * 100.0 /msgCnt, deliveryId, msgCnt))
 
 
-def interact(msgIndexFile, fldIndexFile):
+def interact(index):
     global server, options
 
-    msgIndex = deserialize(msgIndexFile)
-    fldIndex = deserialize(fldIndexFile)
+    msgIndex = index.loadMsgs()
+    fldIndex = index.loadFlds()
 
     if server is None:
-        server = ImapServer(options.server, options.port, options.email, options.pwd)
+        server = ImapServer(options.server, options.port, options.email, options.pwd, not options.noDeflate)
 
     server.select(server.AllMailFolder, readonly=True)
     banner = '\nBaGoMa server instance is "s"';
@@ -1265,6 +5279,10 @@ def main(argv=None):
     parser.add_argument("--dryRun", default=False, action="store_true",
                         help="When combined with \"compact\", shows what files \
                         would be deleted [default: %(default)s]")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="The number of processes used by the \"compact\" \
+                        action to re-compute the SHA1 of the saved messages \
+                        [default: %(default)s]")
     parser.add_argument("--gui", default=False, action="store_true",
                         help="Used when launched by the GUI.")
     parser.add_argument("-s", "--server",
@@ -1275,6 +5293,76 @@ def main(argv=None):
     parser.add_argument("-m", "--maildir", dest="maildir", default="Maildir.BaGoMa",
                         help="Used with the \"maildir\" action to specify where \
                         to create the Maildir directory [default: %(default)s]")
+    parser.add_argument("--batch", dest="batchSize", type=int, default=500,
+                        help="The number of message headers to retrieve with \
+                        each IMAP FETCH command [default: %(default)s]")
+    parser.add_argument("--appendBatch", type=int, default=20,
+                        help="The most messages a restore uploads with each \
+                        APPEND command, if the server supports MULTIAPPEND. \
+                        If the connection drops, they're all sent again \
+                        [default: %(default)s]")
+    parser.add_argument("--appendSize", type=int, default=10240,
+                        help="The most KB a restore uploads with each APPEND \
+                        command (except for messages larger than that, which \
+                        are sent by themselves) [default: %(default)s]")
+    parser.add_argument("--connections", type=int, default=1,
+                        help="The number of server connections used to \
+                        download messages and index folders (or upload \
+                        messages) in parallel [default: %(default)s]")
+    parser.add_argument("--engine", default="sync", choices=['sync', 'pipelined'],
+                        help="Send the UID FETCH commands one at a time (sync) \
+                        or up to %d ahead (pipelined) [default: %%(default)s]" % ImapServer.PipelineDepth)
+    parser.add_argument("--order", default="uid", choices=['uid', 'newest', 'smallest', 'balanced'],
+                        help="The order new messages are downloaded in: \
+                        uid, newest, smallest or balanced (alternating \
+                        between newest and smallest) [default: %(default)s]")
+    parser.add_argument("--maxDuration", type=int, default=0,
+                        help="Stop downloading new messages after this many \
+                        minutes. The rest are downloaded by the next backup \
+                        (0 for no limit) [default: %(default)s]")
+    parser.add_argument("--maxBytes", type=int, default=0,
+                        help="Stop downloading new messages after this many \
+                        MB (0 for no limit) [default: %(default)s]")
+    parser.add_argument("--reconnects", type=int, default=5,
+                        help="How many times to reconnect (waiting longer \
+                        each time) if the connection to the server drops, \
+                        before giving up [default: %(default)s]")
+    parser.add_argument("--noDeflate", default=False, action="store_true",
+                        help="Don't compress the traffic with the server, \
+                        even if it supports COMPRESS=DEFLATE \
+                        [default: %(default)s]")
+    parser.add_argument("--largeMsgSize", type=int, default=10240,
+                        help="Download messages larger than this many KB \
+                        in chunks, so an interrupted download can resume \
+                        (0 to disable) [default: %(default)s]")
+    parser.add_argument("--chunkSize", type=int, default=1024,
+                        help="The size in KB of the chunks large messages \
+                        are downloaded in [default: %(default)s]")
+    parser.add_argument("--checkpoint", dest="checkpointMsgs", type=int, default=5000,
+                        help="Save the partial index of a backup every N \
+                        messages, so an interrupted backup can resume from \
+                        there (0 to disable) [default: %(default)s]")
+    parser.add_argument("--checkpointTime", dest="checkpointSecs", type=int, default=300,
+                        help="Also save the partial index every N seconds \
+                        (0 to disable) [default: %(default)s]")
+    parser.add_argument("--compress", default=None, choices=MsgStore.available(),
+                        help="Compress the messages saved in the backup \
+                        directory with this format (%s). The format is \
+                        remembered for the directory, and the \"compact\" \
+                        action converts the existing messages to it \
+                        [default: the directory's format, or none]" % ', '.join(MsgStore.available()))
+    parser.add_argument("--layout", default=None, choices=MsgStore.Layouts,
+                        help="How to store the messages in the backup \
+                        directory: files (one file per message) or pack \
+                        (appended to a few large pack files). The layout is \
+                        remembered for the directory, and the \"compact\" \
+                        action converts the existing messages to it \
+                        [default: the directory's layout, or files]")
+    parser.add_argument("--index", default=None, choices=['pickle', 'sqlite'],
+                        help="How to store the message and folder index: \
+                        pickle or sqlite. Existing pickles are migrated to a \
+                        new sqlite index [default: sqlite if the backup \
+                        directory has one, otherwise pickle]")
     parser.add_argument("-l", "--log", dest="logLevel", default="WARNING",
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help="The console log level (DEBUG, INFO, WARNING, ERROR, CRITICAL) [default: %(default)s]")
@@ -1315,9 +5403,6 @@ def main(argv=None):
     else:
         progress = progressCli
 
-    msgIndexFile = os.path.join(options.backupDir, "msgIndex.pickle")
-    fldIndexFile = os.path.join(options.backupDir, "fldIndex.pickle")
-
     lock = LockFile(os.path.join(options.backupDir, "BaGoMa"))
     if lock.is_locked():
         logger.error("Failed to acquire application lock. Another BaGoMa instance is running.")
@@ -1326,33 +5411,49 @@ def main(argv=None):
         with lock:
 
             server = None
+            index = openIndex(options.backupDir, options.index)
+            if options.compress is not None:
+                msgStore(options.backupDir).setFormat(options.compress)
+            if options.layout is not None:
+                msgStore(options.backupDir).setLayout(options.layout)
             if options.action == "backup":
-                server = ImapServer(options.server, options.port, options.email, options.pwd)
-                backup(server, options.backupDir, msgIndexFile, fldIndexFile)
+                server = ImapServer(options.server, options.port, options.email, options.pwd, not options.noDeflate)
+                backup(server, options.backupDir, index)
             elif options.action == "restore":
-                server = ImapServer(options.server, options.port, options.email, options.pwd)
-                restore(server, options.backupDir, msgIndexFile, fldIndexFile)
+                server = ImapServer(options.server, options.port, options.email, options.pwd, not options.noDeflate)
+                restore(server, options.backupDir, index)
             elif options.action == "compact":
-                houseKeeping(options.backupDir, msgIndexFile, fldIndexFile, True)
-                houseKeeping(options.backupDir, msgIndexFile, fldIndexFile, False)
+                houseKeeping(options.backupDir, index, True)
+                houseKeeping(options.backupDir, index, False)
+                convertStore(options.backupDir)
             elif options.action == "printIndex":
-                status(deserialize(msgIndexFile))
+                status(index.loadMsgs())
                 status("\n\n")
-                status(deserialize(fldIndexFile))
+                status(index.loadFlds())
             elif options.action == "stats":
-                Stats.extractStats(options.backupDir, msgIndexFile, fldIndexFile)
+                Stats.extractStats(options.backupDir, index)
             elif options.action == "maildir":
-                createMaildir(options.backupDir, msgIndexFile, options.email, options.maildir)
+                createMaildir(options.backupDir, index, options.email, options.maildir)
             elif options.action == "debug":
-                interact(msgIndexFile, fldIndexFile)
+                interact(index)
 
             if server is not None:
                 try:
-                    server.close()
+                    # Unchanged folders are never selected (see prescan)
+                    if server.state == 'SELECTED':
+                        server.close()
                     server.logout()
                 except:
                     logger.exception("Closing server connection")
 
+    if ImapServer.PlainBytes:
+        status("\nCompression: %d KB sent and received for %d KB of data (%.0f%% saved).\n" %
+               (ImapServer.WireBytes / 1024, ImapServer.PlainBytes / 1024,
+                100 - ImapServer.WireBytes * 100.0 / ImapServer.PlainBytes))
+    if ImapServer.Pacer.throttled:
+        status("\n%s.\n" % ImapServer.Pacer)
+    if ImapServer.Reconnects:
+        status("\nReconnected %d time(s), %.0f second(s) lost.\n" % (ImapServer.Reconnects, ImapServer.LostTime))
     status('\nDone.\n')
 
 
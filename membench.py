@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""
+Memory benchmark for the BaGoMa message/folder indexes.
+
+Builds a synthetic index (messages in All Mail, each also in a few other
+folders) once with the structures used by older versions (EmailMsg as a dict,
+EmailFolder.msgs as a dict of strings) and once with the current ones
+(EmailMsg with __slots__, UidMap), and reports the memory and the pickle size
+of each. Every index is built in a separate process so that the memory used by
+one does not hide the other's.
+
+usage: membench.py [messages] [folders]
+"""
+
+import sys
+import os
+import time
+import random
+import hashlib
+import resource
+import subprocess
+import cPickle as pickle
+from binascii import hexlify, unhexlify
+
+import bagoma
+
+FLAGS = ['\\Seen', '', '\\Flagged', '\\Seen \\Flagged', '\\Answered \\Seen']
+
+
+class LegacyMsg(dict):
+    """EmailMsg before it had __slots__"""
+    pass
+
+
+def maxRss():
+    """Peak resident memory, in KB"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss
+
+
+def build(kind, msgCnt, fldCnt):
+    random.seed(1)
+    folderNames = ['[Gmail]/All Mail'] + ['Folder%02d' % i for i in range(fldCnt)]
+    messages = {}
+    flds = dict([(name, {} if kind == 'legacy' else bagoma.UidMap()) for name in folderNames])
+    nextUid = dict([(name, 1) for name in folderNames])
+
+    for i in xrange(msgCnt):
+        sha1 = hashlib.sha1(str(i)).hexdigest()
+        folders = ['[Gmail]/All Mail'] + random.sample(folderNames[1:], random.randint(0, 3))
+        fields = {'sha1':sha1, 'uid':str(i + 1), 'flags':random.choice(FLAGS),
+                  'internaldate':time.strftime('%d-%b-%Y %H:%M:%S +0000', time.gmtime(1e9 + i * 600)),
+                  'folder':folders}
+
+        if kind == 'legacy':
+            msg = LegacyMsg(fields)
+        else:
+            msg = bagoma.EmailMsg.__new__(bagoma.EmailMsg)
+            msg.update(fields)
+        msg.OK = True
+        messages[sha1] = msg
+
+        for name in folders:
+            # The folder index is a separate pickle, so after loading it, its
+            # SHA1s are not the same objects as the msgIndex ones.
+            flds[name][str(nextUid[name])] = hexlify(unhexlify(sha1))
+            nextUid[name] += 1
+
+    return (messages, flds)
+
+
+def child(kind, msgCnt, fldCnt):
+    before = maxRss()
+    start = time.time()
+    messages, flds = build(kind, msgCnt, fldCnt)
+    elapsed = time.time() - start
+    used = maxRss() - before
+
+    size = len(pickle.dumps(messages, pickle.HIGHEST_PROTOCOL)) + \
+           len(pickle.dumps(flds, pickle.HIGHEST_PROTOCOL))
+    print "%d %d %.1f" % (used, size / 1024, elapsed)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        return
+
+    msgCnt = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    fldCnt = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print "%d messages, %d folders" % (msgCnt, fldCnt)
+    print "%-8s %12s %12s %8s" % ('', 'Memory (KB)', 'Pickle (KB)', 'Build (s)')
+
+    results = {}
+    for kind in ('legacy', 'compact'):
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       '--child', kind, str(msgCnt), str(fldCnt)])
+        used, size, elapsed = out.split()
+        results[kind] = int(used)
+        print "%-8s %12s %12s %8s" % (kind, used, size, elapsed)
+
+    print "Memory ratio: %.1fx" % (float(results['legacy']) / max(results['compact'], 1))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,643 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""
+A scripted IMAP server for the tests. It speaks enough of IMAP4rev1, of the
+extensions BaGoMa uses and of GMail's own to run an ImapServer against it
+over a socket pair, without a network.
+
+    account = Account()
+    account.deliver(Message(1), ['INBOX'])
+    server = connect(account)
+
+Each connection is served by a thread of its own, and all of them share the
+Account, so a reconnected or cloned session sees the same folders.
+"""
+
+import re
+import zlib
+import select
+import socket
+import argparse
+import threading
+from email.parser import HeaderParser
+
+import bagoma
+from bagoma import ImapServer, EmailMsg
+
+# Key = host name, value = the Account a FakeImapServer connecting to it gets
+accounts = {}
+
+AllMail = '[Gmail]/All Mail'
+
+
+def makeOptions(**kwargs):
+    """The options main() sets up, with their default values"""
+    values = dict(action='backup', appendBatch=20, appendSize=10240, backupDir=None,
+                  batchSize=500, checkpointMsgs=5000, checkpointSecs=300, chunkSize=1024,
+                  compress=None, configFile='.BaGoMa', connections=1, dryRun=False,
+                  email='me@example.com', engine='sync', gui=False, index=None,
+                  largeMsgSize=10240, layout=None, logFile='off', logLevel='WARNING',
+                  maildir='Maildir.BaGoMa', maxBytes=0, maxDuration=0, noDeflate=False,
+                  order='uid', port=993, processes=1, pwd='secret', reconnects=5,
+                  server='imap.example.com', version=False)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+class Message(object):
+    """
+    A message of the account. GMail keeps a single copy of each message: the
+    same Message is in every folder it has the label of.
+    """
+    def __init__(self, n=0, body=None, date=None, flags='', size=0):
+        if body is None:
+            body = ('From: Sender %d <sender%d@example.com>\r\n'
+                    'To: me@example.com\r\n'
+                    'Subject: Message %d\r\n'
+                    'Date: Tue, 17 Jul 2012 02:44:25 +0000\r\n'
+                    'Message-ID: <%d@example.com>\r\n'
+                    '\r\n'
+                    'Body of message %d\r\n' % (n, n, n, n, n))
+            body += 'x' * max(size - len(body), 0)
+        if date is None:
+            date = '%02d-Jul-2012 %02d:%02d:%02d +0000' % (n / 3600 % 28 + 1, n / 3600 % 24, n / 60 % 60, n % 60)
+        self.body = body
+        self.date = date
+        self.flags = flags
+        self.msgId = 1000 + n
+        self.modseq = 1
+
+    def headers(self, names=None):
+        """The header lines of the message (only those in names, if given), followed by an empty line"""
+        lines = []
+        for line in self.body.split('\r\n\r\n', 1)[0].split('\r\n'):
+            if line[:1] in (' ', '\t') and len(lines):
+                lines[-1] += '\r\n' + line
+            else:
+                lines.append(line)
+        if names is not None:
+            lines = [l for l in lines if l.split(':', 1)[0].upper() in names]
+        return ''.join([l + '\r\n' for l in lines]) + '\r\n'
+
+    def sha1(self):
+        """The SHA1 BaGoMa gives the message"""
+        return EmailMsg.computeSha1(self.date, HeaderParser().parsestr(self.headers(), headersonly=True))
+
+
+class Mailbox(object):
+    def __init__(self, name, flags='\\HasNoChildren', uidValidity=1):
+        self.name = name
+        self.flags = flags
+        self.uidValidity = uidValidity
+        self.uidNext = 1
+        # (uid, Message) in UID order
+        self.msgs = []
+        # (uid, modseq) of the expunged messages
+        self.vanished = []
+
+    def add(self, msg):
+        uid = self.uidNext
+        self.uidNext += 1
+        self.msgs.append((uid, msg))
+        return uid
+
+    def uids(self):
+        return [uid for uid, msg in self.msgs]
+
+    def uidOf(self, msg):
+        for uid, m in self.msgs:
+            if m is msg:
+                return uid
+        return None
+
+    def matching(self, seqSet):
+        """The (seq, uid, Message) whose UID is in seqSet"""
+        last = self.msgs[-1][0] if len(self.msgs) else 0
+        ranges = []
+        for item in seqSet.split(','):
+            lo, hi = (item.split(':') + [item])[:2]
+            lo, hi = [last if n == '*' else int(n) for n in (lo, hi)]
+            ranges.append((min(lo, hi), max(lo, hi)))
+        return [(seq + 1, uid, msg) for seq, (uid, msg) in enumerate(self.msgs)
+                if [r for r in ranges if r[0] <= uid <= r[1]]]
+
+
+class Account(object):
+    Capabilities = ('IMAP4rev1', 'UIDPLUS', 'MULTIAPPEND', 'ENABLE', 'CONDSTORE', 'QRESYNC',
+                    'ESEARCH', 'LIST-STATUS', 'X-GM-EXT-1', 'XLIST', 'COMPRESS=DEFLATE')
+
+    def __init__(self, capabilities=Capabilities):
+        self.capabilities = list(capabilities)
+        self.lock = threading.RLock()
+        self.modseq = 1
+        # In LIST order
+        self.mailboxes = []
+        self.mailbox('INBOX', '\\HasNoChildren \\Inbox')
+        self.mailbox(AllMail, '\\HasNoChildren \\AllMail')
+
+        # The commands received (without their tag and literals), and the
+        # number of connections made so far
+        self.commands = []
+        self.connections = 0
+
+        # The (mailbox, UID) of every message body sent (RFC822 or BODY[])
+        self.downloads = []
+
+        # [regex, bytes, response] of the commands the connection drops on,
+        # or that fail (see dropOn, failOn)
+        self.drops = []
+
+        # If True, the responses to UID FETCH commands that are sent
+        # together (pipelined) are interleaved (see Connection.release)
+        self.interleave = False
+
+        # If True, the first compressed response is sent along with the OK
+        # of COMPRESS, so the client reads some of it before inflating
+        self.eager = False
+
+    def mailbox(self, name, flags='\\HasNoChildren', uidValidity=1):
+        """Returns the mailbox with that name, created if there is none"""
+        with self.lock:
+            for mbox in self.mailboxes:
+                if mbox.name == name or (name.upper() == 'INBOX' and mbox.name == 'INBOX'):
+                    return mbox
+            mbox = Mailbox(name, flags, uidValidity)
+            self.mailboxes.append(mbox)
+            return mbox
+
+    def find(self, name):
+        with self.lock:
+            for mbox in self.mailboxes:
+                if mbox.name == name or (name.upper() == 'INBOX' and mbox.name == 'INBOX'):
+                    return mbox
+        return None
+
+    def deliver(self, msg, labels=()):
+        """Adds msg to All Mail, and to the mailbox of each label"""
+        with self.lock:
+            uid = self.mailbox(AllMail).add(msg)
+            for label in labels:
+                self.mailbox(label).add(msg)
+            return uid
+
+    def setFlags(self, msg, flags):
+        with self.lock:
+            self.modseq += 1
+            msg.flags = flags
+            msg.modseq = self.modseq
+
+    def expunge(self, name, uid):
+        with self.lock:
+            self.modseq += 1
+            mbox = self.find(name)
+            mbox.msgs = [(u, m) for u, m in mbox.msgs if u != uid]
+            mbox.vanished.append((uid, self.modseq))
+
+    def dropOn(self, pattern, after=None):
+        """
+        Drops the connection when it gets the next command that matches the
+        pattern, before answering it, or after sending the first after bytes
+        of the answer.
+        """
+        self.drops.append([re.compile(pattern), after, None])
+
+    def failOn(self, pattern, response='NO Failed'):
+        """Answers the next command that matches the pattern with response"""
+        self.drops.append([re.compile(pattern), None, response])
+
+    def sent(self, pattern):
+        """The commands received that match the pattern"""
+        return [c for c in self.commands if re.search(pattern, c)]
+
+    def labels(self, msg):
+        labels = []
+        for mbox in self.mailboxes:
+            if mbox.name == AllMail or mbox.uidOf(msg) is None:
+                continue
+            special = [f for f in mbox.flags.split() if f in ('\\Inbox', '\\Sent', '\\Drafts', '\\Starred', '\\Important')]
+            labels.append(special[0] if len(special) else '"%s"' % mbox.name)
+        return labels
+
+
+class Literal(str):
+    pass
+
+
+class Closed(Exception):
+    pass
+
+
+def split(text):
+    """Splits a command into its arguments: atoms, "quoted" strings and (lists)"""
+    args = []
+    i = 0
+    while i < len(text):
+        if text[i] == ' ':
+            i += 1
+        elif text[i] == '"':
+            arg = ''
+            i += 1
+            while text[i] != '"':
+                if text[i] == '\\':
+                    i += 1
+                arg += text[i]
+                i += 1
+            args.append(arg)
+            i += 1
+        else:
+            start = i
+            depth = 0
+            while i < len(text) and (depth > 0 or text[i] != ' '):
+                if text[i] in '([':
+                    depth += 1
+                elif text[i] in ')]':
+                    depth -= 1
+                i += 1
+            args.append(text[start:i])
+    return args
+
+
+def quote(name):
+    return '"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def uidSet(uids):
+    return ','.join([str(uid) for uid in uids])
+
+
+class Connection(threading.Thread):
+    """Serves one client connection"""
+    def __init__(self, account, sock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.account = account
+        self.sock = sock
+        self.inbuf = ''
+        self.inflater = self.deflater = None
+        self.selected = None
+        self.enabled = set()
+        # The (untagged, tagged) responses to pipelined UID FETCH commands
+        # held back to be interleaved
+        self.held = []
+        with account.lock:
+            account.connections += 1
+
+    def run(self):
+        try:
+            self.write('* OK Fake IMAP ready\r\n')
+            while True:
+                tag, args = self.readCommand()
+                self.serve(tag, args)
+        except (Closed, socket.error):
+            pass
+        finally:
+            self.sock.close()
+
+    def fill(self):
+        data = self.sock.recv(65536)
+        if not len(data):
+            raise Closed()
+        if self.inflater is not None:
+            data = self.inflater.decompress(data)
+        self.inbuf += data
+
+    def readline(self):
+        while '\r\n' not in self.inbuf:
+            self.fill()
+        line, self.inbuf = self.inbuf.split('\r\n', 1)
+        return line
+
+    def read(self, size):
+        while len(self.inbuf) < size:
+            self.fill()
+        data, self.inbuf = self.inbuf[:size], self.inbuf[size:]
+        return data
+
+    def pending(self):
+        """True if the client sent another command already"""
+        return '\r\n' in self.inbuf or len(select.select([self.sock], [], [], 0.2)[0]) > 0
+
+    def write(self, data):
+        if self.deflater is not None:
+            data = self.deflater.compress(data) + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+        self.sock.sendall(data)
+
+    def readCommand(self):
+        """Returns (tag, arguments). The literals (APPEND) are Literal arguments."""
+        line = self.readline()
+        tag, text = (line.split(' ', 1) + [''])[:2]
+        logged = []
+        args = []
+        while True:
+            match = re.search(r'\{(\d+)(\+?)\}$', text)
+            if match is None:
+                logged.append(text)
+                args.extend(split(text))
+                break
+            logged.append(text[:match.start()].strip())
+            args.extend(split(text[:match.start()]))
+            if not match.group(2):
+                self.write('+ Ready\r\n')
+            args.append(Literal(self.read(int(match.group(1)))))
+            text = self.readline()
+        with self.account.lock:
+            self.account.commands.append(' '.join([l for l in logged if len(l)]))
+        return (tag, args)
+
+    def serve(self, tag, args):
+        name = args[0].upper() if len(args) else ''
+        if name == 'UID' and len(args) > 1:
+            name = 'UID ' + args[1].upper()
+            args = args[1:]
+
+        drop = None
+        with self.account.lock:
+            command = self.account.commands[-1]
+            for rule in self.account.drops:
+                if rule[0].search(command):
+                    drop = rule
+                    self.account.drops.remove(rule)
+                    break
+        if drop is not None and drop[1] is None and drop[2] is None:
+            raise Closed()
+
+        handler = getattr(self, 'do' + name.replace(' ', '_').replace('-', '_'), None)
+        if drop is not None and drop[2] is not None:
+            untagged, tagged = [], drop[2]
+            drop = None
+        elif handler is None:
+            untagged, tagged = [], 'BAD Unknown command'
+        else:
+            try:
+                with self.account.lock:
+                    untagged, tagged = handler(args[1:], tag)
+            except Exception, e:
+                untagged, tagged = [], 'BAD %s: %s' % (e.__class__.__name__, e)
+        tagged = '%s %s\r\n' % (tag, tagged)
+
+        if drop is not None:
+            self.release()
+            self.write((''.join(untagged) + tagged)[:drop[1]])
+            raise Closed()
+
+        if name == 'UID FETCH' and self.account.interleave:
+            self.held.append((untagged, tagged))
+            if not self.pending():
+                self.release()
+            return
+
+        self.release()
+        if name == 'COMPRESS' and tagged.split()[1] == 'OK':
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            data = ''.join(untagged) + tagged
+            if self.account.eager:
+                data += self.deflater.compress('* OK Still here\r\n') + self.deflater.flush(zlib.Z_SYNC_FLUSH)
+            self.sock.sendall(data)
+            return
+
+        self.write(''.join(untagged) + tagged)
+        if name == 'LOGOUT':
+            raise Closed()
+
+    def release(self):
+        """Sends the responses held back, one untagged response from each command in turn"""
+        if not len(self.held):
+            return
+        held, self.held = self.held, []
+        out = []
+        for n in range(max([len(untagged) for untagged, tagged in held])):
+            for untagged, tagged in held:
+                if n < len(untagged):
+                    out.append(untagged[n])
+        self.write(''.join(out + [tagged for untagged, tagged in held]))
+
+    # Each command returns (untagged responses, the tagged response without the tag)
+
+    def doCAPABILITY(self, args, tag):
+        return (['* CAPABILITY %s\r\n' % ' '.join(self.account.capabilities)], 'OK Done')
+
+    def doLOGIN(self, args, tag):
+        return ([], 'OK Logged in')
+
+    def doNOOP(self, args, tag):
+        return ([], 'OK Done')
+
+    def doLOGOUT(self, args, tag):
+        return (['* BYE Logging out\r\n'], 'OK Done')
+
+    def doENABLE(self, args, tag):
+        self.enabled = set([a.upper() for a in args if a.upper() in self.account.capabilities])
+        return (['* ENABLED %s\r\n' % ' '.join(sorted(self.enabled))], 'OK Enabled')
+
+    def doCOMPRESS(self, args, tag):
+        if 'COMPRESS=DEFLATE' not in self.account.capabilities or self.deflater is not None:
+            return ([], 'NO Compression not available')
+        return ([], 'OK Compression active')
+
+    def listRow(self, command, mbox):
+        return '* %s (%s) "/" %s\r\n' % (command, mbox.flags, quote(mbox.name))
+
+    def status(self, mbox, items):
+        values = {'MESSAGES': len(mbox.msgs), 'UIDNEXT': mbox.uidNext,
+                  'UIDVALIDITY': mbox.uidValidity, 'HIGHESTMODSEQ': self.account.modseq}
+        return '* STATUS %s (%s)\r\n' % (quote(mbox.name),
+                ' '.join(['%s %d' % (item, values[item]) for item in items if values.has_key(item)]))
+
+    def doLIST(self, args, tag):
+        rows = [self.listRow('LIST', mbox) for mbox in self.account.mailboxes
+                if args[1] in ('*', '%') or args[1] == mbox.name]
+        if len(args) > 3 and args[2].upper() == 'RETURN' and 'LIST-STATUS' in self.account.capabilities:
+            items = re.search(r'STATUS \(([^()]*)\)', args[3].upper()).group(1).split()
+            for mbox in self.account.mailboxes:
+                rows.append(self.status(mbox, items))
+        return (rows, 'OK Done')
+
+    def doXLIST(self, args, tag):
+        return ([self.listRow('XLIST', mbox) for mbox in self.account.mailboxes
+                 if args[1] == '*' or args[1] == mbox.name], 'OK Done')
+
+    def doCREATE(self, args, tag):
+        if self.account.find(args[0]) is not None:
+            return ([], 'NO Already exists')
+        self.account.mailbox(args[0])
+        return ([], 'OK Created')
+
+    def doSTATUS(self, args, tag):
+        mbox = self.account.find(args[0])
+        if mbox is None:
+            return ([], 'NO No such mailbox')
+        return ([self.status(mbox, args[1].strip('()').upper().split())], 'OK Done')
+
+    def doSELECT(self, args, tag, readonly=False):
+        mbox = self.account.find(args[0])
+        if mbox is None:
+            self.selected = None
+            return ([], 'NO No such mailbox')
+        self.selected = mbox
+        rows = ['* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)\r\n',
+                '* OK [UIDVALIDITY %d] UIDs valid\r\n' % mbox.uidValidity,
+                '* %d EXISTS\r\n' % len(mbox.msgs),
+                '* 0 RECENT\r\n',
+                '* OK [UIDNEXT %d] Predicted next UID\r\n' % mbox.uidNext]
+        if len(self.enabled):
+            rows.append('* OK [HIGHESTMODSEQ %d]\r\n' % self.account.modseq)
+        return (rows, 'OK [%s] Done' % ('READ-ONLY' if readonly else 'READ-WRITE'))
+
+    def doEXAMINE(self, args, tag):
+        return self.doSELECT(args, tag, True)
+
+    def doCLOSE(self, args, tag):
+        self.selected = None
+        return ([], 'OK Closed')
+
+    def doUID_FETCH(self, args, tag):
+        if self.selected is None:
+            return ([], 'BAD No mailbox selected')
+        items = re.findall(r'BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|[^\s()]+', args[1])
+        since = vanished = None
+        if len(args) > 2:
+            match = re.search(r'CHANGEDSINCE (\d+)', args[2].upper())
+            since = int(match.group(1))
+            vanished = 'VANISHED' in args[2].upper()
+
+        rows = []
+        if vanished:
+            gone = [uid for uid, modseq in self.selected.vanished if modseq > since]
+            if len(gone):
+                rows.append('* VANISHED (EARLIER) %s\r\n' % uidSet(gone))
+
+        for seq, uid, msg in self.selected.matching(args[0]):
+            if since is not None and msg.modseq <= since:
+                continue
+            parts = ['UID %d' % uid]
+            for item in items:
+                item = item.upper()
+                if item == 'FLAGS':
+                    parts.append('FLAGS (%s)' % msg.flags)
+                elif item == 'INTERNALDATE':
+                    parts.append('INTERNALDATE "%s"' % msg.date)
+                elif item == 'RFC822.SIZE':
+                    parts.append('RFC822.SIZE %d' % len(msg.body))
+                elif item == 'X-GM-MSGID':
+                    parts.append('X-GM-MSGID %d' % msg.msgId)
+                elif item == 'X-GM-LABELS':
+                    parts.append('X-GM-LABELS (%s)' % ' '.join(self.account.labels(msg)))
+                elif item == 'RFC822':
+                    parts.append('RFC822 {%d}\r\n%s' % (len(msg.body), msg.body))
+                    self.account.downloads.append((self.selected.name, uid))
+                elif item.startswith('BODY'):
+                    section = re.match(r'BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?', item)
+                    if section.group(1) == '':
+                        data = msg.body
+                        name = 'BODY[]'
+                        if section.group(2) is not None:
+                            start = int(section.group(2))
+                            data = data[start:start + int(section.group(3))]
+                            name += '<%d>' % start
+                        self.account.downloads.append((self.selected.name, uid))
+                    else:
+                        names = re.search(r'\(([^()]*)\)', section.group(1)).group(1).split()
+                        data = msg.headers(names)
+                        name = 'BODY[%s]' % section.group(1)
+                    parts.append('%s {%d}\r\n%s' % (name, len(data), data))
+            if since is not None:
+                parts.append('MODSEQ (%d)' % msg.modseq)
+            rows.append('* %d FETCH (%s)\r\n' % (seq, ' '.join(parts)))
+        return (rows, 'OK Success')
+
+    def doUID_SEARCH(self, args, tag):
+        if self.selected is None:
+            return ([], 'BAD No mailbox selected')
+        criteria = [a.upper() for a in args]
+        if criteria[:1] == ['RETURN']:
+            uids = self.selected.uids()
+            found = ' ALL %s' % uidSet(uids) if len(uids) else ''
+            return (['* ESEARCH (TAG "%s") UID%s\r\n' % (tag, found)], 'OK Done')
+        if criteria == ['ALL']:
+            uids = self.selected.uids()
+        elif criteria[0] == 'UID':
+            uids = [uid for seq, uid, msg in self.selected.matching(criteria[1])]
+        else:
+            lo, hi = [int(n) for n in criteria[0].split(':')]
+            uids = [uid for uid, msg in self.selected.msgs[lo - 1:hi]]
+        return (['* SEARCH%s\r\n' % ''.join([' %d' % uid for uid in uids])], 'OK Done')
+
+    def doUID_STORE(self, args, tag):
+        if self.selected is None:
+            return ([], 'BAD No mailbox selected')
+        flags = args[2].strip('()')
+        for seq, uid, msg in self.selected.matching(args[0]):
+            self.account.setFlags(msg, flags)
+        return ([], 'OK Done')
+
+    def doUID_COPY(self, args, tag):
+        if self.selected is None:
+            return ([], 'BAD No mailbox selected')
+        dest = self.account.find(args[1])
+        if dest is None:
+            return ([], 'NO [TRYCREATE] No such mailbox')
+        src = []
+        dst = []
+        for seq, uid, msg in self.selected.matching(args[0]):
+            src.append(uid)
+            dst.append(dest.uidOf(msg) or dest.add(msg))
+        return ([], 'OK [COPYUID %d %s %s] Done' % (dest.uidValidity, uidSet(src), uidSet(dst)))
+
+    def doAPPEND(self, args, tag):
+        mbox = self.account.find(args[0])
+        if mbox is None:
+            return ([], 'NO [TRYCREATE] No such mailbox')
+        uids = []
+        flags = ''
+        date = None
+        for arg in args[1:]:
+            if isinstance(arg, Literal):
+                msg = Message(body=str(arg), date=date, flags=flags)
+                uids.append(mbox.add(msg))
+                if mbox.name != AllMail:
+                    self.account.mailbox(AllMail).add(msg)
+                flags = ''
+                date = None
+            elif arg.startswith('('):
+                flags = arg.strip('()')
+            else:
+                date = arg
+        if 'UIDPLUS' not in self.account.capabilities:
+            return ([], 'OK Success')
+        return ([], 'OK [APPENDUID %d %s] (Success)' % (mbox.uidValidity, uidSet(uids)))
+
+
+class FakeImapServer(ImapServer):
+    """An ImapServer connected to the Account registered under its host name"""
+
+    def open(self, host='', port=993):
+        self.host = host
+        self.port = port
+        ours, theirs = socket.socketpair()
+        Connection(accounts[host], theirs).start()
+        # Buffered like the file of an SSL socket (socket._fileobject)
+        self.sock = socket.socket(_sock=ours)
+        self.sslobj = Wire(self.sock)
+        self.file = self.sock.makefile('rb')
+
+
+class Wire(object):
+    """Stands for the SSL object on top of the socket"""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def read(self, size):
+        return self.sock.recv(size)
+
+
+def connect(account, **kwargs):
+    """Returns a FakeImapServer logged in to the account"""
+    host = 'imap%d.example.com' % id(account)
+    accounts[host] = account
+    return FakeImapServer(host, 993, 'me@example.com', 'secret', **kwargs)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for whole backups against a fake IMAP server, and how an interrupted one resumes"""
+
+import shutil
+import logging
+import tempfile
+import unittest
+
+import bagoma
+from bagoma import backup, openIndex
+
+import fakeimap
+from fakeimap import Account, Message, AllMail
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+bagoma.progress = lambda msg: None
+
+
+class Crash(Exception):
+    """The backup process dying"""
+
+
+class CrashingIndex(object):
+    """
+    An index store that stops taking writes once checkpoints checkpoints are
+    written, as if the process died right then: the backup still runs to its
+    end, but nothing more it does makes it to the index.
+    """
+    def __init__(self, index, checkpoints):
+        self.index = index
+        self.left = checkpoints
+
+    def check(self):
+        if self.left <= 0:
+            raise Crash()
+
+    def addMsgs(self, messages):
+        self.check()
+        self.index.addMsgs(messages)
+
+    def addFlds(self, replaced, added):
+        self.check()
+        self.index.addFlds(replaced, added)
+        self.left -= 1
+
+    def saveMsgs(self, messages):
+        self.check()
+        self.index.saveMsgs(messages)
+
+    def saveFlds(self, flds):
+        self.check()
+        self.index.saveFlds(flds)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+
+class CrashTest(object):
+    """
+    Eight messages, in INBOX (the odd ones) and Work (5 to 8), backed up with
+    a checkpoint every two messages. The tests run on both index stores (see
+    format).
+    """
+    def setUp(self):
+        self.dir = None
+        self.start()
+
+    def tearDown(self):
+        self.cleanUp()
+
+    def start(self):
+        self.cleanUp()
+        self.dir = tempfile.mkdtemp()
+        bagoma.options = fakeimap.makeOptions(backupDir=self.dir, batchSize=2, checkpointMsgs=2, checkpointSecs=0)
+        self.account = Account()
+        self.msgs = [Message(n) for n in range(1, 9)]
+        for n, msg in enumerate(self.msgs):
+            labels = (['INBOX'] if n % 2 == 0 else []) + (['Work'] if n >= 4 else [])
+            self.account.deliver(msg, labels)
+
+    def cleanUp(self):
+        if self.dir is None:
+            return
+        store = bagoma.msgStores.pop(self.dir, None)
+        if store is not None:
+            store.packs.close()
+        shutil.rmtree(self.dir)
+
+    def backUp(self, checkpoints=None):
+        """Returns the number of checkpoints written"""
+        server = fakeimap.connect(self.account)
+        index = CrashingIndex(openIndex(self.dir, self.format), checkpoints or 1000)
+        try:
+            backup(server, self.dir, index)
+        finally:
+            server.logout()
+        return 1000 - index.left
+
+    def check(self):
+        """Every message is in the index and the store, and was downloaded once"""
+        index = openIndex(self.dir, self.format)
+        messages = index.loadMsgs()
+        flds = index.loadFlds()
+        sha1 = [msg.sha1() for msg in self.msgs]
+        self.assertEqual(sorted(messages.keys()), sorted(sha1))
+        self.assertEqual(flds[AllMail].msgs.items(), [(str(n + 1), sha1[n]) for n in range(8)])
+        self.assertEqual(flds['INBOX'].msgs.values(), [sha1[n] for n in (0, 2, 4, 6)])
+        self.assertEqual(flds['Work'].msgs.values(), sha1[4:])
+        self.assertEqual(sorted(messages[sha1[4]]['folder']), ['INBOX', 'Work', AllMail])
+
+        store = bagoma.msgStore(self.dir)
+        for msg in self.msgs:
+            self.assertEqual(store.read(msg.sha1()), msg.body)
+        self.assertEqual(sorted(self.account.downloads), [(AllMail, uid) for uid in range(1, 9)])
+
+    def testNoCrash(self):
+        self.backUp()
+        self.check()
+
+    def testCrashDownloading(self):
+        self.assertRaises(Crash, self.backUp, 2)
+        # Messages 5 and 6 were saved after the second checkpoint, so the
+        # index doesn't have them, but the next backup finds their files
+        self.assertEqual(len(openIndex(self.dir, self.format).loadFlds()[AllMail].msgs), 4)
+        self.assertEqual(len(self.account.downloads), 6)
+        self.backUp()
+        self.check()
+
+    def testCrashAnywhere(self):
+        checkpoints = self.backUp()
+        for crashAt in range(1, checkpoints):
+            self.start()
+            self.assertRaises(Crash, self.backUp, crashAt)
+            self.backUp()
+            self.check()
+
+    def testCrashTwice(self):
+        self.assertRaises(Crash, self.backUp, 1)
+        self.assertRaises(Crash, self.backUp, 2)
+        self.backUp()
+        self.check()
+
+
+class PickleCrashTest(CrashTest, unittest.TestCase):
+    format = 'pickle'
+
+
+class SqliteCrashTest(CrashTest, unittest.TestCase):
+    format = 'sqlite'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for Budget and the download order (ImapServer.schedule)"""
+
+import time
+import logging
+import argparse
+import unittest
+
+import bagoma
+from bagoma import Budget, ImapServer
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.options = argparse.Namespace(batchSize=500)
+
+
+class BudgetTest(unittest.TestCase):
+
+    def testNoLimit(self):
+        budget = Budget(0, 0)
+        budget.sizes = {'1': 10 ** 12}
+        budget.spend('1')
+        self.assertFalse(budget.exhausted())
+
+    def testBytes(self):
+        budget = Budget(0, 1000)
+        budget.sizes = {'1': 600, '2': 400}
+        budget.spend('1')
+        self.assertFalse(budget.exhausted())
+        # Messages of unknown size are free
+        budget.spend('3')
+        self.assertFalse(budget.exhausted())
+        budget.spend('2')
+        self.assertTrue(budget.exhausted())
+        self.assertEqual(budget.bytes, 1000)
+
+    def testTime(self):
+        budget = Budget(60, 0)
+        self.assertFalse(budget.exhausted())
+        budget.start = time.time() - 61
+        self.assertTrue(budget.exhausted())
+        self.assertTrue(str(budget).startswith("Download budget used up (0.0 MB in 1.0 minutes"))
+
+
+class FakeServer(object):
+    """Answers the RFC822.SIZE/INTERNALDATE queries of ImapServer.schedule"""
+    def __init__(self, info):
+        self.info = info
+        self.queried = []
+
+    def fetchSizes(self, uids, withDates=False, batchSz=None):
+        self.queried.append(list(uids))
+        return dict([(uid, self.info[uid]) for uid in uids if uid in self.info])
+
+    schedule = ImapServer.schedule.im_func
+
+
+class ScheduleTest(unittest.TestCase):
+    # UID => (RFC822.SIZE, INTERNALDATE). UID 5 is not reported by the server.
+    INFO = {'1': (100, 100), '2': (400, 400), '3': (200, 200), '4': (300, 300)}
+    UIDS = ['1', '2', '3', '4', '5']
+
+    def testUid(self):
+        server = FakeServer(self.INFO)
+        budget = Budget(0, 1000)
+        self.assertEqual(server.schedule(self.UIDS, 'uid', budget), self.UIDS)
+        # The sizes come with the headers
+        self.assertEqual(server.queried, [])
+
+    def testNewest(self):
+        self.assertEqual(FakeServer(self.INFO).schedule(self.UIDS, 'newest'), ['2', '4', '3', '1', '5'])
+
+    def testSmallest(self):
+        self.assertEqual(FakeServer(self.INFO).schedule(self.UIDS, 'smallest'), ['1', '3', '4', '2', '5'])
+
+    def testBalanced(self):
+        self.assertEqual(FakeServer(self.INFO).schedule(self.UIDS, 'balanced'), ['2', '1', '4', '3', '5'])
+
+    def testBudget(self):
+        budget = Budget(0, 1000)
+        FakeServer(self.INFO).schedule(self.UIDS, 'smallest', budget)
+        self.assertEqual(budget.sizes, {'1': 100, '2': 400, '3': 200, '4': 300})
+
+
+if __name__ == '__main__':
+    unittest.main()
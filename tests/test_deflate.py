@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for COMPRESS=DEFLATE: DeflateFile, and compressed connections to a fake IMAP server"""
+
+import zlib
+import random
+import logging
+import unittest
+
+import bagoma
+from bagoma import DeflateFile
+
+import fakeimap
+from fakeimap import Account, Message, AllMail
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+bagoma.progress = lambda msg: None
+
+LINES = ['* %d FETCH (UID %d FLAGS (\\Seen))\r\n' % (n, n) for n in range(1, 200)] + \
+        ['* 200 FETCH (UID 200 RFC822 {3000}\r\n', 'x' * 2998 + '\r\n', ')\r\n', 'A001 OK Success\r\n']
+TEXT = ''.join(LINES)
+
+
+class Wire(object):
+    """Hands out the compressed data in the pieces it was cut into, whatever the size asked"""
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+
+    def read(self, size):
+        return self.pieces.pop(0) if len(self.pieces) else ''
+
+
+def compressed(text, rnd):
+    """text compressed as a server does, flushed at random points"""
+    deflater = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = ''
+    start = 0
+    while start < len(text):
+        end = start + rnd.randint(1, 500)
+        data += deflater.compress(text[start:end]) + deflater.flush(zlib.Z_SYNC_FLUSH)
+        start = end
+    return data
+
+
+def cut(data, rnd):
+    """data cut at random points"""
+    pieces = []
+    while len(data):
+        n = rnd.randint(1, 64)
+        pieces.append(data[:n])
+        data = data[n:]
+    return pieces
+
+
+class DeflateFileTest(unittest.TestCase):
+
+    def files(self):
+        """DeflateFiles reading TEXT, cut differently each time"""
+        for seed in range(20):
+            rnd = random.Random(seed)
+            pieces = cut(compressed(TEXT, rnd), rnd)
+            # Some of it already read from the wire, like after COMPRESS
+            n = rnd.randint(0, 3)
+            yield DeflateFile(Wire(pieces[n:]), ''.join(pieces[:n]))
+
+    def testReadline(self):
+        for f in self.files():
+            self.assertEqual([f.readline() for line in LINES], LINES)
+            self.assertEqual(f.readline(), '')
+
+    def testReadlineLimit(self):
+        for f in self.files():
+            # Like imaplib, which asks for one byte more than the longest line it takes
+            lines = []
+            while True:
+                line = f.readline(1001)
+                if not len(line):
+                    break
+                self.assertTrue(len(line) <= 1001)
+                self.assertTrue(line.endswith('\n') or len(line) == 1001)
+                lines.append(line)
+            self.assertEqual(''.join(lines), TEXT)
+            self.assertEqual(len(lines), len(LINES) + 2)
+
+    def testRead(self):
+        for f in self.files():
+            rnd = random.Random(len(f.buf))
+            data = ''
+            while True:
+                chunk = f.read(rnd.randint(1, 300))
+                if not len(chunk):
+                    break
+                data += chunk
+            self.assertEqual(data, TEXT)
+
+    def testMixed(self):
+        for f in self.files():
+            self.assertEqual(f.readline(), LINES[0])
+            self.assertEqual(f.read(10), LINES[1][:10])
+            self.assertEqual(f.readline(5), LINES[1][10:15])
+            self.assertEqual(f.readline(), LINES[1][15:])
+            for line in LINES[2:-3]:
+                self.assertEqual(f.readline(), line)
+            self.assertEqual(f.read(3000), LINES[-3])
+            self.assertEqual(f.readline(), LINES[-2])
+            self.assertEqual(f.readline(), LINES[-1])
+
+
+class ConnectionTest(unittest.TestCase):
+    """Compressed connections to the fake IMAP server"""
+
+    def setUp(self):
+        bagoma.options = fakeimap.makeOptions()
+        self.account = Account()
+        self.msgs = [Message(n, size=3000) for n in range(1, 4)]
+        for msg in self.msgs:
+            self.account.deliver(msg, ['INBOX'])
+
+    def fetch(self, server):
+        server.select(AllMail, readonly=True)
+        typ, data = server.uid('FETCH', '1:3', 'RFC822')
+        self.assertEqual(typ, 'OK')
+        self.assertEqual([d[1] for d in data if isinstance(d, tuple)], [msg.body for msg in self.msgs])
+
+    def testDeflate(self):
+        server = fakeimap.connect(self.account)
+        self.assertTrue(isinstance(server.file, DeflateFile))
+        self.fetch(server)
+        server.logout()
+        self.assertEqual(self.account.sent('^COMPRESS'), ['COMPRESS DEFLATE'])
+
+    def testEager(self):
+        # The server's first compressed response comes with its OK to
+        # COMPRESS. Were it lost, the rest of the stream couldn't be inflated
+        self.account.eager = True
+        server = fakeimap.connect(self.account)
+        self.fetch(server)
+        server.logout()
+
+    def testNoDeflate(self):
+        server = fakeimap.connect(self.account, deflate=False)
+        self.fetch(server)
+        # Nor on the connections it opens
+        clone = server.clone()
+        self.fetch(clone)
+        for s in (server, clone):
+            self.assertFalse(isinstance(s.file, DeflateFile))
+            s.logout()
+        self.assertEqual(self.account.sent('^COMPRESS'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
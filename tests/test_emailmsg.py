@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for EmailMsg"""
+
+import logging
+import unittest
+import cPickle as pickle
+
+import bagoma
+from bagoma import EmailMsg
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+
+HEADERS = 'From: Alice <alice@example.com>\r\nTo: bob@example.com\r\n' \
+          'Date: Tue, 17 Jul 2012 04:44:25 +0200\r\nSubject: Hello\r\n' \
+          'Message-ID: <1234@example.com>\r\n\r\n'
+
+
+def fetched(uid, date='17-Jul-2012 02:44:25 +0000', flags='\\Seen', size=1000):
+    return ('%s (UID %s FLAGS (%s) INTERNALDATE "%s" RFC822.SIZE %d BODY[HEADER.FIELDS (FROM TO CC DATE '
+            'SUBJECT X-GMAIL-RECEIVED MESSAGE-ID)] {%d}' % (uid, uid, flags, date, size, len(HEADERS)), HEADERS)
+
+
+class FakeServer(object):
+    """Answers the bulk header FETCH commands of EmailMsg.fetchAll"""
+    def __init__(self):
+        self.batches = []
+
+    def fetchBatches(self, batches, items, depth=1):
+        for batch in batches:
+            self.batches.append(batch)
+            data = []
+            for uid in batch:
+                data.extend([fetched(uid, size=int(uid) * 100), ')'])
+            yield (batch, 'OK', data)
+
+
+class EmailMsgTest(unittest.TestCase):
+
+    def testFromFetchRsp(self):
+        msg = EmailMsg(None, '5', fetched('5'))
+        self.assertTrue(msg.OK)
+        self.assertEqual(msg['uid'], '5')
+        self.assertEqual(msg['flags'], '\\Seen')
+        self.assertEqual(msg['internaldate'], '17-Jul-2012 02:44:25 +0000')
+        self.assertEqual(msg['folder'], ())
+        # Computed from the exact INTERNALDATE string
+        self.assertEqual(msg['sha1'], EmailMsg.computeSha1('17-Jul-2012 02:44:25 +0000',
+                         bagoma.HeaderParser().parsestr(HEADERS, headersonly=True)))
+
+    def testDates(self):
+        msg = EmailMsg.__new__(EmailMsg)
+        msg['internaldate'] = '01-Jan-2013 00:00:05 +0000'
+        self.assertEqual(msg.internaldate, 1356998405)
+        self.assertEqual(msg['internaldate'], '01-Jan-2013 00:00:05 +0000')
+
+        # Kept as they are, since the SHA1 depends on the exact string
+        for date in [' 1-Jan-2013 00:00:05 +0000', '01-Jan-2013 00:00:05 -0700',
+                     '31-Feb-2013 00:00:05 +0000', '01-Jan-1960 00:00:05 +0000', 'garbage']:
+            msg['internaldate'] = date
+            self.assertEqual(msg.internaldate, date)
+            self.assertEqual(msg['internaldate'], date)
+
+    def testDict(self):
+        msg = EmailMsg.__new__(EmailMsg)
+        self.assertFalse(msg.has_key('uid'))
+        self.assertRaises(KeyError, msg.__getitem__, 'uid')
+        self.assertRaises(KeyError, msg.__setitem__, 'other', 1)
+        msg.update({'uid':'7', 'flags':'', 'folder':['INBOX']})
+        msg.addFolder('Work')
+        self.assertEqual(msg.get('uid'), '7')
+        self.assertEqual(msg['folder'], ('INBOX', 'Work'))
+        self.assertEqual(sorted(msg.keys()), ['flags', 'folder', 'uid'])
+
+    def testSharedFolders(self):
+        a = EmailMsg.__new__(EmailMsg)
+        b = EmailMsg.__new__(EmailMsg)
+        a['folder'] = ['INBOX', 'Work']
+        b['folder'] = ('INBOX', 'Work')
+        self.assertTrue(a.folder is b.folder)
+
+    def testPickle(self):
+        msg = EmailMsg(None, '5', fetched('5'))
+        msg.addFolder('INBOX')
+        copy = pickle.loads(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(copy.OK)
+        self.assertEqual(copy.items(), msg.items())
+        # The pickles hold the INTERNALDATE string, like older versions
+        self.assertEqual(msg.__getstate__()[0]['internaldate'], '17-Jul-2012 02:44:25 +0000')
+
+    def testFetchAll(self):
+        server = FakeServer()
+        sizes = {}
+        uids = ['3', '1', '2']
+        msgs = []
+        for uid, msg in EmailMsg.fetchAll(server, uids, 2, sizes=sizes):
+            # The size is known by the time the message is yielded
+            self.assertEqual(sizes[uid], int(uid) * 100)
+            msgs.append((uid, msg['uid']))
+        self.assertEqual(msgs, [('3', '3'), ('1', '1'), ('2', '2')])
+        self.assertEqual(server.batches, [['3', '1'], ['2']])
+
+    def testSplitFetchRsp(self):
+        first, second = fetched('5'), fetched('6')
+        data = [first, ')', '7 (FLAGS (\\Seen))', second, ' FLAGS (\\Flagged))']
+        rsp = EmailMsg.splitFetchRsp(data)
+        self.assertEqual(sorted(rsp.keys()), ['5', '6'])
+        self.assertEqual(rsp['5'], (first[0] + ')', HEADERS))
+        # Data items sent after the literal are kept
+        self.assertTrue(rsp['6'][0].endswith('FLAGS (\\Flagged))'))
+
+
+if __name__ == '__main__':
+    unittest.main()
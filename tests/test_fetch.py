@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for how the headers and bodies of the messages are fetched, against a fake IMAP server"""
+
+import os
+import re
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import unittest
+
+import bagoma
+from bagoma import EmailMsg, DownloadPool, ImapServer
+
+import fakeimap
+from fakeimap import Account, Message, AllMail
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+bagoma.progress = lambda msg: None
+
+
+class ServerTest(unittest.TestCase):
+    """Five messages in All Mail (and INBOX), with All Mail selected"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bagoma.options = fakeimap.makeOptions(backupDir=self.dir)
+        self.account = Account()
+        self.msgs = [Message(n, flags='\\Seen' if n % 2 else '') for n in range(1, 6)]
+        for msg in self.msgs:
+            self.account.deliver(msg, ['INBOX'])
+        self.server = fakeimap.connect(self.account)
+        self.server.select(AllMail, readonly=True)
+
+    def tearDown(self):
+        self.server.logout()
+        store = bagoma.msgStores.pop(self.dir, None)
+        if store is not None:
+            store.packs.close()
+        shutil.rmtree(self.dir)
+
+    def uidSha(self, uids):
+        return [(str(uid), self.msgs[uid - 1].sha1()) for uid in uids]
+
+
+class FetchTest(ServerTest):
+
+    def testHeaderBatches(self):
+        fetched = list(EmailMsg.fetchAll(self.server, ['1', '2', '3', '4', '5'], 2))
+        self.assertEqual([uid for uid, msg in fetched], ['1', '2', '3', '4', '5'])
+        self.assertEqual([msg['sha1'] for uid, msg in fetched], [msg.sha1() for msg in self.msgs])
+        self.assertEqual([msg['flags'] for uid, msg in fetched], ['\\Seen', '', '\\Seen', '', '\\Seen'])
+        self.assertEqual(fetched[0][1]['internaldate'], self.msgs[0].date)
+        # One UID FETCH per batch, and no body
+        self.assertEqual(self.account.sent('^UID FETCH'), [
+            'UID FETCH 1:2 %s' % EmailMsg.FetchItems,
+            'UID FETCH 3:4 %s' % EmailMsg.FetchItems,
+            'UID FETCH 5 %s' % EmailMsg.FetchItems])
+        self.assertEqual(self.account.downloads, [])
+
+    def testSizes(self):
+        sizes = {}
+        for uid, msg in EmailMsg.fetchAll(self.server, ['2', '4'], 500, 1, sizes):
+            # Known before the message is yielded
+            self.assertTrue(uid in sizes)
+        self.assertEqual(sizes, {'2': len(self.msgs[1].body), '4': len(self.msgs[3].body)})
+
+    def testMissing(self):
+        # UID 3 was expunged, so the bulk FETCH leaves it out, and it's
+        # retried by itself
+        self.account.expunge(AllMail, 3)
+        fetched = dict(EmailMsg.fetchAll(self.server, ['2', '3', '4'], 500))
+        self.assertTrue(fetched['2'].OK and fetched['4'].OK)
+        self.assertFalse(fetched['3'].OK)
+        self.assertEqual(self.account.sent('^UID FETCH'), [
+            'UID FETCH 2:4 %s' % EmailMsg.FetchItems,
+            'UID FETCH 3 %s' % EmailMsg.FetchItems])
+
+
+    def testPipelined(self):
+        # The server answers the commands in flight all at once, one
+        # response from each in turn
+        self.account.interleave = True
+        for batchSz in (1, 2):
+            del self.account.commands[:]
+            fetched = list(EmailMsg.fetchAll(self.server, ['1', '2', '3', '4', '5'], batchSz, 8))
+            self.assertEqual([uid for uid, msg in fetched], ['1', '2', '3', '4', '5'])
+            self.assertEqual([msg['sha1'] for uid, msg in fetched], [msg.sha1() for msg in self.msgs])
+            self.assertEqual([msg['flags'] for uid, msg in fetched], ['\\Seen', '', '\\Seen', '', '\\Seen'])
+            # None was missing from its own batch, and retried by itself
+            self.assertEqual(len(self.account.sent('^UID FETCH')), (5 + batchSz - 1) / batchSz)
+
+    def testPipelinedBodies(self):
+        self.account.interleave = True
+        data = {}
+        for batch, result, rsp in self.server.fetchBatches([['1'], ['2', '3'], ['4'], ['5']], '(UID RFC822)', 8):
+            self.assertEqual(result, 'OK')
+            for uid, response in self.server.splitFetch(rsp):
+                data[uid] = response[0][1]
+                self.assertTrue(uid in batch)
+        self.assertEqual(data, dict([(str(n + 1), msg.body) for n, msg in enumerate(self.msgs)]))
+
+
+class SaveMsgsTest(ServerTest):
+
+    def setUp(self):
+        ServerTest.setUp(self)
+        self.store = bagoma.msgStore(self.dir)
+        self.sizes = dict([(str(n + 1), len(msg.body)) for n, msg in enumerate(self.msgs)])
+
+    def testBulk(self):
+        saved, failed = self.server.saveMsgs(self.uidSha([1, 2, 3]), self.dir, self.sizes)
+        self.assertEqual((saved, failed), (3, []))
+        for msg in self.msgs[:3]:
+            self.assertEqual(self.store.read(msg.sha1()), msg.body)
+        # A single UID FETCH for all the bodies
+        self.assertEqual(self.account.sent('^UID FETCH'), ['UID FETCH 1:3 RFC822'])
+        self.assertEqual(sorted(self.account.downloads), [(AllMail, 1), (AllMail, 2), (AllMail, 3)])
+
+    def testSizesAsked(self):
+        self.server.saveMsgs(self.uidSha([1, 2]), self.dir)
+        self.assertEqual(self.account.sent('^UID FETCH'), ['UID FETCH 1:2 (RFC822.SIZE)', 'UID FETCH 1:2 RFC822'])
+
+    def testAlreadySaved(self):
+        self.server.saveMsgs(self.uidSha([2]), self.dir, self.sizes)
+        saved, failed = self.server.saveMsgs(self.uidSha([1, 2, 3]), self.dir, self.sizes)
+        self.assertEqual((saved, failed), (2, []))
+        self.assertEqual(self.account.sent('^UID FETCH'), ['UID FETCH 2 RFC822', 'UID FETCH 1,3 RFC822'])
+
+    def testMissing(self):
+        # Left out of the bulk response, then retried by itself
+        self.account.expunge(AllMail, 2)
+        saved, failed = self.server.saveMsgs(self.uidSha([1, 2, 3]), self.dir, self.sizes)
+        self.assertEqual((saved, failed), (2, self.uidSha([2])))
+        self.assertEqual(self.account.sent('^UID FETCH'), ['UID FETCH 1:3 RFC822', 'UID FETCH 2 RFC822'])
+        self.assertFalse(self.store.exists(self.msgs[1].sha1()))
+
+
+class LargeMsgTest(ServerTest):
+    """A message of 5000 bytes, downloaded 2 KB at a time"""
+
+    def setUp(self):
+        ServerTest.setUp(self)
+        bagoma.options.chunkSize = 2
+        self.big = Message(6, size=5000)
+        self.account.deliver(self.big, [])
+        self.store = bagoma.msgStore(self.dir)
+        self.part = self.store.partPath(self.big.sha1())
+
+    def save(self):
+        self.assertTrue(self.server.saveLargeMsg('6', self.big.sha1(), len(self.big.body), self.dir))
+        self.assertEqual(self.store.read(self.big.sha1()), self.big.body)
+        # Hashed as it was downloaded
+        self.assertEqual(self.store.checksum(self.big.sha1()), hashlib.sha1(self.big.body).hexdigest())
+        self.assertFalse(os.path.exists(self.part))
+
+    def testChunks(self):
+        self.save()
+        self.assertEqual(self.account.sent('^UID FETCH'), [
+            'UID FETCH 6 "BODY.PEEK[]<0.2048>"',
+            'UID FETCH 6 "BODY.PEEK[]<2048.2048>"',
+            'UID FETCH 6 "BODY.PEEK[]<4096.2048>"'])
+        # The .part file became the message file
+        self.assertEqual(self.store.find(self.big.sha1()), (self.store.path(self.big.sha1()), 'none'))
+
+    def testResume(self):
+        self.store.makeDir(os.path.dirname(self.part))
+        with open(self.part, 'wb') as f:
+            f.write(self.big.body[:3000])
+        self.save()
+        self.assertEqual(self.account.sent('^UID FETCH'), ['UID FETCH 6 "BODY.PEEK[]<3000.2048>"'])
+
+    def testPack(self):
+        self.store.setLayout('pack')
+        self.save()
+        self.assertEqual(self.store.packed(), [self.big.sha1()])
+
+    def testCompressed(self):
+        self.store.setFormat('gzip')
+        self.save()
+        self.assertEqual(self.store.find(self.big.sha1())[1], 'gzip')
+
+
+class ReconnectTest(ServerTest):
+    """The connection drops in the middle of a command, and the command is sent again on a new one"""
+
+    def setUp(self):
+        ServerTest.setUp(self)
+        self.sleep = time.sleep
+        time.sleep = lambda secs: None
+        self.reconnects = ImapServer.Reconnects
+
+    def tearDown(self):
+        time.sleep = self.sleep
+        ServerTest.tearDown(self)
+
+    def assertReconnected(self, times):
+        self.assertEqual(ImapServer.Reconnects - self.reconnects, times)
+        self.assertEqual(self.account.connections, times + 1)
+
+    def testHeaders(self):
+        self.account.dropOn('^UID FETCH 3:4 ')
+        fetched = list(EmailMsg.fetchAll(self.server, ['1', '2', '3', '4', '5'], 2))
+        self.assertEqual([msg['sha1'] for uid, msg in fetched], [msg.sha1() for msg in self.msgs])
+        self.assertReconnected(1)
+        # All Mail is selected again on the new connection
+        self.assertEqual(self.account.sent('^UID FETCH 3:4 '), ['UID FETCH 3:4 %s' % EmailMsg.FetchItems] * 2)
+        self.assertEqual(self.account.sent('^EXAMINE'), ['EXAMINE "%s"' % AllMail] * 2)
+
+    def testMidBody(self):
+        # In the middle of the second message
+        sizes = dict([(str(n + 1), len(msg.body)) for n, msg in enumerate(self.msgs)])
+        self.account.dropOn('^UID FETCH 1:3 RFC822', after=sizes['1'] + sizes['2'] / 2 + 100)
+        saved, failed = self.server.saveMsgs(self.uidSha([1, 2, 3]), self.dir, sizes)
+        self.assertEqual((saved, failed), (3, []))
+        store = bagoma.msgStore(self.dir)
+        for msg in self.msgs[:3]:
+            self.assertEqual(store.read(msg.sha1()), msg.body)
+        self.assertReconnected(1)
+        # Nothing is left of the message cut short
+        self.assertEqual([f for dir, dirs, files in os.walk(self.dir) for f in files if f.endswith('.tmp')], [])
+
+    def testGiveUp(self):
+        bagoma.options.reconnects = 2
+        for n in range(3):
+            self.account.dropOn('^UID FETCH')
+        self.assertRaises(self.server.abort, list, EmailMsg.fetchAll(self.server, ['1', '2'], 2))
+        self.assertEqual(len(self.account.sent('^UID FETCH')), 3)
+
+    def testLargeMsg(self):
+        bagoma.options.chunkSize = 2
+        big = Message(6, size=5000)
+        self.account.deliver(big, [])
+        # 1000 bytes into the second chunk (with the FETCH response line)
+        self.account.dropOn(r'^UID FETCH 6 "BODY.PEEK\[\]<2048\.', after=1000)
+        self.assertTrue(self.server.saveLargeMsg('6', big.sha1(), len(big.body), self.dir))
+        store = bagoma.msgStore(self.dir)
+        self.assertEqual(store.read(big.sha1()), big.body)
+        self.assertEqual(store.checksum(big.sha1()), hashlib.sha1(big.body).hexdigest())
+        self.assertReconnected(1)
+        # The next chunk starts after what was received of the one cut short
+        offsets = [int(re.search(r'<(\d+)\.', c).group(1)) for c in self.account.sent('^UID FETCH')]
+        self.assertEqual(len(offsets), 3)
+        self.assertEqual(offsets[:2], [0, 2048])
+        self.assertTrue(2048 < offsets[2] < 3048)
+
+
+class DownloadPoolTest(ServerTest):
+
+    def testPool(self):
+        pool = DownloadPool(self.server, AllMail, self.dir, 3)
+        self.assertEqual(len(pool.workers), 2)
+        pool.submit(self.uidSha([1, 2]))
+        pool.submit(self.uidSha([3]))
+        pool.submit(self.uidSha([4, 5]))
+        self.assertEqual(pool.close(), (5, []))
+
+        self.assertEqual(self.account.connections, 3)
+        store = bagoma.msgStore(self.dir)
+        for msg in self.msgs:
+            self.assertEqual(store.read(msg.sha1()), msg.body)
+        # Each body once
+        self.assertEqual(sorted(self.account.downloads), [(AllMail, uid) for uid in range(1, 6)])
+
+    def testSingleConnection(self):
+        pool = DownloadPool(self.server, AllMail, self.dir, 1)
+        self.assertEqual(pool.workers, [])
+        pool.submit(self.uidSha([1, 2]))
+        # Downloaded as soon as submitted
+        self.assertEqual(pool.saved, 2)
+        self.assertEqual(pool.close(), (2, []))
+        self.assertEqual(self.account.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for how the folders are indexed, against a fake IMAP server"""
+
+import re
+import shutil
+import logging
+import tempfile
+import unittest
+
+import bagoma
+from bagoma import EmailMsg, EmailFolder
+
+import fakeimap
+from fakeimap import Account, Message, AllMail
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+bagoma.progress = lambda msg: None
+
+
+class FolderTest(unittest.TestCase):
+    """
+    Six messages: 1-4 in INBOX, 3-6 in Work, and 6 in Sent. Their UIDs in
+    each folder are not the same as in All Mail.
+    """
+    capabilities = Account.Capabilities
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bagoma.options = fakeimap.makeOptions(backupDir=self.dir, batchSize=2)
+        self.account = Account(self.capabilities)
+        self.account.mailbox('[Gmail]/Sent Mail', '\\HasNoChildren \\Sent')
+        self.account.mailbox('Work')
+        self.msgs = [Message(n) for n in range(1, 7)]
+        for n, msg in enumerate(self.msgs):
+            labels = [name for name, first, last in (('INBOX', 0, 3), ('Work', 2, 5), ('[Gmail]/Sent Mail', 5, 5))
+                      if first <= n <= last]
+            self.account.deliver(msg, labels)
+        self.server = fakeimap.connect(self.account)
+
+    def tearDown(self):
+        self.server.logout()
+        store = bagoma.msgStores.pop(self.dir, None)
+        if store is not None:
+            store.packs.close()
+        shutil.rmtree(self.dir)
+
+    def sha1(self, *ns):
+        return [self.msgs[n - 1].sha1() for n in ns]
+
+    def backUp(self, oldMsgs={}, oldFlds={}):
+        """Downloads All Mail, and indexes the other folders"""
+        messages, allMail = self.server.saveAllMsgs(self.dir, oldMsgs, oldFlds)
+        flds, messages = self.server.indexAllFolders(messages, oldFlds, allMail)
+        return (messages, flds)
+
+    def folderOf(self, msgs):
+        return dict([(sha1, sorted(msg['folder'])) for sha1, msg in msgs.items()])
+
+    def checkIndex(self, messages, flds):
+        self.assertEqual(sorted(flds.keys()), ['INBOX', 'Work', AllMail, '[Gmail]/Sent Mail'])
+        self.assertEqual(flds['INBOX'].msgs.items(), zip(['1', '2', '3', '4'], self.sha1(1, 2, 3, 4)))
+        self.assertEqual(flds['Work'].msgs.items(), zip(['1', '2', '3', '4'], self.sha1(3, 4, 5, 6)))
+        self.assertEqual(flds['[Gmail]/Sent Mail'].msgs.items(), [('1', self.sha1(6)[0])])
+        self.assertEqual(flds[AllMail].msgs.values(), self.sha1(1, 2, 3, 4, 5, 6))
+        folders = self.folderOf(messages)
+        self.assertEqual(folders[self.sha1(1)[0]], ['INBOX', AllMail])
+        self.assertEqual(folders[self.sha1(3)[0]], ['INBOX', 'Work', AllMail])
+        self.assertEqual(folders[self.sha1(6)[0]], ['Work', AllMail, '[Gmail]/Sent Mail'])
+
+
+class LabelTest(FolderTest):
+
+    def testLabels(self):
+        messages, flds = self.backUp()
+        self.checkIndex(messages, flds)
+        # The labels of All Mail in batches, then the X-GM-MSGID of each
+        # folder with a single FETCH, and no headers but All Mail's
+        self.assertEqual(self.account.sent(r'X-GM-'), [
+            'UID FETCH 1:2 (UID X-GM-MSGID X-GM-LABELS)',
+            'UID FETCH 3:4 (UID X-GM-MSGID X-GM-LABELS)',
+            'UID FETCH 5:6 (UID X-GM-MSGID X-GM-LABELS)',
+            'UID FETCH 1:4 (UID X-GM-MSGID)',
+            'UID FETCH 1 (UID X-GM-MSGID)',
+            'UID FETCH 1:4 (UID X-GM-MSGID)'])
+        self.assertEqual(len(self.account.sent(r'HEADER\.FIELDS')), 3)
+
+    def testUnknownMsgId(self):
+        # Not in All Mail (as if it arrived after All Mail was indexed), so
+        # its X-GM-MSGID is unknown and its headers are fetched
+        msg = Message(7)
+        self.account.mailbox('Work').add(msg)
+        messages, allMail = self.server.saveAllMsgs(self.dir, {}, {})
+        flds, messages = self.server.indexAllFolders(messages, {}, allMail)
+        self.assertEqual(flds['Work'].msgs['5'], msg.sha1())
+        self.assertEqual(self.account.sent(r'^UID FETCH 5 \(UID FLAGS'), ['UID FETCH 5 %s' % EmailMsg.FetchItems])
+
+
+class NoLabelTest(FolderTest):
+    capabilities = [c for c in Account.Capabilities if c != 'X-GM-EXT-1']
+
+    def testHeaders(self):
+        messages, flds = self.backUp()
+        self.checkIndex(messages, flds)
+        self.assertEqual(self.account.sent(r'X-GM-'), [])
+        # All Mail, INBOX, Work and Sent, options.batchSize at a time
+        self.assertEqual(len(self.account.sent(r'HEADER\.FIELDS')), 3 + 2 + 2 + 1)
+
+
+class ParallelTest(FolderTest):
+    """The folders indexed over three connections"""
+
+    def backUp(self, oldMsgs={}, oldFlds={}):
+        messages, allMail = self.server.saveAllMsgs(self.dir, oldMsgs, oldFlds)
+        bagoma.options.connections = 3
+        connections = self.account.connections
+        flds, messages = self.server.indexAllFolders(messages, oldFlds, allMail)
+        # One for each of the other two
+        self.assertEqual(self.account.connections - connections, 2)
+        return (messages, flds)
+
+    def testLabels(self):
+        messages, flds = self.backUp()
+        self.checkIndex(messages, flds)
+        # Each folder once, whichever connection took it
+        for name in ('INBOX', 'Work', '[Gmail]/Sent Mail'):
+            self.assertEqual(len(self.account.sent(r'^EXAMINE "?%s"?$' % re.escape(name))), 1)
+        self.assertEqual(self.account.sent(r'^LOGOUT'), ['LOGOUT'] * 2)
+
+    def testHeaders(self):
+        self.account.capabilities = [c for c in Account.Capabilities if c != 'X-GM-EXT-1']
+        self.server = fakeimap.connect(self.account)
+        messages, flds = self.backUp()
+        self.checkIndex(messages, flds)
+        self.assertEqual(self.account.sent(r'X-GM-'), [])
+
+    def testFailedFolder(self):
+        self.account.failOn(r'^EXAMINE "?Work"?$')
+        messages, flds = self.backUp()
+        self.assertEqual(sorted(flds.keys()), ['INBOX', AllMail, '[Gmail]/Sent Mail'])
+        self.assertEqual(flds['INBOX'].msgs.items(), zip(['1', '2', '3', '4'], self.sha1(1, 2, 3, 4)))
+
+
+class ChangesTest(FolderTest):
+    """A second backup, after flag changes, expunges and a new message"""
+
+    def change(self):
+        self.account.setFlags(self.msgs[1], '\\Flagged')
+        # Message 3 loses its INBOX label, and message 5 is deleted
+        self.account.expunge('INBOX', 3)
+        self.account.expunge('Work', 3)
+        self.account.expunge(AllMail, 5)
+        self.msgs.append(Message(7))
+        self.account.deliver(self.msgs[-1], ['INBOX'])
+
+    def backUpAgain(self):
+        messages, flds = self.backUp()
+        modseq = self.account.modseq
+        self.change()
+        start = len(self.account.commands)
+        messages, flds = self.backUp(messages, flds)
+        return (messages, flds, modseq, self.account.commands[start:])
+
+    def testChanges(self):
+        messages, flds, modseq, commands = self.backUpAgain()
+        self.assertEqual(flds[AllMail].msgs.values(), self.sha1(1, 2, 3, 4, 6, 7))
+        self.assertEqual(flds['INBOX'].msgs.items(), zip(['1', '2', '4', '5'], self.sha1(1, 2, 4, 7)))
+        self.assertEqual(flds['Work'].msgs.items(), zip(['1', '2', '4'], self.sha1(3, 4, 6)))
+        self.assertEqual(messages[self.sha1(2)[0]]['flags'], '\\Flagged')
+        self.assertEqual(self.folderOf(messages)[self.sha1(3)[0]], ['Work', AllMail])
+
+        # Only the changes and the new UIDs of each folder are asked for
+        changes = 'UID FETCH 1:* (UID FLAGS) (CHANGEDSINCE %d VANISHED)' % modseq
+        self.assertEqual([c for c in commands if 'CHANGEDSINCE' in c], [changes] * 4)
+        self.assertEqual([c for c in commands if 'SEARCH' in c],
+                         ['UID SEARCH UID 7:*', 'UID SEARCH UID 5:*', 'UID SEARCH UID 2:*', 'UID SEARCH UID 5:*'])
+        # Only the new message is downloaded
+        self.assertEqual([c for c in commands if c.endswith('RFC822')], ['UID FETCH 7 RFC822'])
+
+    def testFailedChanges(self):
+        messages, flds = self.backUp()
+        modseq = self.account.modseq
+        self.change()
+        self.account.failOn(r'CHANGEDSINCE')
+        start = len(self.account.commands)
+        # All Mail's UIDs are listed in full instead, and its flags come
+        # from the old index
+        messages, flds = self.backUp(messages, flds)
+        self.assertEqual(flds[AllMail].msgs.values(), self.sha1(1, 2, 3, 4, 6, 7))
+        commands = self.account.commands[start:]
+        failed = [n for n, c in enumerate(commands) if 'CHANGEDSINCE' in c][0]
+        self.assertEqual(commands[failed + 1], 'UID SEARCH RETURN (ALL) ALL')
+        self.assertEqual(messages[self.sha1(2)[0]]['flags'], '')
+        # The next backup asks for the changes since then again
+        self.assertEqual(flds[AllMail]['HIGHESTMODSEQ'], modseq)
+
+
+class CondstoreTest(ChangesTest):
+    capabilities = [c for c in Account.Capabilities if c != 'QRESYNC']
+
+    def testChanges(self):
+        messages, flds, modseq, commands = self.backUpAgain()
+        self.assertEqual(flds[AllMail].msgs.values(), self.sha1(1, 2, 3, 4, 6, 7))
+        self.assertEqual(flds['INBOX'].msgs.items(), zip(['1', '2', '4', '5'], self.sha1(1, 2, 4, 7)))
+        self.assertEqual(messages[self.sha1(2)[0]]['flags'], '\\Flagged')
+        # The flags of All Mail only, and every folder's UIDs are listed
+        self.assertEqual([c for c in commands if 'CHANGEDSINCE' in c],
+                         ['UID FETCH 1:* (UID FLAGS) (CHANGEDSINCE %d)' % modseq])
+        self.assertEqual(len([c for c in commands if c.startswith('UID SEARCH RETURN')]), 4)
+
+
+class PrescanTest(FolderTest):
+
+    def backUpScanned(self, oldMsgs, oldFlds):
+        """Backs up only the folders that changed since oldFlds (see backup)"""
+        start = len(self.account.commands)
+        self.server.prescan([f for f in self.server.getFolders() if f not in self.server.IgnoredFolders])
+        messages, flds = self.backUp(oldMsgs, oldFlds)
+        return (messages, flds, self.account.commands[start:])
+
+    def testStatus(self):
+        folderNames = self.server.getFolders()
+        start = len(self.account.commands)
+        self.server.prescan(folderNames)
+        self.assertEqual(self.account.commands[start:],
+                         ['LIST "" * RETURN (STATUS (MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ))'])
+        self.assertEqual(self.server.folderStatus['Work'],
+                         {'MESSAGES': 4, 'UIDNEXT': 5, 'UIDVALIDITY': 1, 'HIGHESTMODSEQ': 1})
+        self.assertEqual(sorted(self.server.folderStatus.keys()), ['INBOX', 'Work', AllMail, '[Gmail]/Sent Mail'])
+
+    def testUnchanged(self):
+        messages, flds = self.backUp()
+        messages, flds, commands = self.backUpScanned(messages, flds)
+        self.checkIndex(messages, flds)
+        self.assertEqual([c for c in commands if c.startswith('EXAMINE')], [])
+
+    def testNewMessage(self):
+        messages, flds = self.backUp()
+        self.msgs.append(Message(7))
+        self.account.deliver(self.msgs[-1], ['INBOX'])
+        messages, flds, commands = self.backUpScanned(messages, flds)
+        self.assertEqual(flds['INBOX'].msgs.values(), self.sha1(1, 2, 3, 4, 7))
+        self.assertEqual(flds['Work'].msgs.values(), self.sha1(3, 4, 5, 6))
+        self.assertEqual(self.folderOf(messages)[self.sha1(4)[0]], ['INBOX', 'Work', AllMail])
+        # All Mail twice: for the download, and for the labels
+        self.assertEqual([c for c in commands if c.startswith('EXAMINE')],
+                         ['EXAMINE "[Gmail]/All Mail"', 'EXAMINE "[Gmail]/All Mail"', 'EXAMINE INBOX'])
+
+    def testFlagsChanged(self):
+        # Only All Mail needs a look
+        messages, flds = self.backUp()
+        self.account.setFlags(self.msgs[4], '\\Seen')
+        messages, flds, commands = self.backUpScanned(messages, flds)
+        self.assertEqual(messages[self.sha1(5)[0]]['flags'], '\\Seen')
+        self.assertEqual([c for c in commands if c.startswith('EXAMINE')], ['EXAMINE "[Gmail]/All Mail"'])
+        self.checkIndex(messages, flds)
+
+
+class StatusTest(PrescanTest):
+    capabilities = [c for c in Account.Capabilities if c != 'LIST-STATUS']
+
+    def testStatus(self):
+        start = len(self.account.commands)
+        self.server.prescan(['INBOX', 'Work'])
+        self.assertEqual(self.account.commands[start:], [
+            'STATUS INBOX (MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ)',
+            'STATUS Work (MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ)'])
+        self.assertEqual(self.server.folderStatus['INBOX'],
+                         {'MESSAGES': 4, 'UIDNEXT': 5, 'UIDVALIDITY': 1, 'HIGHESTMODSEQ': 1})
+
+
+class SearchTest(unittest.TestCase):
+    """Lists the UIDs of a folder of 300 messages, with gaps"""
+    capabilities = Account.Capabilities
+
+    def setUp(self):
+        bagoma.options = fakeimap.makeOptions()
+        self.account = Account(self.capabilities)
+        self.account.mailbox('Empty')
+        for n in range(1, 301):
+            self.account.deliver(Message(n), ['Big'])
+        for uid in [2, 3, 4, 100, 300]:
+            self.account.expunge('Big', uid)
+        self.uids = [str(uid) for uid in range(1, 301) if uid not in (2, 3, 4, 100, 300)]
+        self.server = fakeimap.connect(self.account)
+
+    def tearDown(self):
+        self.server.logout()
+
+    def searches(self):
+        return self.account.sent('SEARCH')
+
+    def testEsearch(self):
+        folder = EmailFolder(self.server, 'Big')
+        self.assertTrue(folder.OK)
+        self.assertEqual(list(folder.UIDs), self.uids)
+        self.assertEqual(str(folder.UIDs), '1,5:99,101:299')
+        self.assertEqual(self.searches(), ['UID SEARCH RETURN (ALL) ALL'])
+
+    def testEmpty(self):
+        folder = EmailFolder(self.server, 'Empty')
+        self.assertTrue(folder.OK)
+        self.assertEqual(list(folder.UIDs), [])
+        self.assertEqual(self.searches(), [])
+
+    def testFailed(self):
+        # Falls back to UID SEARCH by blocks of message numbers
+        self.account.failOn('RETURN')
+        folder = EmailFolder(self.server, 'Big')
+        self.assertTrue(folder.OK)
+        self.assertEqual(list(folder.UIDs), self.uids)
+        self.assertEqual(self.searches(), ['UID SEARCH RETURN (ALL) ALL', 'UID SEARCH 1:250', 'UID SEARCH 251:500'])
+
+
+class NoEsearchTest(SearchTest):
+    capabilities = [c for c in Account.Capabilities if c != 'ESEARCH']
+
+    def testEsearch(self):
+        folder = EmailFolder(self.server, 'Big')
+        self.assertEqual(list(folder.UIDs), self.uids)
+        self.assertEqual(self.searches(), ['UID SEARCH 1:250', 'UID SEARCH 251:500'])
+
+    def testFailed(self):
+        self.account.failOn('SEARCH 251')
+        folder = EmailFolder(self.server, 'Big')
+        self.assertFalse(folder.OK)
+
+
+if __name__ == '__main__':
+    unittest.main()
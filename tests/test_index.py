@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for the index stores (PickleIndex, SqliteIndex)"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+import hashlib
+
+import bagoma
+from bagoma import EmailMsg, EmailFolder, UidMap, UidSet, PickleIndex, SqliteIndex
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+
+
+def makeMsg(n, folders):
+    # EmailMsg.__init__ would query the server
+    msg = EmailMsg.__new__(EmailMsg)
+    msg.update({'sha1':sha1(n), 'uid':str(n), 'flags':'\\Seen' if n % 2 else '',
+                'internaldate':'%02d-Jul-2012 02:44:25 +0000' % (n % 28 + 1), 'folder':folders})
+    msg.OK = True
+    return msg
+
+def makeFolder(name, uidSha1, uidValidity=1, dupUIDs=()):
+    folder = EmailFolder.__new__(EmailFolder)
+    folder.update({'UIDVALIDITY':uidValidity, 'UIDNEXT':max([int(uid) for uid in uidSha1] + [0]) + 1,
+                   'EXISTS':len(uidSha1), 'RECENT':0, 'HIGHESTMODSEQ':1234L,
+                   'Type':frozenset(['\\AllMail']) if name == 'All' else frozenset(),
+                   'FLAGS':('\\Answered', '\\Seen')})
+    folder.OK = True
+    folder.name = name
+    folder.msgs = UidMap(uidSha1)
+    folder.UIDs = UidSet(uidSha1.keys() + list(dupUIDs))
+    folder.dupUIDs = UidSet(dupUIDs)
+    folder.changedFlags = {}
+    return folder
+
+def sha1(n):
+    return hashlib.sha1(str(n)).hexdigest()
+
+def msgsOf(messages):
+    return dict([(sha, dict(msg.items())) for sha, msg in messages.items()])
+
+def fldsOf(flds):
+    return dict([(name, (dict(fld), sorted(fld.msgs.items()), str(fld.UIDs), str(fld.dupUIDs)))
+                 for name, fld in flds.items()])
+
+
+class IndexTest(object):
+    """The tests run on both index stores (see makeIndex)"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.messages = dict([(sha1(n), makeMsg(n, ['All', 'INBOX'] if n < 3 else ['All'])) for n in range(1, 6)])
+        self.flds = {
+            'All':makeFolder('All', dict([(str(n), sha1(n)) for n in range(1, 6)]), dupUIDs=['6']),
+            'INBOX':makeFolder('INBOX', {'10':sha1(1), '11':sha1(2)}, uidValidity=7),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testEmpty(self):
+        index = self.makeIndex()
+        self.assertFalse(index.exists())
+        self.assertEqual(index.loadMsgs(), {})
+        self.assertEqual(index.loadFlds(), {})
+
+    def testRoundTrip(self):
+        index = self.makeIndex()
+        index.saveMsgs(self.messages)
+        index.saveFlds(self.flds)
+        self.assertTrue(index.exists())
+
+        index = self.makeIndex()
+        self.assertEqual(msgsOf(index.loadMsgs()), msgsOf(self.messages))
+        self.assertEqual(fldsOf(index.loadFlds()), fldsOf(self.flds))
+
+    def testChanges(self):
+        index = self.makeIndex()
+        index.saveMsgs(self.messages)
+        index.saveFlds(self.flds)
+
+        del self.messages[sha1(5)]
+        self.messages[sha1(1)]['flags'] = '\\Flagged'
+        self.messages[sha1(7)] = makeMsg(7, ['All'])
+        del self.flds['INBOX']
+        del self.flds['All'].msgs['5']
+        self.flds['All'].msgs['7'] = sha1(7)
+        index.saveMsgs(self.messages)
+        index.saveFlds(self.flds)
+
+        index = self.makeIndex()
+        self.assertEqual(msgsOf(index.loadMsgs()), msgsOf(self.messages))
+        self.assertEqual(fldsOf(index.loadFlds()), fldsOf(self.flds))
+
+    def testCheckpoint(self):
+        index = self.makeIndex()
+        index.saveMsgs(self.messages)
+        index.saveFlds(self.flds)
+
+        # What Checkpoint.save writes
+        newMsgs = {sha1(8):makeMsg(8, ['All'])}
+        index.addMsgs(newMsgs)
+        header = makeFolder('All', {})
+        header['UIDNEXT'] = 9
+        inbox = makeFolder('INBOX', {'12':sha1(8)}, uidValidity=8)
+        index.addFlds({'INBOX':inbox}, {'All':(header, [('8', sha1(8))])})
+
+        self.messages.update(newMsgs)
+        self.flds['All'].msgs['8'] = sha1(8)
+        self.flds['All']['UIDNEXT'] = 9
+        self.flds['INBOX'] = inbox
+
+        index = self.makeIndex()
+        self.assertEqual(msgsOf(index.loadMsgs()), msgsOf(self.messages))
+        loaded = index.loadFlds()
+        self.assertEqual(sorted(loaded['All'].msgs.items()), sorted(self.flds['All'].msgs.items()))
+        self.assertEqual(loaded['All']['UIDNEXT'], 9)
+        self.assertEqual(fldsOf({'INBOX':loaded['INBOX']}), fldsOf({'INBOX':inbox}))
+
+
+class PickleIndexTest(IndexTest, unittest.TestCase):
+
+    def makeIndex(self):
+        return PickleIndex(self.dir)
+
+    def testSaveDropsCheckpoints(self):
+        index = self.makeIndex()
+        index.addMsgs(self.messages)
+        self.assertTrue(os.path.exists(index.checkpointFile))
+        index.saveMsgs(self.messages)
+        index.saveFlds(self.flds)
+        self.assertFalse(os.path.exists(index.checkpointFile))
+
+
+class SqliteIndexTest(IndexTest, unittest.TestCase):
+
+    def makeIndex(self):
+        return SqliteIndex(self.dir)
+
+    def testMigrate(self):
+        pickleIndex = PickleIndex(self.dir)
+        pickleIndex.saveMsgs(self.messages)
+        pickleIndex.saveFlds(self.flds)
+
+        index = self.makeIndex()
+        index.migrate(pickleIndex)
+        self.assertEqual(msgsOf(index.loadMsgs()), msgsOf(self.messages))
+        self.assertEqual(fldsOf(index.loadFlds()), fldsOf(self.flds))
+
+
+if __name__ == '__main__':
+    unittest.main()
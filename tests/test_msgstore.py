@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for MsgStore and the message files"""
+
+import os
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+import unittest
+from email.parser import HeaderParser
+
+import bagoma
+from bagoma import MsgStore, PackSet, EmailMsg
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+bagoma.progress = lambda msg: None
+
+BODY = 'From: alice@example.com\r\nSubject: Hello\r\n\r\n' + 'Some text\r\n' * 2000
+
+
+def sha1(n):
+    return hashlib.sha1(str(n)).hexdigest()
+
+
+class MsgStoreTest(unittest.TestCase):
+    """Runs on the files layout. See PackStoreTest for the pack layout."""
+    layout = 'files'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = self.makeStore()
+
+    def tearDown(self):
+        bagoma.msgStores.pop(self.dir, None)
+        self.store.packs.close()
+        shutil.rmtree(self.dir)
+
+    def makeStore(self, format=None):
+        store = MsgStore(self.dir)
+        if format is not None:
+            store.setFormat(format)
+        if store.layout != self.layout:
+            store.setLayout(self.layout)
+        return store
+
+    def save(self, sha, body=BODY, store=None):
+        store = store or self.store
+        with store.create(sha, size=len(body)) as f:
+            for start in range(0, len(body), 1000):
+                f.write(body[start:start + 1000])
+        store.sync()
+
+    def testFormats(self):
+        for n, fmt in enumerate(MsgStore.available()):
+            store = self.makeStore(fmt)
+            self.save(sha1(n), store=store)
+            self.assertTrue(store.exists(sha1(n)))
+            self.assertEqual(store.read(sha1(n)), BODY)
+            self.assertEqual(store.readHeaders(sha1(n)), 'From: alice@example.com\r\nSubject: Hello')
+            f, size = store.open(sha1(n))
+            self.assertEqual((f.read(), size), (BODY, len(BODY)))
+            f.close()
+
+        # Messages in any format can be read
+        store = self.makeStore()
+        for n, fmt in enumerate(MsgStore.available()):
+            self.assertEqual(store.read(sha1(n)), BODY)
+
+    def testConfig(self):
+        self.makeStore('gzip')
+        store = MsgStore(self.dir)
+        self.assertEqual((store.format, store.layout), ('gzip', self.layout))
+
+    def testCompress(self):
+        for fmt in MsgStore.available():
+            data = MsgStore.compress(BODY, fmt)
+            if fmt != 'none':
+                self.assertTrue(len(data) < len(BODY))
+            self.assertEqual(MsgStore.decompress(data, fmt), BODY)
+
+    def testParseName(self):
+        self.assertEqual(MsgStore.parseName(sha1(1)), (sha1(1), 'none'))
+        self.assertEqual(MsgStore.parseName(sha1(1) + '.gz'), (sha1(1), 'gzip'))
+        self.assertEqual(MsgStore.parseName(sha1(1) + '.zst'), (sha1(1), 'zstd'))
+        self.assertEqual(MsgStore.parseName('tmpXYZ.tmp'), ('tmpXYZ.tmp', None))
+        self.assertEqual(MsgStore.parseName(sha1(1) + '.part'), (sha1(1) + '.part', None))
+
+    def testShortWrite(self):
+        try:
+            with self.store.create(sha1(1), size=len(BODY) + 1) as f:
+                f.write(BODY)
+        except IOError:
+            pass
+        else:
+            self.fail("A message cut short was saved")
+        self.assertFalse(self.store.exists(sha1(1)))
+        self.assertEqual(self.tmpFiles(), [])
+
+    def testAbort(self):
+        try:
+            with self.store.create(sha1(1)) as f:
+                f.write(BODY)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(self.store.exists(sha1(1)))
+        self.assertEqual(self.tmpFiles(), [])
+
+    def testAdopt(self):
+        path = os.path.join(self.dir, 'message')
+        with open(path, 'wb') as f:
+            f.write(MsgStore.compress(BODY, self.store.format))
+        self.store.adopt(sha1(1), path, hashlib.sha1(BODY).hexdigest())
+        self.store.sync()
+        self.assertEqual(self.store.read(sha1(1)), BODY)
+        self.assertEqual(MsgStore(self.dir).checksum(sha1(1)), hashlib.sha1(BODY).hexdigest())
+        # Renamed, or left for the caller to remove
+        self.assertEqual(os.path.exists(path), self.layout == 'pack')
+
+    def testChecksum(self):
+        self.save(sha1(1))
+        digest = hashlib.sha1(BODY).hexdigest()
+        self.assertEqual(self.store.checksum(sha1(1)), digest)
+        # Loaded from BaGoMa.sums
+        self.assertEqual(MsgStore(self.dir).checksum(sha1(1)), digest)
+
+    def testMoveRemove(self):
+        self.save(sha1(1))
+        self.store.move(sha1(1), sha1(2))
+        self.assertFalse(self.store.exists(sha1(1)))
+        self.assertEqual(self.store.read(sha1(2)), BODY)
+        self.assertEqual(self.store.checksum(sha1(2)), hashlib.sha1(BODY).hexdigest())
+
+        self.store.remove(sha1(2))
+        self.store.sync()
+        self.assertFalse(self.store.exists(sha1(2)))
+        self.assertEqual(MsgStore(self.dir).checksum(sha1(2)), None)
+        self.assertRaises(IOError, self.store.read, sha1(2))
+
+    def testPruneSums(self):
+        self.save(sha1(1))
+        self.save(sha1(2))
+        self.store.pruneSums(set([sha1(2)]))
+        store = MsgStore(self.dir)
+        self.assertEqual(store.checksum(sha1(1)), None)
+        self.assertEqual(store.checksum(sha1(2)), hashlib.sha1(BODY).hexdigest())
+
+    def testReindex(self):
+        date = '17-Jul-2012 02:44:25 +0000'
+        other = BODY.replace('Hello', 'Bye')
+        good, moved = [EmailMsg.computeSha1(date, HeaderParser().parsestr(body, headersonly=True))
+                       for body in (BODY, other)]
+        self.save(good)
+        self.save(sha1(1), other)
+        self.save(sha1(2))
+        msgIndex = {good: {'internaldate': date, 'folder': []},
+                    sha1(1): {'internaldate': date, 'folder': []},
+                    sha1(2): {'internaldate': 'yesterday', 'folder': []}}
+        # A repack in progress, that the workers must leave alone
+        os.mkdir(self.store.packDir + '.new')
+
+        bagoma.msgStores[self.dir] = self.store
+        options = bagoma.options
+        bagoma.options = argparse.Namespace(processes=2, dryRun=False)
+        try:
+            bagoma.reindex(self.dir, msgIndex, {})
+        finally:
+            bagoma.options = options
+        self.store.sync()
+
+        # sha1(2) can't be checked without its internaldate, so it stays
+        self.assertEqual(sorted(msgIndex.keys()), sorted([good, moved, sha1(2)]))
+        self.assertEqual(self.store.read(moved), other)
+        self.assertFalse(self.store.exists(sha1(1)))
+        self.assertEqual(self.store.read(sha1(2)), BODY)
+        self.assertTrue(os.path.isdir(self.store.packDir + '.new'))
+
+    def tmpFiles(self):
+        return [f for dir, dirs, files in os.walk(self.dir) for f in files if f.endswith('.tmp')]
+
+
+class PackStoreTest(MsgStoreTest):
+    layout = 'pack'
+
+    def testPacked(self):
+        self.save(sha1(1))
+        self.assertEqual(self.store.packed(), [sha1(1)])
+        self.assertEqual(self.store.find(sha1(1)), (None, None))
+        self.assertFalse(os.path.exists(os.path.join(self.dir, sha1(1)[0:2])))
+
+    def testRepack(self):
+        for n in range(3):
+            self.save(sha1(n))
+        self.store.remove(sha1(1))
+        packs = self.store.newPacks()
+        for sha in self.store.packed():
+            data, fmt = self.store.packs.read(sha)
+            packs.append(sha, data, fmt)
+        self.store.swapPacks(packs)
+
+        store = MsgStore(self.dir)
+        self.assertEqual(sorted(store.packed()), sorted([sha1(0), sha1(2)]))
+        self.assertEqual(store.read(sha1(2)), BODY)
+        self.assertFalse(os.path.exists(store.packDir + '.new'))
+        self.assertFalse(os.path.exists(store.packDir + '.old'))
+        store.packs.close()
+
+
+class PackSetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.packs = PackSet(self.dir)
+
+    def tearDown(self):
+        self.packs.close()
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        self.packs.close()
+        self.packs = PackSet(self.dir)
+
+    def testReadBack(self):
+        self.packs.append(sha1(1), 'one', 'none')
+        self.packs.append(sha1(2), 'two', 'gzip')
+        # Readable before the sync
+        self.assertEqual(self.packs.read(sha1(1)), ('one', 'none'))
+        self.packs.sync()
+        self.reopen()
+        self.assertEqual(len(self.packs), 2)
+        self.assertEqual(self.packs.read(sha1(1)), ('one', 'none'))
+        self.assertEqual(self.packs.read(sha1(2)), ('two', 'gzip'))
+
+    def testRenameRemove(self):
+        self.packs.append(sha1(1), 'one', 'none')
+        self.packs.append(sha1(2), 'two', 'none')
+        self.packs.rename(sha1(1), sha1(3))
+        self.packs.remove(sha1(2))
+        self.reopen()
+        self.assertEqual(self.packs.keys(), [sha1(3)])
+        self.assertEqual(self.packs.read(sha1(3)), ('one', 'none'))
+
+    def testCutShortIndex(self):
+        self.packs.append(sha1(1), 'one', 'none')
+        self.packs.close()
+        with open(self.packs.indexFile, 'ab') as f:
+            f.write('%s 1 3' % sha1(2))
+
+        self.packs = PackSet(self.dir)
+        self.assertFalse(sha1(2) in self.packs)
+        self.packs.append(sha1(3), 'three', 'none')
+        self.packs.sync()
+        self.reopen()
+        self.assertEqual(sorted(self.packs.keys()), sorted([sha1(1), sha1(3)]))
+        self.assertEqual(self.packs.read(sha1(3)), ('three', 'none'))
+
+    def testNewPack(self):
+        maxSize = PackSet.MaxSize
+        PackSet.MaxSize = 10
+        try:
+            for n in range(3):
+                self.packs.append(sha1(n), 'message%d' % n, 'none')
+        finally:
+            PackSet.MaxSize = maxSize
+        self.reopen()
+        self.assertEqual(len([f for f in os.listdir(self.dir) if f.endswith('.pack')]), 3)
+        for n in range(3):
+            self.assertEqual(self.packs.read(sha1(n)), ('message%d' % n, 'none'))
+
+
+if __name__ == '__main__':
+    unittest.main()
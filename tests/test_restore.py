@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for RestoreJournal, and how a restore keeps track of All Mail"""
+
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+import bagoma
+from bagoma import RestoreJournal, restoreAllMailFld
+
+from test_index import makeMsg, makeFolder, sha1
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+
+
+class RestoreJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = RestoreJournal(self.dir)
+
+    def tearDown(self):
+        self.journal.remove()
+        shutil.rmtree(self.dir)
+
+    def testLoad(self):
+        self.journal.add([(sha1(1), '11'), (sha1(2), None)], 7)
+        self.journal.add([(sha1(3), '13')], 8)
+        self.assertEqual(RestoreJournal(self.dir).load(7), {sha1(1): '11', sha1(2): None})
+        self.assertEqual(RestoreJournal(self.dir).load(8), {sha1(3): '13'})
+        self.assertEqual(RestoreJournal(self.dir).loadPending(), set())
+
+    def testCutShort(self):
+        self.journal.add([(sha1(1), '11')], 7)
+        self.journal.file.write('%s 1' % sha1(2))
+        self.journal.file.flush()
+        self.assertEqual(RestoreJournal(self.dir).load(7), {sha1(1): '11'})
+        self.assertEqual(RestoreJournal(self.dir).loadPending(), set())
+
+    def testReset(self):
+        self.journal.add([(sha1(1), '11')], 7)
+        self.journal.reset([sha1(2), sha1(3)])
+        journal = RestoreJournal(self.dir)
+        self.assertEqual(journal.load(7), {})
+        self.assertEqual(journal.loadPending(), set([sha1(2), sha1(3)]))
+
+        # The next restore appends to it
+        journal.add([(sha1(2), '12')], 7)
+        self.assertEqual(RestoreJournal(self.dir).load(7), {sha1(2): '12'})
+        self.assertEqual(RestoreJournal(self.dir).loadPending(), set([sha1(2), sha1(3)]))
+
+        journal.reset([])
+        self.assertFalse(os.path.exists(journal.path))
+
+
+class FakeServer(object):
+    """An All Mail folder that holds allMail (UID => SHA1) under uidValidity"""
+    AllMailFolder = 'All'
+
+    def __init__(self, allMail, uidValidity):
+        self.folder = makeFolder('All', allMail, uidValidity)
+
+    def indexOneFolder(self, messages, oldFld, folderName):
+        return self.folder
+
+
+class RestoreAllMailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal = RestoreJournal(self.dir)
+        self.messages = dict([(sha1(n), makeMsg(n, ['All'])) for n in range(1, 4)])
+        self.allMail = makeFolder('All', dict([(str(n), sha1(n)) for n in range(1, 4)]), 1)
+        self.saved = (bagoma.EmailFolder, bagoma.uploadAll)
+        # Key = SHA1, value = the UID the server gives it (None if it doesn't
+        # say). The messages left out fail to upload.
+        self.newUids = {}
+        # The SHA1 of the messages uploaded
+        self.uploads = []
+
+    def tearDown(self):
+        bagoma.EmailFolder, bagoma.uploadAll = self.saved
+        self.journal.remove()
+        shutil.rmtree(self.dir)
+
+    def restore(self, server):
+        bagoma.EmailFolder = lambda srv, name: server.folder
+        def uploadAll(srv, backupDir, msgs, destFolder, done):
+            self.uploads.extend([msg['sha1'] for msg in msgs])
+            uploaded = dict([(msg['sha1'], self.newUids[msg['sha1']]) for msg in msgs
+                             if self.newUids.has_key(msg['sha1'])])
+            done([(self.messages[sha], uid) for sha, uid in uploaded.items()])
+            for sha, uid in uploaded.items():
+                if uid is not None:
+                    server.folder.msgs[uid] = sha
+            server.folder.UIDs = bagoma.UidSet(server.folder.msgs.keys())
+            return uploaded
+        bagoma.uploadAll = uploadAll
+        pending = restoreAllMailFld(server, self.dir, self.messages, self.allMail, self.journal)
+        self.journal.reset(pending)
+        return pending
+
+    def testNewUidValidity(self):
+        # Only message 1 is still on the server, and message 3 fails to upload
+        server = FakeServer({'7': sha1(1)}, 2)
+        self.newUids = {sha1(2): '8'}
+        self.assertEqual(self.restore(server), [sha1(3)])
+        # No UID for message 3, and the old UIDVALIDITY until it's restored
+        self.assertEqual(sorted(self.allMail.msgs.items()), [('7', sha1(1)), ('8', sha1(2))])
+        self.assertEqual(list(self.allMail.UIDs), ['7', '8'])
+        self.assertEqual(self.allMail['UIDVALIDITY'], 1)
+        self.assertEqual(RestoreJournal(self.dir).loadPending(), set([sha1(3)]))
+
+        # The next restore looks for it by SHA1
+        self.newUids = {sha1(3): '9'}
+        self.assertEqual(self.restore(server), [])
+        self.assertEqual(sorted(self.allMail.msgs.items()), [('7', sha1(1)), ('8', sha1(2)), ('9', sha1(3))])
+        self.assertEqual(self.messages[sha1(3)]['uid'], '9')
+        self.assertEqual(self.allMail['UIDVALIDITY'], 2)
+        self.assertFalse(os.path.exists(self.journal.path))
+
+    def testSameUidValidity(self):
+        # Message 3 was left out by a restore that was followed by a backup
+        del self.allMail.msgs['3']
+        self.allMail.UIDs = bagoma.UidSet(['1', '2'])
+        self.journal.reset([sha1(3), sha1(9)])
+        server = FakeServer({'1': sha1(1), '2': sha1(2)}, 1)
+        self.assertEqual(self.restore(server), [sha1(3)])
+        self.assertEqual(sorted(self.allMail.msgs.keys()), ['1', '2'])
+
+        self.newUids = {sha1(3): '4'}
+        self.assertEqual(self.restore(server), [])
+        self.assertEqual(sorted(self.allMail.msgs.items()), [('1', sha1(1)), ('2', sha1(2)), ('4', sha1(3))])
+        self.assertEqual(list(self.allMail.UIDs), ['1', '2', '4'])
+
+    def testSameUidValidityFailed(self):
+        # Messages 2 and 3 are gone from the server. Message 2 fails to
+        # upload, and the server doesn't give the new UID of message 3.
+        server = FakeServer({'1': sha1(1)}, 1)
+        self.newUids = {sha1(3): None}
+        self.assertEqual(sorted(self.restore(server)), sorted([sha1(2), sha1(3)]))
+        # Neither keeps its old UID
+        self.assertEqual(self.allMail.msgs.items(), [('1', sha1(1))])
+        self.assertEqual(list(self.allMail.UIDs), ['1'])
+        self.assertEqual(RestoreJournal(self.dir).loadPending(), set([sha1(2), sha1(3)]))
+
+        self.newUids = {sha1(2): '5', sha1(3): '6'}
+        del self.uploads[:]
+        self.assertEqual(self.restore(server), [])
+        self.assertEqual(sorted(self.uploads), sorted([sha1(2), sha1(3)]))
+        self.assertEqual(self.allMail.msgs.items(), [('1', sha1(1)), ('5', sha1(2)), ('6', sha1(3))])
+
+    def testSameUidValidityInterrupted(self):
+        # The restore that was interrupted uploaded message 3 without
+        # getting its UID, and message 2 with UID 4
+        self.journal.add([(sha1(3), None), (sha1(2), '4')], 1)
+        server = FakeServer({'1': sha1(1), '4': sha1(2), '5': sha1(3)}, 1)
+        self.assertEqual(self.restore(server), [sha1(3)])
+        self.assertEqual(self.uploads, [])
+        self.assertEqual(self.allMail.msgs.items(), [('1', sha1(1)), ('4', sha1(2))])
+        self.assertEqual(list(self.allMail.UIDs), ['1', '4'])
+
+
+if __name__ == '__main__':
+    unittest.main()
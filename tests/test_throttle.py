@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for Throttle"""
+
+import time
+import logging
+import unittest
+
+import bagoma
+from bagoma import Throttle
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+
+
+class ThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.throttle = Throttle()
+
+    def testUnthrottled(self):
+        for n in range(5):
+            self.throttle.wait()
+            self.throttle.done(0.5, 100 * 1024 * 1024, False)
+        self.assertEqual(self.throttle.pause, 0.0)
+        # No cap until the server throttles us
+        self.assertEqual(self.throttle.rate, None)
+        self.assertTrue(self.throttle.next <= time.time())
+
+    def testPause(self):
+        self.throttle.done(0.1, 100, True)
+        self.assertEqual(self.throttle.pause, 1.0)
+        self.assertTrue(self.throttle.next >= time.time() + 0.9)
+        self.throttle.done(0.1, 100, True)
+        self.assertEqual(self.throttle.pause, 2.0)
+        for n in range(10):
+            self.throttle.done(0.1, 100, True)
+        self.assertEqual(self.throttle.pause, Throttle.MaxPause)
+        self.assertEqual(self.throttle.throttled, 12)
+        # Too few bytes for it to be the transfer rate
+        self.assertEqual(self.throttle.rate, None)
+
+    def testRecovery(self):
+        self.throttle.done(0.1, 100, True)
+        self.throttle.done(0.1, 100, True)
+        pauses = []
+        for n in range(5):
+            self.throttle.done(0.1, 100, False)
+            pauses.append(self.throttle.pause)
+        # 1/(1/pause + 1): one more command per second each time
+        self.assertAlmostEqual(pauses[0], 2.0 / 3)
+        self.assertAlmostEqual(pauses[1], 0.4)
+        self.assertEqual(pauses, sorted(pauses, reverse=True))
+
+        for n in range(200):
+            self.throttle.done(0.1, 100, False)
+        self.assertEqual(self.throttle.pause, 0.0)
+
+    def testRate(self):
+        now = time.time()
+        self.throttle.windowStart = now - 4
+        self.throttle.done(0.1, 8 * 1024 * 1024, True)
+        # Half of 8 MB in 4 seconds
+        self.assertAlmostEqual(self.throttle.rate, 1024 * 1024, delta=1024)
+
+        # Never less than MinRate, and never more than the last cap
+        self.throttle.windowStart = time.time() - 8
+        self.throttle.windowBytes = 0
+        self.throttle.done(0.1, 1024 * 1024, True)
+        self.assertEqual(self.throttle.rate, Throttle.MinRate)
+
+        # Creeps back up, and paces the next command by the bytes received
+        self.throttle.pause = 0.0
+        self.throttle.last = time.time() - 2
+        self.throttle.next = 0.0
+        self.throttle.done(0.1, Throttle.MinRate, False)
+        self.assertAlmostEqual(self.throttle.rate, Throttle.MinRate + 2 * Throttle.RateStep, delta=1024)
+        self.assertTrue(self.throttle.next > time.time() + 0.5)
+
+    def testStr(self):
+        self.assertEqual(str(self.throttle), "Throttled 0 time(s) in 0 command(s), 0.00s per command on average")
+        self.throttle.done(1.0, 100, False)
+        self.throttle.done(2.0, 100, True)
+        self.assertEqual(str(self.throttle), "Throttled 1 time(s) in 2 command(s), 1.20s per command on average")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for UidMap"""
+
+import logging
+import hashlib
+import unittest
+import cPickle as pickle
+
+import bagoma
+from bagoma import UidMap
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+
+
+def sha1(n):
+    return hashlib.sha1(str(n)).hexdigest()
+
+
+class UidMapTest(unittest.TestCase):
+
+    def testDict(self):
+        msgs = UidMap({'3':sha1(3), '1':sha1(1)})
+        msgs['2'] = sha1(2)
+        self.assertEqual(len(msgs), 3)
+        self.assertEqual(msgs['2'], sha1(2))
+        self.assertEqual(msgs[2], sha1(2))
+        self.assertTrue('1' in msgs)
+        self.assertFalse(msgs.has_key('4'))
+        self.assertEqual(msgs.get('4', 'none'), 'none')
+        self.assertRaises(KeyError, msgs.__getitem__, '4')
+        self.assertEqual(msgs.keys(), ['1', '2', '3'])
+        self.assertEqual(msgs.items(), [('1', sha1(1)), ('2', sha1(2)), ('3', sha1(3))])
+
+    def testUnsorted(self):
+        msgs = UidMap()
+        for uid in [10, 5, 7, 1, 12]:
+            msgs[str(uid)] = sha1(uid)
+        self.assertEqual(msgs['7'], sha1(7))
+        self.assertEqual(msgs.keys(), ['1', '5', '7', '10', '12'])
+        self.assertEqual(msgs.values(), [sha1(uid) for uid in [1, 5, 7, 10, 12]])
+
+    def testReplaceAndDelete(self):
+        msgs = UidMap(dict([(str(n), sha1(n)) for n in range(1, 6)]))
+        msgs['3'] = sha1(30)
+        del msgs['1']
+        msgs['0'] = sha1(0)
+        del msgs['0']
+        self.assertRaises(KeyError, msgs.__delitem__, '1')
+        self.assertEqual(msgs.items(), [('2', sha1(2)), ('3', sha1(30)), ('4', sha1(4)), ('5', sha1(5))])
+
+    def testOtherValues(self):
+        # Only SHA1s are stored as digests
+        msgs = UidMap({'1':sha1(1), '2':'__%s.2' % sha1(1)})
+        self.assertEqual(msgs['2'], '__%s.2' % sha1(1))
+        self.assertEqual(len(msgs), 2)
+        self.assertEqual(sorted(msgs.items()), [('1', sha1(1)), ('2', '__%s.2' % sha1(1))])
+        del msgs['2']
+        self.assertEqual(msgs.keys(), ['1'])
+
+    def testCopy(self):
+        msgs = UidMap({'1':sha1(1)})
+        copy = msgs.copy()
+        copy['2'] = sha1(2)
+        self.assertEqual(msgs.keys(), ['1'])
+        self.assertEqual(copy.keys(), ['1', '2'])
+
+    def testTrack(self):
+        msgs = UidMap({'1':sha1(1)})
+        msgs.track()
+        msgs['3'] = sha1(3)
+        msgs['2'] = sha1(2)
+        self.assertEqual(msgs.takeAdded(), ['3', '2'])
+        self.assertEqual(msgs.takeAdded(), [])
+
+    def testReverse(self):
+        msgs = UidMap({'1':sha1(1), '2':sha1(2), '9':sha1(1)})
+        # Out of order
+        msgs['5'] = sha1(1)
+        self.assertEqual(msgs.uidsOf(sha1(1)), ['1', '5', '9'])
+        self.assertEqual(msgs.uidOf(sha1(1)), '9')
+        self.assertEqual(msgs.uidsOf(sha1(2)), ['2'])
+        self.assertEqual(msgs.uidOf(sha1(3)), None)
+        self.assertEqual(msgs.uidOf(sha1(3), 'none'), 'none')
+
+    def testReverseUpdates(self):
+        msgs = UidMap({'1':sha1(1), '2':sha1(2), '3':sha1(1)})
+        self.assertEqual(msgs.uidsOf(sha1(1)), ['1', '3'])
+
+        # The reverse map is kept up to date once built
+        msgs['4'] = sha1(1)
+        msgs['0'] = sha1(2)
+        self.assertEqual(msgs.uidsOf(sha1(1)), ['1', '3', '4'])
+        self.assertEqual(msgs.uidsOf(sha1(2)), ['0', '2'])
+
+        msgs['3'] = sha1(3)
+        del msgs['1']
+        del msgs['0']
+        self.assertEqual(msgs.uidsOf(sha1(1)), ['4'])
+        self.assertEqual(msgs.uidsOf(sha1(2)), ['2'])
+        self.assertEqual(msgs.uidOf(sha1(3)), '3')
+
+        del msgs['4']
+        self.assertEqual(msgs.uidsOf(sha1(1)), [])
+        msgs.clear()
+        self.assertEqual(msgs.uidsOf(sha1(2)), [])
+
+    def testReverseOther(self):
+        msgs = UidMap({'1':sha1(1), '2':'other', '3':'other'})
+        self.assertEqual(msgs.uidsOf('other'), ['2', '3'])
+        self.assertEqual(msgs.uidOf('other'), '3')
+        self.assertEqual(msgs.uidsOf(sha1(1)), ['1'])
+
+    def testReverseCopy(self):
+        msgs = UidMap({'1':sha1(1)})
+        self.assertEqual(msgs.uidOf(sha1(1)), '1')
+        copy = msgs.copy()
+        copy['2'] = sha1(1)
+        self.assertEqual(copy.uidsOf(sha1(1)), ['1', '2'])
+        self.assertEqual(msgs.uidsOf(sha1(1)), ['1'])
+
+        # Rebuilt after unpickling
+        copy = pickle.loads(pickle.dumps(copy, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy.uidsOf(sha1(1)), ['1', '2'])
+
+    def testPickle(self):
+        msgs = UidMap({'1':sha1(1), '2':'other'})
+        msgs['0'] = sha1(0)
+        copy = pickle.loads(pickle.dumps(msgs, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy.items(), msgs.items())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for UidSet and the IMAP sequence set helpers"""
+
+import logging
+import unittest
+
+import bagoma
+from bagoma import UidSet, compressUidSet, expandUidSet
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+
+
+class UidSetTest(unittest.TestCase):
+
+    def testRanges(self):
+        uids = UidSet(['9', '1', '2', '3', '7', '12', '10', '11', '3'])
+        self.assertEqual(str(uids), '1:3,7,9:12')
+        self.assertEqual(len(uids), 8)
+        self.assertEqual(list(uids), ['1', '2', '3', '7', '9', '10', '11', '12'])
+
+    def testEmpty(self):
+        uids = UidSet()
+        self.assertEqual(len(uids), 0)
+        self.assertEqual(str(uids), '')
+        self.assertEqual(list(uids), [])
+        self.assertFalse('1' in uids)
+
+    def testParse(self):
+        uids = UidSet.parse('12:9,1:4,7,3')
+        self.assertEqual(str(uids), '1:4,7,9:12')
+        self.assertEqual(str(UidSet.parse(str(uids))), str(uids))
+
+    def testFromPairs(self):
+        self.assertEqual(str(UidSet.fromPairs([(5, 8), (1, 2), (3, 3), (7, 10)])), '1:3,5:10')
+
+    def testContains(self):
+        uids = UidSet.parse('1:3,7,9:12')
+        for uid in ['1', '2', '3', '7', '9', '12', 10L]:
+            self.assertTrue(uid in uids, uid)
+        for uid in ['0', '4', '6', '8', '13']:
+            self.assertFalse(uid in uids, uid)
+
+    def testUnion(self):
+        uids = UidSet.parse('1:3,10').union(['4', '8', '9'])
+        self.assertEqual(str(uids), '1:4,8:10')
+
+    def testIntersection(self):
+        uids = UidSet.parse('1:10,20:30').intersection(UidSet.parse('5:22,25,40'))
+        self.assertEqual(str(uids), '5:10,20:22,25')
+
+    def testDifference(self):
+        uids = UidSet.parse('1:10,20:30').difference(UidSet.parse('3,5:6,10:21,30'))
+        self.assertEqual(str(uids), '1:2,4,7:9,22:29')
+        self.assertEqual(len(UidSet.parse('1:5').difference(['1', '2', '3', '4', '5'])), 0)
+
+    def testOf(self):
+        uids = UidSet.parse('1:3')
+        self.assertTrue(UidSet.of(uids) is uids)
+        self.assertEqual(str(UidSet.of(['3', '1', '2'])), '1:3')
+
+    def testPickle(self):
+        import cPickle as pickle
+        uids = UidSet.parse('1:3,7,9:12')
+        self.assertEqual(str(pickle.loads(pickle.dumps(uids, pickle.HIGHEST_PROTOCOL))), '1:3,7,9:12')
+
+
+class SequenceSetTest(unittest.TestCase):
+
+    def testCompress(self):
+        self.assertEqual(compressUidSet(['4', '1', '2', '3', '7', '9', '10', '3']), '1:4,7,9:10')
+
+    def testExpandKeepsOrder(self):
+        # COPYUID pairs the UIDs by their position
+        self.assertEqual(expandUidSet('5,1:3,9:8'), ['5', '1', '2', '3', '8', '9'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# vi:ai:tabstop=8:shiftwidth=4:softtabstop=4:expandtab:fdm=indent
+
+"""Tests for how a restore groups the messages it uploads, and uploads them to a fake IMAP server"""
+
+import shutil
+import logging
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import bagoma
+from bagoma import groupBySize
+
+import fakeimap
+from fakeimap import Account, Message
+from test_index import makeMsg
+
+# Normally set up by main()
+bagoma.logger = logging.getLogger('bagoma')
+bagoma.status = lambda msg, log2logger=True: None
+bagoma.progress = lambda msg: None
+
+
+class GroupBySizeTest(unittest.TestCase):
+
+    def group(self, sizes, maxCount, maxBytes):
+        return list(groupBySize(sizes, lambda size: size, maxCount, maxBytes))
+
+    def testCount(self):
+        self.assertEqual(self.group([1] * 5, 2, 100), [[1, 1], [1, 1], [1]])
+        self.assertEqual(self.group([1] * 3, 1, 100), [[1], [1], [1]])
+        self.assertEqual(self.group([], 2, 100), [])
+
+    def testBytes(self):
+        self.assertEqual(self.group([40, 60, 10, 90, 5], 10, 100), [[40, 60], [10, 90], [5]])
+        # Too large for any group
+        self.assertEqual(self.group([10, 500, 10], 10, 100), [[10], [500], [10]])
+
+    def testLazy(self):
+        taken = []
+        def items():
+            for n in range(6):
+                taken.append(n)
+                yield n
+        groups = groupBySize(items(), lambda n: 1, 2, 100)
+        self.assertEqual(groups.next(), [0, 1])
+        # Only one more item is taken than what was yielded
+        self.assertEqual(taken, [0, 1, 2])
+
+
+
+class UploadTest(unittest.TestCase):
+    """Five messages in the backup, uploaded to Work"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        bagoma.options = fakeimap.makeOptions(backupDir=self.dir, appendBatch=2)
+        store = bagoma.msgStore(self.dir)
+        self.msgs = [makeMsg(n, ['Work']) for n in range(1, 6)]
+        self.bodies = [Message(n).body for n in range(1, 6)]
+        for msg, body in zip(self.msgs, self.bodies):
+            with store.create(msg['sha1']) as f:
+                f.write(body)
+        self.account = Account()
+        self.account.mailbox('Work')
+        self.server = fakeimap.connect(self.account)
+
+    def tearDown(self):
+        self.server.logout()
+        store = bagoma.msgStores.pop(self.dir, None)
+        store.packs.close()
+        shutil.rmtree(self.dir)
+
+    def check(self, uploaded):
+        work = self.account.mailbox('Work')
+        self.assertEqual([msg.body for uid, msg in work.msgs], self.bodies)
+        self.assertEqual([msg.flags for uid, msg in work.msgs], ['\\Seen', '', '\\Seen', '', '\\Seen'])
+        self.assertEqual([msg.date for uid, msg in work.msgs], [msg['internaldate'] for msg in self.msgs])
+        self.assertEqual(uploaded, dict([(msg['sha1'], str(uid)) for msg, (uid, m) in zip(self.msgs, work.msgs)]))
+
+    def testMultiAppend(self):
+        uploaded = self.server.uploadMsgs(self.dir, self.msgs, 'Work')
+        self.check(uploaded)
+        # Two at a time
+        self.assertEqual(len(self.account.sent('^APPEND')), 3)
+        # Only in the tagged responses
+        self.assertFalse('APPENDUID' in self.server.untagged_responses)
+
+    def testOneAtATime(self):
+        self.account.capabilities = [c for c in Account.Capabilities if c != 'MULTIAPPEND']
+        self.server.logout()
+        self.server = fakeimap.connect(self.account)
+        self.check(self.server.uploadMsgs(self.dir, self.msgs, 'Work'))
+        self.assertEqual(len(self.account.sent('^APPEND')), 5)
+
+    def testFailed(self):
+        # The messages of the APPEND that fails are sent again one at a time
+        self.account.failOn('^APPEND')
+        uploaded = self.server.uploadMsgs(self.dir, self.msgs, 'Work')
+        self.assertEqual(len(uploaded), 5)
+        self.assertEqual(len(self.account.sent('^APPEND')), 2 + 2 + 1)
+
+    def testStaleResponses(self):
+        # Left by an earlier command
+        self.server.untagged_responses['NO'] = ['Stale']
+        body = self.bodies[0]
+        result, data = self.server.appendOnce('Nowhere', [('', self.msgs[0]['internaldate'], StringIO(body), len(body))])
+        self.assertEqual(result, 'NO')
+        self.assertFalse('Stale' in self.server.untagged_responses.get('NO', []))
+
+    def testState(self):
+        self.server.logout()
+        self.assertRaisesRegexp(self.server.error, 'APPEND illegal in state LOGOUT', self.server.appendOnce, 'Work', [])
+        self.server = fakeimap.connect(self.account)
+
+
+if __name__ == '__main__':
+    unittest.main()